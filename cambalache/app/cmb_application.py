@@ -53,6 +53,12 @@ class CmbApplication(Gtk.Application):
                              _("Export project"),
                              None)
 
+        self.add_main_option('jobs', b'j',
+                             GLib.OptionFlags.NONE,
+                             GLib.OptionArg.INT,
+                             _("Number of processes used to export the project"),
+                             'N')
+
     def __add_window(self):
         window = CmbWindow(application=self)
         window.connect('open-project', self.__on_open_project)
@@ -70,10 +76,47 @@ class CmbApplication(Gtk.Application):
         if window is None:
             window = self.__add_window()
             if path is not None:
-                window.open_project(path, target_tk=target_tk, uiname=uiname)
+                self.__open_project(window, path, target_tk, uiname)
 
         window.present()
 
+    def __ask_recover(self, window, path):
+        text = _('Recover unsaved changes?')
+        dialog = Gtk.MessageDialog(
+            transient_for=window,
+            flags=0,
+            message_type=Gtk.MessageType.QUESTION,
+            text=f'<b><big>{text}</big></b>',
+            use_markup=True,
+            secondary_text=_('{path} was not saved before Cambalache was closed.').format(
+                path=path.replace(GLib.get_home_dir(), '~')
+            )
+        )
+
+        dialog.add_buttons(_('Discard'), Gtk.ResponseType.REJECT,
+                           _('Recover'), Gtk.ResponseType.ACCEPT)
+
+        dialog.set_default_response(Gtk.ResponseType.ACCEPT)
+        response = dialog.run()
+        dialog.destroy()
+
+        return response
+
+    def __open_project(self, window, path, target_tk, uiname):
+        response = None
+
+        # Offer to load the autosave file if it is newer than the project
+        if CmbProject.get_recovery_filename(path) is not None:
+            window.present()
+            response = self.__ask_recover(window, path)
+
+        recover = response == Gtk.ResponseType.ACCEPT
+        window.open_project(path, target_tk=target_tk, uiname=uiname, recover=recover)
+
+        # Unsaved changes are only thrown away if the user says so
+        if response == Gtk.ResponseType.REJECT and window.project is not None:
+            window.project.remove_autosave()
+
     def import_file(self, path):
         window = self.__add_window() if self.props.active_window is None else self.props.active_window
         window.import_file(path)
@@ -89,7 +132,7 @@ class CmbApplication(Gtk.Application):
                     data = fd.read(1024)
                 content_type, uncertain = Gio.content_type_guess(path, data)
 
-            if content_type == 'application/x-cambalache-project':
+            if content_type in ['application/x-cambalache-project', 'application/x-cambalache-project-db']:
                 self.open(path)
             elif content_type in ['application/x-gtk-builder', 'application/x-glade']:
                 self.import_file(path)
@@ -116,7 +159,7 @@ class CmbApplication(Gtk.Application):
 
     def __on_open_project(self, window, filename, target_tk, uiname):
         if window.project is None:
-            window.open_project(filename, target_tk, uiname)
+            self.__open_project(window, filename, target_tk, uiname)
         else:
             self.open(filename, target_tk, uiname)
 
@@ -181,8 +224,14 @@ class CmbApplication(Gtk.Application):
                 for project, check in projects2save:
                     if check is None or check.props.active:
                         project.save()
+                    else:
+                        project.remove_autosave()
             elif unsaved_windows_len:
                 unsaved_windows[0].project.save()
+        elif response == Gtk.ResponseType.CLOSE:
+            # Changes were discarded, nothing to recover
+            for win in unsaved_windows:
+                win.project.remove_autosave()
         elif response == Gtk.ResponseType.CANCEL:
             return False
 
@@ -219,7 +268,8 @@ class CmbApplication(Gtk.Application):
             filename = options.lookup_value('export-all')
             filename = ''.join([ chr(c) for c in filename.unpack()])
             project = CmbProject(filename=filename)
-            project.export()
+            jobs = options.lookup_value('jobs').get_int32() if options.contains('jobs') else 1
+            project.export(jobs=jobs)
             return 0
 
         return -1
@@ -35,6 +35,12 @@ from . import cmb_tutorial
 
 logger = getLogger(__name__)
 
+# Seconds between unsaved changes backups
+AUTOSAVE_INTERVAL = 30
+
+# Undo history size is shown in MB in the preferences dialog
+HISTORY_SIZE_UNIT = 1024 * 1024
+
 
 @Gtk.Template(resource_path='/ar/xjuan/Cambalache/app/cmb_window.ui')
 class CmbWindow(Gtk.ApplicationWindow):
@@ -85,6 +91,11 @@ class CmbWindow(Gtk.ApplicationWindow):
 
     about_dialog = Gtk.Template.Child()
 
+    # Preferences
+    preferences_dialog = Gtk.Template.Child()
+    history_max_entries = Gtk.Template.Child()
+    history_max_size = Gtk.Template.Child()
+
     # Tutor widgets
     intro_button = Gtk.Template.Child()
     main_menu = Gtk.Template.Child()
@@ -99,6 +110,8 @@ class CmbWindow(Gtk.ApplicationWindow):
 
         super().__init__(**kwargs)
 
+        self.__autosave_timeout_id = GLib.timeout_add_seconds(AUTOSAVE_INTERVAL, self.__on_autosave_timeout)
+
         self.editor_stack.set_size_request(420, -1)
 
         self.actions = {}
@@ -117,7 +130,7 @@ class CmbWindow(Gtk.ApplicationWindow):
                        'close', 'debug',
                        'show_workspace',
                        'donate', 'liberapay', 'patreon',
-                       'contact', 'about']:
+                       'contact', 'preferences', 'about']:
             gaction = Gio.SimpleAction.new(action, None)
             gaction.connect("activate", getattr(self, f'_on_{action}_activate'))
             self.actions[action] = gaction
@@ -194,6 +207,16 @@ class CmbWindow(Gtk.ApplicationWindow):
         for prop in settings:
             self.settings.bind(prop, self, prop.replace('-', '_'), Gio.SettingsBindFlags.DEFAULT)
 
+        # Preferences dialog
+        self.history_max_entries.set_range(0, 1000000)
+        self.history_max_entries.set_increments(256, 1024)
+        self.settings.bind('history-max-entries', self.history_max_entries, 'value', Gio.SettingsBindFlags.DEFAULT)
+
+        self.history_max_size.set_range(0, 2047)
+        self.history_max_size.set_increments(16, 64)
+        self.settings.connect('changed::history-max-size', self.__on_history_max_size_setting_changed)
+        self.__on_history_max_size_setting_changed(self.settings, 'history-max-size')
+
         self.__load_window_state()
         self.__update_actions()
 
@@ -217,6 +240,10 @@ class CmbWindow(Gtk.ApplicationWindow):
             self.__project.disconnect_by_func(self.__on_project_filename_notify)
             self.__project.disconnect_by_func(self.__on_project_selection_changed)
             self.__project.disconnect_by_func(self.__on_project_changed)
+            self.settings.unbind(self.__project, 'history-max-entries')
+            self.settings.unbind(self.__project, 'history-max-size')
+            self.settings.unbind(self.__project, 'history-persistent')
+            self.__project.save_history()
 
         self.__project = project
         self.view.project = project
@@ -236,6 +263,11 @@ class CmbWindow(Gtk.ApplicationWindow):
             self.__project.connect("notify::filename", self.__on_project_filename_notify)
             self.__project.connect('selection-changed', self.__on_project_selection_changed)
             self.__project.connect('changed', self.__on_project_changed)
+
+            # History limits are user settings
+            self.settings.bind('history-max-entries', project, 'history-max-entries', Gio.SettingsBindFlags.GET)
+            self.settings.bind('history-max-size', project, 'history-max-size', Gio.SettingsBindFlags.GET)
+            self.settings.bind('history-persistent', project, 'history-persistent', Gio.SettingsBindFlags.GET)
         else:
             self.headerbar.set_subtitle(None)
 
@@ -250,6 +282,18 @@ class CmbWindow(Gtk.ApplicationWindow):
         widget.hide()
         return True
 
+    @Gtk.Template.Callback('on_preferences_dialog_delete_event')
+    def __on_preferences_dialog_delete_event(self, widget, event):
+        widget.hide()
+        return True
+
+    def __on_history_max_size_setting_changed(self, settings, key):
+        self.history_max_size.set_value(settings.get_int(key) // HISTORY_SIZE_UNIT)
+
+    @Gtk.Template.Callback('on_history_max_size_value_changed')
+    def __on_history_max_size_value_changed(self, spinbutton):
+        self.settings.set_int('history-max-size', spinbutton.get_value_as_int() * HISTORY_SIZE_UNIT)
+
     @Gtk.Template.Callback('on_type_chooser_type_selected')
     def __on_type_chooser_type_selected(self, popover, info):
         selection = self.project.get_selection()
@@ -388,7 +432,7 @@ class CmbWindow(Gtk.ApplicationWindow):
 
             history_index = self.project.history_index
             history_index_max = self.project.history_index_max
-            self.actions['undo'].set_enabled(history_index > 0)
+            self.actions['undo'].set_enabled(history_index > self.project.history_index_min)
             self.actions['redo'].set_enabled(history_index < history_index_max)
         else:
             self.actions['undo'].set_enabled(False)
@@ -612,15 +656,19 @@ class CmbWindow(Gtk.ApplicationWindow):
             self.present_message_to_user(_("Error importing {filename}").format(filename=filename),
                                          secondary_text=str(e))
 
-    def open_project(self, filename, target_tk=None, uiname=None):
+    def open_project(self, filename, target_tk=None, uiname=None, recover=False):
         try:
-            self.project = CmbProject(filename=filename, target_tk=target_tk)
+            self.project = CmbProject(filename=filename,
+                                      target_tk=target_tk,
+                                      recover=recover,
+                                      history_persistent=self.settings.get_boolean('history-persistent'))
 
             if uiname:
                 ui = self.project.add_ui(uiname)
                 self.project.set_selection([ui])
 
-            self.__last_saved_index = self.project.history_index
+            # Recovered changes are not saved yet
+            self.__last_saved_index = None if recover else self.project.history_index
             self.__set_page('workspace')
             self.__update_actions()
         except Exception as e:
@@ -834,9 +882,25 @@ class CmbWindow(Gtk.ApplicationWindow):
     def __save_project(self):
         if self.project is not None:
             self.__last_saved_index = self.project.history_index
-            self.project.save()
+            self.project.save_async(self.__on_project_saved)
             self.__update_action_save()
 
+    def __on_project_saved(self, error):
+        if error is None:
+            return
+
+        # Let the user try again
+        self.__last_saved_index = None
+        self.__update_action_save()
+        self.present_message_to_user(_('Error saving project'), secondary_text=str(error))
+
+    def __on_autosave_timeout(self):
+        # Project only writes a backup if there are new changes
+        if self.project is not None:
+            self.project.autosave()
+
+        return GLib.SOURCE_CONTINUE
+
     def _on_export_activate(self, action, data):
         if self.project is None:
             return
@@ -854,8 +918,12 @@ class CmbWindow(Gtk.ApplicationWindow):
     def _on_debug_activate(self, action, data):
         filename = self.project.filename + '.db'
         self.project.db_move_to_fs(filename)
+        self.view.debug_controllers()
         Gtk.show_uri_on_window(self, f'file://{filename}', Gdk.CURRENT_TIME)
 
+    def _on_preferences_activate(self, action, data):
+        self.preferences_dialog.present()
+
     def _on_about_activate(self, action, data):
         self.about_dialog.present()
 
@@ -1003,10 +1071,24 @@ class CmbWindow(Gtk.ApplicationWindow):
 
         self.window_settings.set_value('size', GLib.Variant('(ii)', size))
 
+    def __remove_autosave_timeout(self):
+        if self.__autosave_timeout_id:
+            GLib.source_remove(self.__autosave_timeout_id)
+            self.__autosave_timeout_id = None
+
     def do_delete_event(self, event):
         self.__save_window_state()
+        self.__remove_autosave_timeout()
+
+        if self.project is not None:
+            self.project.save_history()
+
         return False
 
+    def do_destroy(self):
+        self.__remove_autosave_timeout()
+        Gtk.ApplicationWindow.do_destroy(self)
+
     def __user_message_by_type(self, info):
         msg = None
 
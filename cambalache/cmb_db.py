@@ -22,9 +22,16 @@
 #
 
 import os
+import re
 import sys
 import sqlite3
+import stat
+import threading
 import ast
+import copy
+import itertools
+import hashlib
+import pathlib
 import gi
 
 from lxml import etree
@@ -61,6 +68,24 @@ GTK4_XML = os.path.join(catalogsdir, 'gtk-4.0.xml')
 LIBHANDY_XML = os.path.join(catalogsdir, 'libhandy-1.xml')
 LIBADWAITA_XML = os.path.join(catalogsdir, 'libadwaita-1.xml')
 
+# Native project file format, the SQLite database itself
+CMBDB_EXTENSION = '.cmbdb'
+
+# Maximum number of rows inserted with a single executemany() while loading
+LOAD_CHUNK_SIZE = 1024
+
+# Number of rows fetched and written at once while saving
+SAVE_CHUNK_SIZE = 1024
+
+# Number of history commands measured at once while compacting history
+HISTORY_SIZE_CHUNK = 256
+
+# Prebuilt type system snapshots, one per target_tk
+CATALOG_CACHE_DIR = os.path.join(GLib.get_user_cache_dir(), 'cambalache', 'catalogs')
+
+# Used if the user cache directory is not writable
+CATALOG_CACHE_FALLBACK_DIR = os.path.join(GLib.get_user_runtime_dir(), 'cambalache', 'catalogs')
+
 
 class CmbDB(GObject.GObject):
     __gtype_name__ = 'CmbDB'
@@ -73,6 +98,8 @@ class CmbDB(GObject.GObject):
         self.type_info = None
 
         self.__db_filename = None
+        self.__type_system_uri = None
+        self.__type_system_conn = None
 
         self.__tables = [
             'ui',
@@ -87,8 +114,60 @@ class CmbDB(GObject.GObject):
             'object_data_arg'
         ]
 
+        # Tables sorted by ui_id that can be saved one UI at a time
+        self.__per_ui_tables = [
+            'ui',
+            'ui_library',
+            'object',
+            'object_property',
+            'object_layout_property',
+            'object_data',
+            'object_data_arg'
+        ]
+
+        # Serialized table data from the last save and UIs changed since then
+        self.__save_cache = {}
+        self.__save_dirty = {}
+        self.__save_lock = threading.Lock()
+        self.__save_thread = None
+        self.__save_queue = []
+
+        # Tables serialized by the last prepared save, reset if a save fails
+        self.__save_cached = set()
+        self.__save_generation = 0
+
+        # Native project file up to date except for the changes listed here
+        self.__cmbdb_filename = None
+        self.__cmbdb_dirty = {}
+        self.__cmbdb_generation = 0
+
+        # Same for the autosave file
+        self.__autosave_thread = None
+        self.__autosave_filename = None
+        self.__autosave_dirty = {}
+
+        # History file up to date until this history id
+        self.__history_filename = None
+        self.__history_synced = 0
+
+        # Exported object nodes by (ui_id, object_id, merengue) and objects changed since then
+        self.__export_cache = {}
+        self.__export_dirty = set()
+        self.__export_dirty_names = set()
+
+        # Save always properties of each type hierarchy
+        self.__save_always_cache = {}
+
         self.history_commands = {}
 
+        # SQL expression with the size in bytes of a history table row
+        self.__history_row_size = {}
+
+        # Number of history commands and their size before this history id
+        self.__history_count = 0
+        self.__history_size = 0
+        self.__history_counted = 0
+
         self.clipboard = []
         self.clipboard_ids = []
 
@@ -96,27 +175,49 @@ class CmbDB(GObject.GObject):
 
         super().__init__(**kwargs)
 
-        c = self.conn.cursor()
         self.foreign_keys = True
 
-        # Create type system tables
-        c.executescript(BASE_SQL)
+        # Get shared type system database
+        self.__init_data()
+
+        c = self.conn.cursor()
 
         # Create project tables
         c.executescript(PROJECT_SQL)
 
+        # Tables with rowid have to be read in rowid order to get the same rows order on every save
+        self.__rowid_tables = [row[0] for row in c.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND sql NOT LIKE '%WITHOUT ROWID%';")]
+
+        # Rows of the other rowid tables are interleaved between UIs, they have to be saved as a whole
+        self.__save_per_ui_tables = [table for table in self.__per_ui_tables
+                                     if table == 'ui' or table not in self.__rowid_tables]
+
+        # Columns and schema used to copy project tables to save snapshots
+        self.__table_columns = {table: [row[1] for row in c.execute(f'PRAGMA table_info({table});')]
+                                for table in self.__tables}
+        tables = ', '.join([f"'{table}'" for table in self.__tables])
+        self.__tables_sql = [row[0] for row in c.execute(f'''SELECT sql FROM sqlite_master
+                                                               WHERE sql IS NOT NULL AND type IN ('table', 'index') AND tbl_name IN ({tables})
+                                                               ORDER BY type DESC;''')]
+
         self.conn.commit()
         c.close()
 
+        # Attach type system tables
+        self.__attach_type_system(self.conn)
+
         # Initialize history (Undo/Redo) tables
         self.__init_dynamic_tables()
-        self.__init_data()
 
 
     def __del__(self):
         self.conn.commit()
         self.conn.close()
 
+        if self.__type_system_conn is not None:
+            self.__type_system_conn.close()
+
     @GObject.Property(type=bool, default=True)
     def foreign_keys(self):
         self.conn.commit()
@@ -132,11 +233,14 @@ class CmbDB(GObject.GObject):
         self.conn.execute(f"PRAGMA foreign_keys={fk};")
 
     def __sqlite_connect(self, path):
-        conn = sqlite3.connect(path)
+        conn = sqlite3.connect(path, uri=True)
 
         conn.create_function('VERSION_CMP', 2, sqlite_version_cmp)
         conn.create_aggregate('MAX_VERSION', 1, MaxVersion)
         conn.create_function('CMB_PRINT', 1, cmb_print)
+        conn.create_function('CMB_TABLE_CHANGED', -1, self.__on_table_changed)
+        conn.create_function('CMB_EXPORT_CHANGED', -1, self.__on_export_changed)
+        conn.create_function('CMB_EXPORT_NAMES_CHANGED', 1, self.__on_export_names_changed)
 
         return conn
 
@@ -194,15 +298,60 @@ class CmbDB(GObject.GObject):
         nonpkcolumns = ', '.join(non_pk_columns)
 
         command = {
-            'PK': f"SELECT {pkcolumns} FROM history_{table} WHERE history_id=?;",
-            'COUNT': f"SELECT count(1) FROM {table} WHERE ({pkcolumns}) IS (SELECT {pkcolumns} FROM history_{table} WHERE history_id=?);",
             'DATA': f"SELECT {columns} FROM history_{table} WHERE history_id=?;",
-            'DELETE': f"DELETE FROM {table} WHERE ({pkcolumns}) IS (SELECT {pkcolumns} FROM history_{table} WHERE history_id=?);",
-            'INSERT': f"INSERT INTO {table} ({columns}) SELECT {columns} FROM history_{table} WHERE history_id=?;",
-            'UPDATE': f'UPDATE {table} SET ({nonpkcolumns}) = (SELECT {nonpkcolumns} FROM history_{table} WHERE history_id=? AND history_old=?) \
-                        WHERE ({pkcolumns}) IS (SELECT {pkcolumns} FROM history_{table} WHERE history_id=? AND history_old=?);'
+            'INSERT': f"INSERT INTO {table} ({columns}) SELECT {columns} FROM history_{table} WHERE history_id=?;"
         }
+
+        # Range commands, used to replay consecutive commands on this table with one statement
+        h_pkcolumns = ', '.join([f'h.{col}' for col in pk_columns])
+        t_pkcolumns = ', '.join([f'{table}.{col}' for col in pk_columns])
+        h_columns = ', '.join([f'h.{col}' for col in all_columns])
+        range_update = f'UPDATE {table} SET ({nonpkcolumns}) = \
+                          (SELECT {nonpkcolumns} FROM history_{table} AS h \
+                           WHERE h.history_id BETWEEN ? AND ? AND h.history_old={{old}} AND ({h_pkcolumns}) IS ({t_pkcolumns}) \
+                           ORDER BY h.history_id {{order}} LIMIT 1) \
+                        WHERE ({pkcolumns}) IN (SELECT {pkcolumns} FROM history_{table} WHERE history_id BETWEEN ? AND ? AND history_old={{old}});'
+
+        command.update({
+            'GET': f"SELECT {columns} FROM {table} WHERE ({pkcolumns}) IS ({', '.join(['?'] * len(pk_columns))});",
+            'RANGE_DATA': f"SELECT history.command, history.column_name, {h_columns} FROM history_{table} AS h JOIN history USING (history_id) \
+                            WHERE history_id BETWEEN ? AND ? ORDER BY history_id;",
+            'RANGE_DELETE': f"DELETE FROM {table} WHERE ({pkcolumns}) IN (SELECT {pkcolumns} FROM history_{table} WHERE history_id BETWEEN ? AND ?);",
+            'RANGE_INSERT': f"INSERT INTO {table} ({columns}) SELECT {columns} FROM history_{table} WHERE history_id BETWEEN ? AND ? ORDER BY history_id;",
+            'RANGE_INSERT_REVERSE': f"INSERT INTO {table} ({columns}) SELECT {columns} FROM history_{table} WHERE history_id BETWEEN ? AND ? ORDER BY history_id DESC;",
+            'RANGE_UNDO_UPDATE': range_update.format(old=1, order='ASC'),
+            'RANGE_REDO_UPDATE': range_update.format(old=0, order='DESC')
+        })
+
+        # Used to store and remove a whole UI at once on IMPORT commands
+        if 'ui_id' in all_columns:
+            command['SNAPSHOT'] = f"INSERT INTO history_{table} (history_id, history_old, {columns}) SELECT ?, ?, {columns} FROM {table} WHERE ui_id=?;"
+            command['DELETE_UI'] = f"DELETE FROM {table} WHERE ui_id IN (SELECT ui_id FROM history_ui WHERE history_id=? AND history_old=?);"
+            command['RESTORE_UI'] = f"INSERT INTO {table} ({columns}) SELECT {columns} FROM history_{table} WHERE history_id=? AND history_old=?;"
+
         self.history_commands[table] = command
+        self.__history_row_size[table] = ' + '.join([f'coalesce(length({col}), 0)' for col in all_columns])
+
+        # Keep track of changed tables to only serialize them on save
+        old_ui_id, new_ui_id = ('OLD.ui_id', 'NEW.ui_id') if 'ui_id' in all_columns else ('NULL', 'NULL')
+        c.execute(f'''
+    CREATE TRIGGER on_{table}_insert_changed AFTER INSERT ON {table}
+    BEGIN
+      SELECT CMB_TABLE_CHANGED('{table}', {new_ui_id});
+    END;
+        ''')
+        c.execute(f'''
+    CREATE TRIGGER on_{table}_delete_changed AFTER DELETE ON {table}
+    BEGIN
+      SELECT CMB_TABLE_CHANGED('{table}', {old_ui_id});
+    END;
+        ''')
+        c.execute(f'''
+    CREATE TRIGGER on_{table}_update_changed AFTER UPDATE ON {table}
+    BEGIN
+      SELECT CMB_TABLE_CHANGED('{table}', {old_ui_id}, {new_ui_id});
+    END;
+        ''')
 
         # INSERT Trigger
         c.execute(f'''
@@ -236,42 +385,37 @@ class CmbDB(GObject.GObject):
             else:
                 pkcolumns_values += ', NEW.' + col
 
-        if len(pk_columns) == 0:
+        if len(pk_columns) == 0 or len(non_pk_columns) == 0:
             return
 
-        # UPDATE Trigger for each non PK column
-        for column in non_pk_columns:
-            c.execute(f'''
-    CREATE TRIGGER on_{table}_update_{column} AFTER UPDATE OF {column} ON {table}
+        old_nonpk_values = ', '.join([f'OLD.{col}' for col in non_pk_columns])
+        new_nonpk_values = ', '.join([f'NEW.{col}' for col in non_pk_columns])
+
+        # Comma separated list of the columns changed by the UPDATE
+        changed_columns = ' || '.join([f"CASE WHEN NEW.{col} IS NOT OLD.{col} THEN ',{col}' ELSE '' END" for col in non_pk_columns])
+        changed_columns = f'substr({changed_columns}, 2)'
+
+        # UPDATE Trigger
+        # Consecutive updates of the same columns of the same row are compressed
+        # into the last history command, otherwise a new command is added.
+        # changes() is used to know which of the statements actually did something
+        c.execute(f'''
+    CREATE TRIGGER on_{table}_update AFTER UPDATE ON {table}
     WHEN
-      NEW.{column} IS NOT OLD.{column} AND {history_is_enabled} AND
-      ((SELECT command, table_name, column_name FROM history WHERE history_id = {history_seq})
-         IS NOT ('UPDATE', '{table}', '{column}')
-         OR
-       (SELECT {pkcolumns} FROM history_{table} WHERE history_id = {history_seq} AND history_old=0)
-         IS NOT ({pkcolumns_values}))
+      ({new_nonpk_values}) IS NOT ({old_nonpk_values}) AND {history_is_enabled}
     BEGIN
       {clear_history};
-      INSERT INTO history (history_id, command, table_name, column_name) VALUES ({history_next_seq}, 'UPDATE', '{table}', '{column}');
+      UPDATE history_{table} SET ({nonpkcolumns}) = ({new_nonpk_values})
+        WHERE history_id = {history_seq} AND history_old=0 AND ({pkcolumns}) IS ({pkcolumns_values}) AND
+          (SELECT command, table_name, column_name FROM history WHERE history_id = {history_seq}) IS ('UPDATE', '{table}', {changed_columns});
+      INSERT INTO history (history_id, command, table_name, column_name)
+        SELECT {history_next_seq}, 'UPDATE', '{table}', {changed_columns} WHERE changes() = 0;
       INSERT INTO history_{table} (history_id, history_old, {columns})
-        VALUES (last_insert_rowid(), 1, {old_values}),
-               (last_insert_rowid(), 0, {new_values});
-    END;
-            ''')
-
-            c.execute(f'''
-    CREATE TRIGGER on_{table}_update_{column}_compress AFTER UPDATE OF {column} ON {table}
-    WHEN
-      NEW.{column} IS NOT OLD.{column} AND {history_is_enabled} AND
-      ((SELECT command, table_name, column_name FROM history WHERE history_id = {history_seq})
-         IS ('UPDATE', '{table}', '{column}')
-         AND
-       (SELECT {pkcolumns} FROM history_{table} WHERE history_id = {history_seq} AND history_old=0)
-         IS ({pkcolumns_values}))
-    BEGIN
-      UPDATE history_{table} SET {column}=NEW.{column} WHERE history_id = {history_seq} AND history_old=0;
+        SELECT history_id, 1, {old_values} FROM (SELECT {history_seq} AS history_id) WHERE changes() = 1
+        UNION ALL
+        SELECT history_id, 0, {new_values} FROM (SELECT {history_seq} AS history_id) WHERE changes() = 1;
     END;
-            ''')
+        ''')
 
     def __init_dynamic_tables(self):
         c = self.conn.cursor()
@@ -283,36 +427,199 @@ class CmbDB(GObject.GObject):
         for table in self.__tables:
             self.__create_support_table(c,table)
 
+        self.__create_export_triggers(c)
+
         self.conn.commit()
         c.close()
 
-    def __init_data(self):
+    def __create_export_triggers(self, c):
+        def create_triggers(table, old_args, new_args):
+            for event, args in [('INSERT', [new_args]), ('DELETE', [old_args]), ('UPDATE', [old_args, new_args])]:
+                calls = '\n'.join([f'SELECT CMB_EXPORT_CHANGED({a});' for a in args])
+                c.execute(f'''
+    CREATE TRIGGER on_{table}_{event.lower()}_export AFTER {event} ON {table}
+    BEGIN
+      {calls}
+    END;
+                ''')
+
+        # Changing an object invalidates its parent too, since it is part of its children
+        create_triggers('object', 'OLD.ui_id, OLD.object_id, OLD.parent_id', 'NEW.ui_id, NEW.object_id, NEW.parent_id')
+
+        # Layout properties are exported in the child node
+        create_triggers('object_layout_property', 'OLD.ui_id, OLD.child_id', 'NEW.ui_id, NEW.child_id')
+
+        for table in ['object_property', 'object_signal', 'object_data', 'object_data_arg']:
+            create_triggers(table, 'OLD.ui_id, OLD.object_id', 'NEW.ui_id, NEW.object_id')
+
+        # UI data like template_id affects every object
+        create_triggers('ui', 'OLD.ui_id', 'NEW.ui_id')
+
+        # Object references are exported by name
+        c.executescript('''
+    CREATE TRIGGER on_object_insert_export_names AFTER INSERT ON object
+    BEGIN
+      SELECT CMB_EXPORT_NAMES_CHANGED(NEW.ui_id);
+    END;
+
+    CREATE TRIGGER on_object_delete_export_names AFTER DELETE ON object
+    BEGIN
+      SELECT CMB_EXPORT_NAMES_CHANGED(OLD.ui_id);
+    END;
+
+    CREATE TRIGGER on_object_update_export_names AFTER UPDATE OF name ON object
+    WHEN NEW.name IS NOT OLD.name
+    BEGIN
+      SELECT CMB_EXPORT_NAMES_CHANGED(NEW.ui_id);
+    END;
+        ''')
+
+    def __get_catalogs(self):
         if self.target_tk not in ['gtk+-3.0', 'gtk-4.0']:
             raise Exception(f'Unknown target tk {self.target_tk}')
 
-        # Add GObject and Gio data
-        self.load_catalog(GOBJECT_XML)
-        self.load_catalog(GIO_XML)
-
-        # Add GdkPixbuf and Pango data
-        self.load_catalog(GDKPIXBUF_XML)
-        self.load_catalog(PANGO_XML)
+        # GObject, Gio, GdkPixbuf and Pango data
+        retval = [GOBJECT_XML, GIO_XML, GDKPIXBUF_XML, PANGO_XML]
 
         # Add gtk data
         if self.target_tk == 'gtk+-3.0':
-            self.load_catalog(GDK3_XML)
-            self.load_catalog(GTK3_XML)
-            # FIXME: this should be optional
-            self.load_catalog(LIBHANDY_XML)
+            # FIXME: libhandy should be optional
+            retval += [GDK3_XML, GTK3_XML, LIBHANDY_XML]
         elif self.target_tk == 'gtk-4.0':
-            self.load_catalog(GDK4_XML)
-            self.load_catalog(GSK4_XML)
-            self.load_catalog(GTK4_XML)
-            # FIXME: this should be optional
-            self.load_catalog(LIBADWAITA_XML)
+            # FIXME: libadwaita should be optional
+            retval += [GDK4_XML, GSK4_XML, GTK4_XML, LIBADWAITA_XML]
 
         # TODO: Load all libraries that depend on self.target_tk
 
+        return retval
+
+    def __get_catalog_cache_basename(self, catalogs):
+        # The snapshot is only valid for this exact schema, catalogs and version
+        digest = hashlib.sha256()
+        digest.update(VERSION.encode())
+        digest.update(BASE_SQL.encode())
+
+        for filename in catalogs:
+            with open(filename, 'rb') as fd:
+                digest.update(f'{filename}:{os.stat(fd.fileno()).st_mtime_ns}'.encode())
+                digest.update(fd.read())
+
+        return f'{self.target_tk}-{digest.hexdigest()}.db'
+
+    @staticmethod
+    def __is_private(path, mode_mask):
+        # Only trust paths owned by the user that nobody else can write to
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+
+        return not stat.S_ISLNK(st.st_mode) and st.st_uid == os.getuid() and not (st.st_mode & mode_mask)
+
+    def __get_catalog_cache_dirs(self):
+        retval = []
+
+        for dirname in [CATALOG_CACHE_DIR, CATALOG_CACHE_FALLBACK_DIR]:
+            try:
+                os.makedirs(dirname, mode=0o700, exist_ok=True)
+
+                # Directories created by older versions could be readable by others
+                if CmbDB.__is_private(dirname, 0o022) and stat.S_IMODE(os.stat(dirname).st_mode) != 0o700:
+                    os.chmod(dirname, 0o700)
+            except OSError as e:
+                logger.warning(f'Error creating catalog cache directory {dirname}: {e}')
+                continue
+
+            if CmbDB.__is_private(dirname, 0o077):
+                retval.append(dirname)
+            else:
+                logger.warning(f'Ignoring catalog cache directory {dirname}, it is not private')
+
+        return retval
+
+    def __save_catalog_cache(self, conn, dirnames, basename):
+        for dirname in dirnames:
+            filename = os.path.join(dirname, basename)
+            tmp_filename = f'{filename}.{os.getpid()}.tmp'
+
+            try:
+                file_conn = sqlite3.connect(tmp_filename)
+                conn.backup(file_conn)
+                file_conn.close()
+
+                # Make sure other processes never see a partial snapshot
+                os.replace(tmp_filename, filename)
+            except Exception as e:
+                logger.warning(f'Error saving catalog cache {filename}: {e}')
+
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+            else:
+                return filename
+
+        return None
+
+    def __build_catalog_cache(self, catalogs, uri):
+        # Populate a scratch database since load_catalog() works on self.conn
+        conn = self.conn
+        self.conn = self.__sqlite_connect(uri)
+
+        try:
+            self.foreign_keys = True
+
+            # Create type system tables
+            self.conn.executescript(BASE_SQL)
+            self.conn.commit()
+
+            for catalog in catalogs:
+                self.load_catalog(catalog)
+
+            return self.conn
+        except Exception as e:
+            self.conn.close()
+            raise e
+        finally:
+            self.conn = conn
+
+    def __init_data(self):
+        catalogs = self.__get_catalogs()
+        basename = self.__get_catalog_cache_basename(catalogs)
+        dirnames = self.__get_catalog_cache_dirs()
+
+        for dirname in dirnames:
+            filename = os.path.join(dirname, basename)
+
+            if os.path.isfile(filename) and CmbDB.__is_private(filename, 0o022):
+                self.__type_system_uri = f'{pathlib.Path(filename).as_uri()}?mode=ro&immutable=1'
+                return
+
+        # Build the type system in a memory database shared with self.conn
+        uri = f'file:cambalache-{basename}-{id(self)}?mode=memory&cache=shared'
+        conn = self.__build_catalog_cache(catalogs, uri)
+        filename = self.__save_catalog_cache(conn, dirnames, basename)
+
+        if filename is None:
+            # Keep the memory database alive while this project is open
+            logger.warning(f'Could not save {self.target_tk} type system, using a memory copy')
+            self.__type_system_conn = conn
+            self.__type_system_uri = uri
+        else:
+            conn.close()
+            self.__type_system_uri = f'{pathlib.Path(filename).as_uri()}?mode=ro&immutable=1'
+
+    def __attach_type_system(self, conn):
+        # Every project shares the same read only type system database
+        conn.execute('ATTACH DATABASE ? AS base;', (self.__type_system_uri, ))
+
+        # Project template types are kept in the template_type overlay table
+        conn.execute('''
+            CREATE TEMP VIEW type AS
+              SELECT * FROM base.type
+              UNION ALL
+              SELECT type_id, parent_id, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL
+                FROM main.template_type;
+            ''')
+
     @staticmethod
     def get_target_from_file(filename):
         def get_target_from_line(line, tag):
@@ -323,6 +630,19 @@ class CmbDB(GObject.GObject):
             return root.get('target_tk', None)
 
         retval = None
+
+        if is_cmbdb_file(filename):
+            try:
+                uri = pathlib.Path(os.path.abspath(filename)).as_uri()
+                conn = sqlite3.connect(f'{uri}?mode=ro', uri=True)
+                row = conn.execute("SELECT value FROM cambalache_project WHERE key='target_tk';").fetchone()
+                conn.close()
+                retval = row[0] if row else None
+            except:
+                pass
+
+            return retval
+
         try:
             f = open(filename, 'r')
             for line in f:
@@ -358,6 +678,66 @@ class CmbDB(GObject.GObject):
 
         return retval
 
+    def get_toplevel(self, ui_id, object_id):
+        c = self.execute('''
+            WITH RECURSIVE ancestor(object_id, parent_id) AS (
+              SELECT object_id, parent_id FROM object WHERE ui_id=? AND object_id=?
+              UNION
+              SELECT o.object_id, o.parent_id
+                FROM object AS o JOIN ancestor ON o.object_id=ancestor.parent_id
+                WHERE o.ui_id=?
+            )
+            SELECT object_id FROM ancestor WHERE parent_id IS NULL;
+            ''', (ui_id, object_id, ui_id))
+        row = c.fetchone()
+        c.close()
+
+        return row[0] if row is not None else None
+
+    def get_toplevel_ids(self, ui_id, toplevel_id=None):
+        '''
+        Return a dictionary with the toplevel object id of every object in
+        ui_id, or only the ones in toplevel_id subtree.
+        '''
+        toplevel_filter = 'AND object_id=?' if toplevel_id is not None else ''
+        params = (ui_id, toplevel_id, ui_id) if toplevel_id is not None else (ui_id, ui_id)
+
+        return dict(self.execute(f'''
+            WITH RECURSIVE tree(object_id, toplevel_id) AS (
+              SELECT object_id, object_id FROM object WHERE ui_id=? AND parent_id IS NULL {toplevel_filter}
+              UNION ALL
+              SELECT o.object_id, tree.toplevel_id
+                FROM object AS o JOIN tree ON o.parent_id=tree.object_id
+                WHERE o.ui_id=?
+            )
+            SELECT object_id, toplevel_id FROM tree;
+            ''', params))
+
+    def has_external_references(self, ui_id, toplevel_id):
+        '''
+        Return True if an object outside toplevel_id subtree has an object
+        property pointing to an object inside it.
+        '''
+        c = self.execute('''
+            WITH RECURSIVE subtree(object_id) AS (
+              SELECT ?
+              UNION
+              SELECT o.object_id
+                FROM object AS o JOIN subtree ON o.parent_id=subtree.object_id
+                WHERE o.ui_id=?
+            )
+            SELECT EXISTS (
+              SELECT 1
+                FROM object_property AS op, property AS p
+                WHERE op.ui_id=? AND p.owner_id=op.owner_id AND p.property_id=op.property_id AND p.is_object AND
+                  op.object_id NOT IN subtree AND CAST(op.value AS INTEGER) IN subtree
+            );
+            ''', (toplevel_id, ui_id, ui_id))
+        row = c.fetchone()
+        c.close()
+
+        return bool(row[0])
+
     def __parse_version(self, version):
         if version is None:
             return (0, 0, 0)
@@ -379,31 +759,91 @@ class CmbDB(GObject.GObject):
 
         return data
 
-    def __migrate_table_data(self, c, version, table, data):
+    def __migrate_table_data(self, c, version, table):
         if version is None:
             return
 
         if version < (0, 7, 5):
-            cmb_db_migration.migrate_table_data_to_0_7_5(c, table, data)
+            cmb_db_migration.migrate_table_data_to_0_7_5(c, table)
 
         if version < (0, 9, 0):
-            cmb_db_migration.migrate_table_data_to_0_9_0(c, table, data)
+            cmb_db_migration.migrate_table_data_to_0_9_0(c, table)
 
     def __load_table_from_tuples(self, c, table, tuples, version=None):
-        data = ast.literal_eval(f'[{tuples}]') if tuples else []
+        if tuples:
+            self.__load_table_rows(c, table, iter_tuples(tuples), version)
 
-        if len(data) == 0:
-            return
+    def __load_table_rows(self, c, table, rows, version=None):
+        query = None
+
+        # Insert rows in bounded chunks while the text is being parsed
+        while True:
+            data = list(itertools.islice(rows, LOAD_CHUNK_SIZE))
+
+            if len(data) == 0:
+                break
 
-        # Ensure table data has the right ammount of columns
-        data = self.__ensure_table_data_columns(version, table, data)
+            # Ensure table data has the right ammount of columns
+            data = self.__ensure_table_data_columns(version, table, data)
 
-        # Load table data
-        cols = ', '.join(['?' for col in data[0]])
-        c.executemany(f'INSERT INTO {table} VALUES ({cols})', data)
+            # Load table data
+            if query is None:
+                cols = ', '.join(['?' for col in data[0]])
+                query = f'INSERT INTO {table} VALUES ({cols})'
+
+            c.executemany(query, data)
 
         # Migrate data to current format
-        self.__migrate_table_data(c, version, table, data)
+        if query is not None:
+            self.__migrate_table_data(c, version, table)
+
+    def __load_cmbdb(self, filename):
+        self.conn.commit()
+
+        # Project file is only read, this allows several processes loading the same file
+        uri = pathlib.Path(os.path.abspath(filename)).as_uri()
+        self.conn.execute('ATTACH DATABASE ? AS project_file;', (f'{uri}?mode=ro', ))
+
+        try:
+            metadata = dict(self.conn.execute('SELECT key, value FROM project_file.cambalache_project;'))
+            target_tk = metadata.get('target_tk', None)
+
+            if target_tk != self.target_tk:
+                raise Exception(f'Can not load a {target_tk} target in {self.target_tk} project.')
+
+            version = self.__parse_version(metadata.get('version', None))
+
+            if version > self.version:
+                raise Exception(f'Can not open file version {version}')
+
+            tables = [row[0] for row in self.conn.execute("SELECT name FROM project_file.sqlite_master WHERE type='table';")]
+            c = self.conn.cursor()
+
+            # Avoid circular dependencies errors
+            self.foreign_keys = False
+
+            for table in self.__tables:
+                if table not in tables:
+                    continue
+
+                if version == self.version:
+                    # Same schema, no need to go through Python
+                    c.execute(f'INSERT INTO main.{table} SELECT * FROM project_file.{table};')
+                else:
+                    rows = self.conn.execute(f'SELECT * FROM project_file.{table};')
+                    self.__load_table_rows(c, table, rows, version)
+
+            self.conn.commit()
+            self.foreign_keys = True
+            c.close()
+        finally:
+            self.conn.execute('DETACH DATABASE project_file;')
+
+        with self.__save_lock:
+            # Older files have to be written again with the current schema
+            self.__cmbdb_filename = os.path.realpath(filename) if version == self.version else None
+            self.__cmbdb_dirty = {}
+            self.__cmbdb_generation += 1
 
     def load(self, filename):
         # TODO: drop all data before loading?
@@ -411,30 +851,44 @@ class CmbDB(GObject.GObject):
         if filename is None or not os.path.isfile(filename):
             return
 
-        tree = etree.parse(filename)
-        root = tree.getroot()
+        if is_cmbdb_file(filename):
+            self.__load_cmbdb(filename)
+            return
 
-        target_tk = root.get('target_tk', None)
+        c = None
+        depth = 0
 
-        if target_tk != self.target_tk:
-            raise Exception(f'Can not load a {target_tk} target in {self.target_tk} project.')
+        # Parse one table at a time instead of building the whole tree
+        for event, node in etree.iterparse(filename, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
 
+                if depth == 1:
+                    target_tk = node.get('target_tk', None)
 
-        version = self.__parse_version(root.get('version', None))
+                    if target_tk != self.target_tk:
+                        raise Exception(f'Can not load a {target_tk} target in {self.target_tk} project.')
 
-        if version > self.version:
-            raise Exception(f'Can not open file version {version}')
+                    version = self.__parse_version(node.get('version', None))
 
-        c = self.conn.cursor()
+                    if version > self.version:
+                        raise Exception(f'Can not open file version {version}')
 
-        # Avoid circular dependencies errors
-        self.foreign_keys = False
+                    c = self.conn.cursor()
 
-        for child in root.getchildren():
-            self.__load_table_from_tuples(c, child.tag, child.text, version)
+                    # Avoid circular dependencies errors
+                    self.foreign_keys = False
+                continue
 
-        self.foreign_keys = True
-        c.close()
+            depth -= 1
+
+            if depth == 1:
+                self.__load_table_from_tuples(c, node.tag, node.text, version)
+                node.clear()
+
+        if c is not None:
+            self.foreign_keys = True
+            c.close()
 
     def load_catalog(self, filename):
         tree = etree.parse(filename)
@@ -489,84 +943,505 @@ class CmbDB(GObject.GObject):
                 # TODO: should we try to load the module?
                 #pass
 
-        # Avoid circular dependencies errors
-        self.foreign_keys = False
+        # Avoid circular dependencies errors
+        self.foreign_keys = False
+
+        for child in root.getchildren():
+            self.__load_table_from_tuples(c, child.tag, child.text)
+
+        self.foreign_keys = True
+        c.close()
+
+        self.commit()
+
+    def __on_table_changed(self, table, *ui_ids):
+        keys = ui_ids if table in self.__per_ui_tables else [None]
+
+        with self.__save_lock:
+            self.__save_dirty.setdefault(table, set()).update(keys)
+            self.__cmbdb_dirty.setdefault(table, set()).update(keys)
+            self.__autosave_dirty.setdefault(table, set()).update(keys)
+
+    def __on_export_changed(self, ui_id, *object_ids):
+        # No object ids means the whole UI changed
+        if len(object_ids) == 0:
+            self.__export_dirty.add((ui_id, None))
+
+        for object_id in object_ids:
+            if object_id is not None:
+                self.__export_dirty.add((ui_id, object_id))
+
+    def __on_export_names_changed(self, ui_id):
+        self.__export_dirty_names.add(ui_id)
+
+    def __export_cache_flush(self):
+        if not self.__export_dirty and not self.__export_dirty_names:
+            return
+
+        dirty = {}
+        for ui_id, object_id in self.__export_dirty:
+            dirty.setdefault(ui_id, set()).add(object_id)
+
+        dirty_names = self.__export_dirty_names
+        self.__export_dirty = set()
+        self.__export_dirty_names = set()
+
+        keys = set()
+        c = self.conn.cursor()
+
+        for ui_id, object_ids in dirty.items():
+            if None in object_ids:
+                continue
+
+            keys.update([(ui_id, object_id) for object_id in object_ids])
+            object_ids = list(object_ids)
+
+            # Cached ancestors include the changed objects
+            for i in range(0, len(object_ids), 512):
+                chunk = object_ids[i:i + 512]
+                placeholders = ','.join(['?'] * len(chunk))
+
+                for row in c.execute(f'''
+                    WITH RECURSIVE ancestor(object_id, parent_id) AS (
+                      SELECT object_id, parent_id FROM object WHERE ui_id=? AND object_id IN ({placeholders})
+                      UNION
+                      SELECT o.object_id, o.parent_id
+                        FROM object AS o JOIN ancestor ON o.object_id=ancestor.parent_id
+                        WHERE o.ui_id=?
+                    )
+                    SELECT object_id FROM ancestor;
+                    ''', (ui_id, *chunk, ui_id)):
+                    keys.add((ui_id, row[0]))
+
+        c.close()
+
+        for key in list(self.__export_cache.keys()):
+            ui_id, object_id, merengue = key
+
+            if (ui_id, object_id) in keys or None in dirty.get(ui_id, []) or \
+               (not merengue and ui_id in dirty_names):
+                self.__export_cache.pop(key)
+
+    def __get_table_sections(self, c, table, cache, dirty):
+        sections = cache.get(table, None)
+        per_ui = table in self.__save_per_ui_tables
+        order = ' ORDER BY rowid' if table in self.__rowid_tables else ''
+
+        def format_rows(rows):
+            return escape_xml_text(',\n'.join([format_tuple(row) for row in rows]))
+
+        if sections is None or (not per_ui and table in dirty):
+            # Serialize the whole table, grouping rows by UI if possible
+            groups = {}
+
+            c.execute(f"SELECT * FROM {table}{order};")
+            rows = c.fetchmany(SAVE_CHUNK_SIZE)
+
+            while len(rows):
+                for row in rows:
+                    groups.setdefault(row[0] if per_ui else None, []).append(row)
+
+                rows = c.fetchmany(SAVE_CHUNK_SIZE)
+
+            sections = {key: format_rows(rows) for key, rows in groups.items()}
+        elif per_ui:
+            # Only serialize UIs that changed since the last save
+            for ui_id in dirty.get(table, []):
+                rows = c.execute(f"SELECT * FROM {table} WHERE ui_id=?{order};", (ui_id, )).fetchall()
+
+                if len(rows):
+                    sections[ui_id] = format_rows(rows)
+                else:
+                    sections.pop(ui_id, None)
+
+        cache[table] = sections
+
+        return [sections[key] for key in sorted(sections)] if per_ui else list(sections.values())
+
+    def __write_table(self, fd, table, sections, prefix):
+        if len(sections) == 0:
+            return False
+
+        fd.write(f'{prefix}  <{table}>\n'.encode())
+
+        for i, section in enumerate(sections):
+            if i:
+                fd.write(b',\n')
+            fd.write(section.encode())
+
+        fd.write(f'\n  </{table}>\n'.encode())
+        return True
+
+    def __save_snapshot(self, tables):
+        '''
+        Copy project rows to a database that can be used from another thread.
+
+        tables maps every table to copy to a set of ui_ids or None for all rows.
+        '''
+        self.conn.commit()
+        snapshot = sqlite3.connect(':memory:', check_same_thread=False)
+
+        for table, ui_ids in tables.items():
+            columns = self.__table_columns[table]
+            rowid = table in self.__rowid_tables
+            snapshot.execute(f'CREATE TABLE {table} ({", ".join(columns)});')
+
+            # Keep rowids so rows are read back in the same order
+            select = 'SELECT rowid, *' if rowid else 'SELECT *'
+            names = ', '.join(['rowid'] + columns if rowid else columns)
+            values = ', '.join(['?' for i in range(len(columns) + rowid)])
+
+            if ui_ids is None:
+                rows = self.conn.execute(f'{select} FROM main.{table};')
+            else:
+                snapshot.execute(f'CREATE INDEX {table}_ui_id ON {table} (ui_id);')
+                keys = ', '.join(['?' for ui_id in ui_ids])
+                rows = self.conn.execute(f'{select} FROM main.{table} WHERE ui_id IN ({keys});', tuple(ui_ids))
+
+            snapshot.executemany(f'INSERT INTO {table} ({names}) VALUES ({values});', rows)
+
+        snapshot.commit()
+
+        return snapshot
+
+    def __cmbdb_snapshot(self, dirty):
+        # Every row if there is no file to update
+        if dirty is None:
+            return self.__save_snapshot({table: None for table in self.__tables})
+
+        return self.__save_snapshot({table: keys if table in self.__per_ui_tables else None
+                                     for table, keys in dirty.items()})
+
+    def __save_prepare(self, filename):
+        filename = os.path.realpath(filename)
+
+        # Only rows not already serialized or written are copied, the file
+        # itself is written after any pending save
+        if is_cmbdb_filename(filename):
+            with self.__save_lock:
+                dirty = self.__cmbdb_dirty
+                self.__cmbdb_dirty = {}
+                generation = self.__cmbdb_generation
+
+                if self.__cmbdb_filename != filename or not os.path.isfile(filename):
+                    dirty = None
+
+                self.__cmbdb_filename = filename
+
+            snapshot = self.__cmbdb_snapshot(dirty)
+            return lambda: self.__save_cmbdb(snapshot, dirty, filename, generation)
+
+        with self.__save_lock:
+            dirty = self.__save_dirty
+            self.__save_dirty = {}
+            generation = self.__save_generation
+            cached = self.__save_cached
+            self.__save_cached = set(self.__tables)
+
+        tables = {}
+        for table in self.__tables:
+            if table not in cached or (table in dirty and table not in self.__save_per_ui_tables):
+                tables[table] = None
+            elif table in dirty:
+                tables[table] = dirty[table]
+
+        snapshot = self.__save_snapshot(tables)
+        return lambda: self.__save_write(snapshot, dirty, filename, generation)
+
+    def __save_write(self, snapshot, dirty, filename, generation):
+        # Never write directly to the project file, use a temporary file in
+        # the same directory and replace it once everything is on disk
+        tmp_filename = f'{filename}.{os.getpid()}.tmp'
+        c = snapshot.cursor()
+
+        try:
+            with self.__save_lock:
+                if generation != self.__save_generation:
+                    raise Exception('Previous save failed')
+
+                cache = {table: dict(sections) for table, sections in self.__save_cache.items()}
+
+            # Serialize everything first, the cache is valid even if writing fails
+            try:
+                tables = [(table, self.__get_table_sections(c, table, cache, dirty)) for table in self.__tables]
+            except Exception as e:
+                with self.__save_lock:
+                    # Pending saves only know their own changes, serialize everything again
+                    self.__save_cache = {}
+                    self.__save_cached = set()
+                    self.__save_generation += 1
+
+                raise e
+
+            with self.__save_lock:
+                self.__save_cache = cache
+
+            with open(tmp_filename, 'wb') as fd:
+                # Write the same XML lxml would generate, one table at a time
+                fd.write(b"<?xml version='1.0' encoding='UTF-8' standalone='no'?>\n")
+                fd.write(b'<!DOCTYPE cambalache-project SYSTEM "cambalache-project.dtd">\n')
+
+                root = f'cambalache-project version="{escape_xml_attr(VERSION)}" target_tk="{escape_xml_attr(self.target_tk)}"'
+
+                # Root start tag is only written before the first non empty table
+                prefix = f'<{root}>\n'
+                for table, sections in tables:
+                    if self.__write_table(fd, table, sections, prefix):
+                        prefix = ''
+
+                fd.write(f'<{root}/>\n'.encode() if prefix else b'</cambalache-project>\n')
+
+                fd.flush()
+                os.fsync(fd.fileno())
+
+            if os.path.exists(filename):
+                os.chmod(tmp_filename, stat.S_IMODE(os.stat(filename).st_mode))
+
+            os.replace(tmp_filename, filename)
+            fsync_dir(os.path.dirname(filename))
+        except Exception as e:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+            raise e
+        finally:
+            c.close()
+            snapshot.close()
+
+    def __cmbdb_write_metadata(self, conn):
+        conn.execute('CREATE TABLE cambalache_project (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;')
+        conn.executemany('INSERT INTO cambalache_project VALUES (?, ?);',
+                         [('version', VERSION), ('target_tk', self.target_tk)])
+
+    def __cmbdb_write_all(self, snapshot, filename):
+        tmp_filename = f'{filename}.{os.getpid()}.tmp'
+
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+        # Create project tables, without history or triggers
+        conn = sqlite3.connect(tmp_filename)
+        self.__cmbdb_write_metadata(conn)
+
+        for sql in self.__tables_sql:
+            conn.execute(sql)
+
+        conn.commit()
+        conn.close()
+
+        try:
+            snapshot.execute('ATTACH DATABASE ? AS project_file;', (tmp_filename, ))
+
+            with snapshot:
+                for table in self.__tables:
+                    snapshot.execute(f'INSERT INTO project_file.{table} SELECT * FROM main.{table};')
+
+            snapshot.execute('PRAGMA project_file.journal_mode=WAL;')
+            snapshot.execute('DETACH DATABASE project_file;')
+
+            if os.path.exists(filename):
+                os.chmod(tmp_filename, stat.S_IMODE(os.stat(filename).st_mode))
+
+            # Stale WAL files from the old project must not be applied to the new one
+            for suffix in ['-wal', '-shm']:
+                if os.path.exists(filename + suffix):
+                    os.remove(filename + suffix)
+
+            os.replace(tmp_filename, filename)
+            fsync_dir(os.path.dirname(filename))
+        except Exception as e:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+            raise e
+
+    def __cmbdb_write_changes(self, snapshot, dirty, filename):
+        snapshot.execute('ATTACH DATABASE ? AS project_file;', (filename, ))
+
+        try:
+            snapshot.execute('PRAGMA project_file.journal_mode=WAL;')
+
+            # Commit only tables and UIs changed since the last save
+            with snapshot:
+                for table, keys in dirty.items():
+                    if table not in self.__per_ui_tables:
+                        snapshot.execute(f'DELETE FROM project_file.{table};')
+                        snapshot.execute(f'INSERT INTO project_file.{table} SELECT * FROM main.{table};')
+                        continue
+
+                    for ui_id in keys:
+                        snapshot.execute(f'DELETE FROM project_file.{table} WHERE ui_id=?;', (ui_id, ))
+                        snapshot.execute(f'INSERT INTO project_file.{table} SELECT * FROM main.{table} WHERE ui_id=?;',
+                                         (ui_id, ))
+
+                snapshot.execute("UPDATE project_file.cambalache_project SET value=? WHERE key='version';",
+                                 (VERSION, ))
+
+            # Keep the project in a single file
+            snapshot.execute('PRAGMA project_file.wal_checkpoint(TRUNCATE);')
+        finally:
+            snapshot.execute('DETACH DATABASE project_file;')
+
+    def __save_cmbdb(self, snapshot, dirty, filename, generation):
+        try:
+            if dirty is None:
+                self.__cmbdb_write_all(snapshot, filename)
+            else:
+                with self.__save_lock:
+                    if generation != self.__cmbdb_generation:
+                        raise Exception('Previous save failed')
+
+                self.__cmbdb_write_changes(snapshot, dirty, filename)
+        except Exception as e:
+            with self.__save_lock:
+                # Pending saves only know their own changes, write everything again
+                self.__cmbdb_filename = None
+                self.__cmbdb_generation += 1
+
+            raise e
+        finally:
+            snapshot.close()
+
+    def __save_wait(self):
+        thread = self.__save_thread
+
+        if thread is not None:
+            thread.join()
+
+    def __save_worker(self):
+        # Write queued saves in order, each one starts from the cache left by the previous one
+        while True:
+            with self.__save_lock:
+                if len(self.__save_queue) == 0:
+                    self.__save_thread = None
+                    return
+
+                write, filename, callback = self.__save_queue.pop(0)
+
+            error = None
+
+            try:
+                write()
+            except Exception as e:
+                logger.warning(f'Error saving {filename}: {e}')
+                error = e
+
+            if callback:
+                GLib.idle_add(callback, error)
+
+    def save(self, filename):
+        write = self.__save_prepare(filename)
+
+        # Pending saves have to be on disk first
+        self.__save_wait()
+        write()
+
+    def save_async(self, filename, callback=None):
+        '''
+        Save project to filename from a worker thread.
+
+        If a save is still running this one is queued after it.
+        callback will be called from the main loop with the exception raised
+        or None if the project was saved.
+        '''
+        write = self.__save_prepare(filename)
+
+        with self.__save_lock:
+            self.__save_queue.append((write, filename, callback))
 
-        for child in root.getchildren():
-            self.__load_table_from_tuples(c, child.tag, child.text)
+            if self.__save_thread is not None:
+                return
 
-        self.foreign_keys = True
-        c.close()
+            self.__save_thread = threading.Thread(target=self.__save_worker, name='CmbDB save')
+            self.__save_thread.start()
 
-        self.commit()
+    def autosave(self, filename):
+        '''
+        Backup the project to filename from a worker thread.
 
-    def save(self, filename):
-        def get_row(row):
-            r = None
+        The backup is a native project file that can be loaded to recover
+        unsaved changes, only changes since the last autosave are written.
+        Returns False if the previous autosave is still running.
+        '''
+        if self.__autosave_thread is not None and self.__autosave_thread.is_alive():
+            return False
 
-            for c in row:
-                if r:
-                    r += ','
-                else:
-                    r = ''
-
-                if type(c)  == str:
-                    # FIXME: find a better way to escape string
-                    val = c.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
-                    r += f'"{val}"'
-                elif c:
-                    r += str(c)
-                else:
-                    r += 'None'
+        filename = os.path.realpath(filename)
 
-            return f'\t({r})'
+        with self.__save_lock:
+            dirty = self.__autosave_dirty
+            self.__autosave_dirty = {}
 
-        def _dump_table(c, table):
-            c.execute(f"SELECT * FROM {table};")
-            row = c.fetchone()
+        if self.__autosave_filename != filename or not os.path.isfile(filename):
+            dirty = None
 
-            if row is None:
-                return None
+        self.__autosave_filename = filename
+        snapshot = self.__cmbdb_snapshot(dirty)
+
+        def autosave_thread():
+            try:
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
 
-            retval = ''
-            while row is not None:
-                retval += get_row(row)
-                row = c.fetchone()
+                if dirty is None:
+                    self.__cmbdb_write_all(snapshot, filename)
+                else:
+                    self.__cmbdb_write_changes(snapshot, dirty, filename)
+            except Exception as e:
+                logger.warning(f'Error autosaving {filename}: {e}')
+                self.__autosave_filename = None
+            finally:
+                snapshot.close()
 
-                if row:
-                    retval += ',\n'
+        self.__autosave_thread = threading.Thread(target=autosave_thread, name='CmbDB autosave')
+        self.__autosave_thread.start()
 
-            return f'\n{retval}\n  '
+        return True
 
+    def snapshot(self, filename):
+        '''
+        Backup the whole database to filename as a native project file.
+        '''
         self.conn.commit()
-        c = self.conn.cursor()
 
-        project = E('cambalache-project',
-                    version=VERSION,
-                    target_tk=self.target_tk)
+        conn = sqlite3.connect(filename)
+        self.conn.backup(conn)
+        self.__cmbdb_write_metadata(conn)
+        conn.commit()
+        conn.close()
 
-        for table in self.__tables:
-            data = _dump_table(c, table)
+    def remove_autosave(self, filename):
+        # Make sure a running autosave does not write the file again
+        if self.__autosave_thread is not None:
+            self.__autosave_thread.join()
+            self.__autosave_thread = None
 
-            if data is None:
-                continue
+        # Next autosave has to write everything again
+        self.__autosave_filename = None
 
-            element = etree.Element(table)
-            element.text = data
-            project.append(element)
-
-        # Dump xml to file
-        with open(filename, 'wb') as fd:
-            tree = etree.ElementTree(project)
-            tree.write(fd,
-                       pretty_print=True,
-                       xml_declaration=True,
-                       encoding='UTF-8',
-                       standalone=False,
-                       doctype='<!DOCTYPE cambalache-project SYSTEM "cambalache-project.dtd">')
-            fd.close()
+        # Autosave files are updated in WAL mode
+        for path in [filename, filename + '-wal', filename + '-shm']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f'Error removing {path}: {e}')
 
-        c.close()
+    @staticmethod
+    def convert(filename, output):
+        '''
+        Convert a project between the XML (.cmb) and SQLite (.cmbdb) formats.
+
+        The output format is selected by the file extension.
+        '''
+        target_tk = CmbDB.get_target_from_file(filename)
+
+        if target_tk is None:
+            raise Exception(f'Can not get target from {filename}')
+
+        db = CmbDB(target_tk=target_tk)
+        db.load(filename)
+        db.save(output)
 
     def move_to_fs(self, filename):
         self.conn.commit()
@@ -583,6 +1458,8 @@ class CmbDB(GObject.GObject):
         with conn:
             self.conn.backup(conn)
 
+        self.__attach_type_system(conn)
+
         # Close current connection
         self.conn.close()
 
@@ -1127,6 +2004,10 @@ class CmbDB(GObject.GObject):
             'interface-authors': 'authors'
         }
 
+        # Materialize type info for every class used in this file at once
+        self.type_info.prefetch([node.get('class') for node in root.iter('object')] +
+                                [node.get('parent') for node in root.iter('template')])
+
         # Import objects
         for child in root.iterchildren():
             if child.tag == 'object':
@@ -1179,22 +2060,154 @@ class CmbDB(GObject.GObject):
         if comment:
             node.addprevious(etree.Comment(comment))
 
+    def __get_save_always_properties(self, type_id):
+        properties = self.__save_always_cache.get(type_id, None)
+
+        if properties is not None:
+            return properties
+
+        info = self.type_info.get(type_id, None)
+
+        # Create class hierarchy list
+        hierarchy = [type_id] + info.hierarchy if info else [type_id]
+
+        # SQL placeholder for every class in the list
+        placeholders = ','.join((['?'] * len(hierarchy)))
+
+        properties = self.conn.execute(f'''
+            SELECT default_value, property_id, is_object, is_inline_object
+              FROM property
+              WHERE save_always=1 AND owner_id IN ({placeholders});
+            ''', hierarchy).fetchall()
+
+        # Template types hierarchy can change
+        if info is None or info.library_id is not None:
+            self.__save_always_cache[type_id] = properties
+
+        return properties
+
+    def __export_fetch(self, ui_id, object_id=None):
+        '''
+        Get all the rows needed to export a UI, or just object_id subtree,
+        indexed by object id.
+        '''
+        if object_id is None:
+            subtree = ''
+            scope = ''
+            args = (ui_id, )
+        else:
+            subtree = '''
+            WITH RECURSIVE subtree(object_id) AS (
+              SELECT ?
+              UNION
+              SELECT o.object_id FROM object AS o JOIN subtree ON o.parent_id=subtree.object_id WHERE o.ui_id=?
+            )'''
+            scope = 'AND object_id IN subtree'
+            args = (object_id, ui_id, ui_id)
+
+        data = {
+            'objects': {},
+            'children': {},
+            'names': {},
+            'properties': {},
+            'layout': {},
+            'signals': {},
+            'data': {},
+            'data_args': {}
+        }
+
+        c = self.conn.cursor()
+
+        for row in c.execute(f'''{subtree}
+            SELECT object_id, type_id, name, parent_id, internal, type, comment, position, custom_fragment
+              FROM object
+              WHERE ui_id=? {scope}
+              ORDER BY parent_id, position, object_id;''', args):
+            data['objects'][row[0]] = row[1:]
+            data['children'].setdefault(row[3], []).append(row[0])
+
+        # Object references could point outside the subtree
+        for row in c.execute('SELECT object_id, name FROM object WHERE ui_id=?;', (ui_id, )):
+            data['names'][row[0]] = row[1]
+
+        for row in c.execute(f'''{subtree}
+            SELECT op.object_id, op.value, op.property_id, op.inline_object_id, op.comment, op.translatable, op.translation_context, op.translation_comments, p.is_object, p.is_inline_object
+              FROM object_property AS op, property AS p
+              WHERE op.ui_id=? {scope.replace('object_id', 'op.object_id')} AND
+                p.owner_id = op.owner_id AND
+                p.property_id = op.property_id;''', args):
+            data['properties'].setdefault(row[0], []).append(row[1:])
+
+        for row in c.execute(f'''{subtree}
+            SELECT object_id, child_id, value, property_id, comment
+              FROM object_layout_property
+              WHERE ui_id=? {scope};''', args):
+            data['layout'].setdefault((row[0], row[1]), []).append(row[2:])
+
+        for row in c.execute(f'''{subtree}
+            SELECT s.object_id, s.signal_id, s.handler, s.detail, o.name, s.swap, s.after, s.comment
+              FROM object_signal AS s LEFT JOIN object AS o ON o.ui_id=s.ui_id AND o.object_id=s.user_data
+              WHERE s.ui_id=? {scope.replace('object_id', 's.object_id')}
+              ORDER BY s.signal_pk;''', args):
+            data['signals'].setdefault(row[0], []).append(row[1:])
+
+        for row in c.execute(f'''{subtree}
+            SELECT object_id, owner_id, data_id, id, value, parent_id, comment
+              FROM object_data
+              WHERE ui_id=? {scope}
+              ORDER BY object_id, owner_id, data_id, id;''', args):
+            data['data'].setdefault(row[0:3], []).append(row[3:])
+
+        for row in c.execute(f'''{subtree}
+            SELECT object_id, owner_id, data_id, id, key, value
+              FROM object_data_arg
+              WHERE ui_id=? {scope} AND value IS NOT NULL
+              ORDER BY object_id, owner_id, data_id, id, key;''', args):
+            data['data_args'].setdefault(row[0:4], []).append(row[4:])
+
+        c.close()
+
+        return data
+
     def __export_object(self,
                         ui_id,
                         object_id,
                         merengue=False,
                         template_id=None,
-                        ignore_id=False):
+                        ignore_id=False,
+                        data=None):
+        self.__export_cache_flush()
+
+        # Template objects are exported differently
+        cache_key = (ui_id, object_id, merengue)
+        cacheable = not ignore_id and (merengue or template_id != object_id)
+
+        if cacheable:
+            node = self.__export_cache.get(cache_key, None)
+
+            if node is not None:
+                return copy.deepcopy(node)
+
+        if data is None:
+            data = self.__export_fetch(ui_id, object_id)
+
+        obj, cacheable_tree = self.__export_object_tree(ui_id, object_id, merengue, template_id, ignore_id, data)
+
+        # Only toplevels are cached, with their whole tree
+        if cacheable and cacheable_tree and data['objects'][object_id][2] is None:
+            self.__export_cache[cache_key] = copy.deepcopy(obj)
+
+        return obj
+
+    def __export_object_tree(self, ui_id, object_id, merengue, template_id, ignore_id, data):
 
         def node_set(node, attr, val):
             if val is not None:
                 node.set(attr, str(val))
 
-        c = self.conn.cursor()
-        cc = self.conn.cursor()
+        cacheable = True
 
-        c.execute('SELECT type_id, name, custom_fragment FROM object WHERE ui_id=? AND object_id=?;', (ui_id, object_id))
-        type_id, name, custom_fragment = c.fetchone()
+        type_id, name, parent_id, internal, ctype, comment, position, custom_fragment = data['objects'][object_id]
 
         info = self.type_info.get(type_id, None)
 
@@ -1206,10 +2219,16 @@ class CmbDB(GObject.GObject):
             # Keep real merengue id
             name = f'__cmb__{ui_id}.{object_id}'
 
+            # Depends on the template UI
+            cacheable = False
+
             # Get ui_id and object_id from template object
-            c.execute('SELECT u.ui_id, u.template_id, o.type_id FROM ui AS u, object AS o WHERE u.template_id IS NOT NULL AND u.ui_id=o.ui_id AND u.template_id=o.object_id AND o.name=?;',
-                      (type_id, ))
+            c = self.conn.execute('SELECT u.ui_id, u.template_id, o.type_id FROM ui AS u, object AS o WHERE u.template_id IS NOT NULL AND u.ui_id=o.ui_id AND u.template_id=o.object_id AND o.name=?;',
+                                  (type_id, ))
             ui_id, object_id, type_id = c.fetchone()
+            c.close()
+
+            data = self.__export_fetch(ui_id, object_id)
 
             # Use template info and object_id from now on
             info = self.type_info.get(type_id, None)
@@ -1241,30 +2260,16 @@ class CmbDB(GObject.GObject):
                     node_set(obj, 'class', type_id)
                     node_set(obj, 'id', name)
 
-        # Create class hierarchy list
-        hierarchy = [type_id] + info.hierarchy if info else [type_id]
+        # Properties + save_always default values
+        properties = list(data['properties'].get(object_id, []))
+        property_ids = set([row[1] for row in properties])
+        inline_ids = set([row[2] for row in properties if row[2] is not None])
 
-        # SQL placeholder for every class in the list
-        placeholders = ','.join((['?'] * len(hierarchy)))
+        for val, property_id, is_object, is_inline_object in self.__get_save_always_properties(type_id):
+            if property_id not in property_ids:
+                properties.append((val, property_id, None, None, None, None, None, is_object, is_inline_object))
 
-        # Properties + save_always default values
-        for row in c.execute(f'''
-                SELECT op.value, op.property_id, op.inline_object_id, op.comment, op.translatable, op.translation_context, op.translation_comments, p.is_object, p.is_inline_object
-                  FROM object_property AS op, property AS p
-                  WHERE op.ui_id=? AND op.object_id=? AND
-                    p.owner_id = op.owner_id AND
-                    p.property_id = op.property_id
-                UNION
-                SELECT default_value, property_id, null, null, null, null, null, is_object, is_inline_object
-                  FROM property
-                  WHERE save_always=1 AND owner_id IN ({placeholders}) AND
-                    property_id NOT IN
-                    (SELECT property_id
-                     FROM object_property
-                     WHERE ui_id=? AND object_id=?)
-                ORDER BY op.property_id
-                ''',
-                (ui_id, object_id) + tuple(hierarchy) + (ui_id, object_id)):
+        for row in sorted(dict.fromkeys(properties), key=lambda row: row[1]):
             val, property_id, inline_object_id, comment, translatable, translation_context, translation_comments, is_object, is_inline_object = row
 
             if is_object:
@@ -1278,19 +2283,15 @@ class CmbDB(GObject.GObject):
                     continue
 
                 if inline_object_id and is_inline_object:
-                    value = self.__export_object(ui_id,
-                                                 inline_object_id,
-                                                 merengue=merengue,
-                                                 ignore_id=ignore_id)
+                    value, inline_cacheable = self.__export_object_tree(ui_id, inline_object_id, merengue, None, ignore_id, data)
+                    cacheable = cacheable and inline_cacheable
                 else:
                     if merengue:
                         value = f'__cmb__{ui_id}.{val}'
                     else:
-                        cc.execute('SELECT name FROM object WHERE ui_id=? AND object_id=?;', (ui_id, val))
-                        row = cc.fetchone()
-                        if row is None:
+                        value = data['names'].get(int(val), None) if val is not None else None
+                        if value is None:
                             continue
-                        value = row[0]
             else:
                 value = val
 
@@ -1305,12 +2306,16 @@ class CmbDB(GObject.GObject):
             self.__node_add_comment(node, comment)
 
         # Signals
-        for row in c.execute('SELECT signal_id, handler, detail, (SELECT name FROM object WHERE ui_id=? AND object_id=user_data), swap, after, comment FROM object_signal WHERE ui_id=? AND object_id=?;',
-                             (ui_id, ui_id, object_id,)):
-            signal_id, handler, detail, data, swap, after, comment = row
+        for row in data['signals'].get(object_id, []):
+            signal_id, handler, detail, user_data, swap, after, comment = row
             name = f'{signal_id}::{detail}' if detail is not None else signal_id
             node = E.signal(name=name, handler=handler)
-            node_set(node, 'object', data)
+            node_set(node, 'object', user_data)
+
+            # Object name is exported in both modes
+            if user_data is not None:
+                cacheable = False
+
             if swap:
                 node_set(node, 'swapped', 'yes')
             if after:
@@ -1321,23 +2326,16 @@ class CmbDB(GObject.GObject):
         # Layout properties class
         layout_class = f'{type_id}LayoutChild'
         linfo = self.type_info.get(layout_class, None)
-
-        # Construct Layout Child class hierarchy list
-        hierarchy = [layout_class] + linfo.hierarchy if linfo else [layout_class]
-
-        # SQL placeholder for every class in the list
-        placeholders = ','.join((['?'] * len(hierarchy)))
+        layout_properties = self.__get_save_always_properties(layout_class) if linfo else []
 
         child_position = 0
 
         # Children
-        for row in c.execute('''
-            SELECT object_id, internal, type, comment, position
-                FROM object
-                WHERE ui_id=? AND parent_id=?
-                    AND object_id NOT IN (SELECT inline_object_id FROM object_property WHERE inline_object_id IS NOT NULL AND ui_id=? AND object_id=?)
-                ORDER BY position;''', (ui_id, object_id, ui_id, object_id)):
-            child_id, internal, ctype,  comment, position = row
+        for child_id in data['children'].get(object_id, []):
+            if child_id in inline_ids:
+                continue
+
+            ctype_id, cname, cparent_id, internal, ctype, comment, position, cfragment = data['objects'][child_id]
 
             if merengue:
                 position = position if position is not None else 0
@@ -1350,10 +2348,8 @@ class CmbDB(GObject.GObject):
 
                 child_position += 1
 
-            child_obj = self.__export_object(ui_id,
-                                             child_id,
-                                             merengue=merengue,
-                                             ignore_id=ignore_id)
+            child_obj, child_cacheable = self.__export_object_tree(ui_id, child_id, merengue, None, ignore_id, data)
+            cacheable = cacheable and child_cacheable
             child = E.child(child_obj)
             node_set(child, 'internal-child', internal)
             node_set(child, 'type', ctype)
@@ -1366,22 +2362,11 @@ class CmbDB(GObject.GObject):
 
             # Packing / Layout
             layout = E('packing' if self.target_tk == 'gtk+-3.0' else 'layout')
-            for prop in cc.execute(f'''
-                    SELECT value, property_id, comment
-                      FROM object_layout_property
-                      WHERE ui_id=? AND object_id=? AND child_id=?
-                    UNION
-                    SELECT default_value AS value, property_id, null
-                      FROM property
-                      WHERE save_always=1 AND owner_id IN ({placeholders}) AND property_id NOT IN
-                        (SELECT property_id FROM object_layout_property
-                         WHERE ui_id=? AND object_id=? AND child_id=?)
-                    ORDER BY property_id
-                    ''',
-                    (ui_id, object_id, child_id) +
-                    tuple(hierarchy) +
-                    (ui_id, object_id, child_id)):
-                value, property_id, comment = prop
+            rows = data['layout'].get((object_id, child_id), [])
+            property_ids = set([row[1] for row in rows])
+            rows = rows + [(val, property_id, None) for val, property_id, is_object, is_inline_object in layout_properties if property_id not in property_ids]
+
+            for value, property_id, comment in sorted(dict.fromkeys(rows), key=lambda row: row[1]):
                 node = E.property(value, name=property_id)
                 layout.append(node)
                 self.__node_add_comment(node, comment)
@@ -1394,29 +2379,22 @@ class CmbDB(GObject.GObject):
 
         # Custom buildable tags
         def export_object_data(owner_id, name, info, node, parent_id):
-            c = self.conn.cursor()
-            cc = self.conn.cursor()
+            for id, value, data_parent_id, comment in data['data'].get((object_id, owner_id, info.data_id), []):
+                if data_parent_id != parent_id:
+                    continue
 
-            for row in c.execute('SELECT id, value, comment FROM object_data WHERE ui_id=? AND object_id=? AND owner_id=? AND data_id=? AND parent_id=?;',
-                                 (ui_id, object_id, owner_id, info.data_id, parent_id)):
-                id, value, comment = row
                 ntag = etree.Element(name)
                 if value:
                     ntag.text = value
                 node.append(ntag)
                 self.__node_add_comment(ntag, comment)
 
-                for row in cc.execute('SELECT key, value FROM object_data_arg WHERE ui_id=? AND object_id=? AND owner_id=? AND data_id=? AND id=? AND value IS NOT NULL;',
-                                      (ui_id, object_id, owner_id, info.data_id, id)):
-                    key, value = row
+                for key, value in data['data_args'].get((object_id, owner_id, info.data_id, id), []):
                     ntag.set(key, value)
 
                 for tag in info.children:
                     export_object_data(owner_id, tag, info.children[tag], ntag, id)
 
-            c.close()
-            cc.close()
-
         def export_type_data(owner_id, info, node):
             if len(info.data.keys()) == 0:
                 return
@@ -1424,9 +2402,7 @@ class CmbDB(GObject.GObject):
             for tag in info.data:
                 taginfo = info.data[tag]
 
-                for row in c.execute('SELECT id, value, comment FROM object_data WHERE ui_id=? AND object_id=? AND owner_id=? AND data_id=?;',
-                                     (ui_id, object_id, owner_id, taginfo.data_id)):
-                    id, value, comment = row
+                for id, value, data_parent_id, comment in data['data'].get((object_id, owner_id, taginfo.data_id), []):
                     ntag = etree.Element(tag)
                     if value:
                         ntag.text = value
@@ -1445,10 +2421,7 @@ class CmbDB(GObject.GObject):
         # Dump custom fragments
         self.__export_custom_fragment(obj, custom_fragment)
 
-        c.close()
-        cc.close()
-
-        return obj
+        return obj, cacheable
 
     def __export_custom_fragment(self, node, custom_fragment):
         if custom_fragment is None:
@@ -1462,7 +2435,7 @@ class CmbDB(GObject.GObject):
             for child in root:
                 node.append(child)
 
-    def export_ui(self, ui_id, merengue=False):
+    def export_ui(self, ui_id, merengue=False, toplevels=None):
         c = self.conn.cursor()
 
         node = E.interface()
@@ -1505,23 +2478,36 @@ class CmbDB(GObject.GObject):
             req = E.requires(lib=library_id, version=version)
             node.append(req)
 
+        self.__export_cache_flush()
+        data = None
+
         # Iterate over toplovel objects
         for row in c.execute('SELECT object_id, comment FROM object WHERE parent_id IS NULL AND ui_id=?;',
                              (ui_id,)):
             object_id, comment = row
-            child = self.__export_object(ui_id, object_id, merengue=merengue, template_id=template_id)
+
+            # Only export some toplevels, used to update part of the workspace
+            if toplevels is not None and object_id not in toplevels:
+                continue
+
+            # Get all rows at once the first time something is not cached
+            if data is None and (ui_id, object_id, merengue) not in self.__export_cache:
+                data = self.__export_fetch(ui_id)
+
+            child = self.__export_object(ui_id, object_id, merengue=merengue, template_id=template_id, data=data)
             node.append(child)
             self.__node_add_comment(child, comment)
 
         # Dump custom fragments
-        self.__export_custom_fragment(node, custom_fragment)
+        if toplevels is None:
+            self.__export_custom_fragment(node, custom_fragment)
 
         c.close()
 
         return etree.ElementTree(node)
 
-    def tostring(self, ui_id, merengue=False):
-        ui = self.export_ui(ui_id, merengue=merengue)
+    def tostring(self, ui_id, merengue=False, toplevels=None):
+        ui = self.export_ui(ui_id, merengue=merengue, toplevels=toplevels)
 
         if ui is None:
             return None
@@ -1615,6 +2601,475 @@ class CmbDB(GObject.GObject):
     def clear_history(self):
         self.conn.executescript(self.__clear_history)
 
+    def __get_ui_tables(self):
+        return [table for table in self.__tables if 'SNAPSHOT' in self.history_commands[table]]
+
+    def history_add_import(self, history_id, message):
+        '''
+        Record a single IMPORT history command.
+
+        Instead of one command per row, a copy of every UI row is stored with
+        history_snapshot_ui() so the import can be redone without parsing the
+        file again.
+        '''
+        self.conn.execute("INSERT INTO history (history_id, command, table_name, message) VALUES (?, 'IMPORT', 'ui', ?);",
+                          (history_id, message))
+
+    def history_snapshot_ui(self, history_id, ui_id, old):
+        '''
+        Store a copy of every ui_id row in an IMPORT command, old rows are
+        restored on undo and new rows on redo
+        '''
+        with self.conn:
+            for table in self.__get_ui_tables():
+                self.conn.execute(self.history_commands[table]['SNAPSHOT'], (history_id, old, ui_id))
+
+    def history_cancel_import(self, history_id):
+        '''
+        Remove an IMPORT command that could not be completed and restore the
+        UI it overwrote, if any
+        '''
+        self.foreign_keys = False
+
+        try:
+            with self.conn:
+                for table in self.__get_ui_tables():
+                    self.conn.execute(self.history_commands[table]['RESTORE_UI'], (history_id, True))
+
+                for table in self.__tables:
+                    self.conn.execute(f'DELETE FROM history_{table} WHERE history_id=?;', (history_id, ))
+
+                self.conn.execute('DELETE FROM history WHERE history_id=?;', (history_id, ))
+        finally:
+            self.foreign_keys = True
+
+    def history_undo_redo_import(self, history_id, undo):
+        '''
+        Replace the imported UI rows with the overwritten ones on undo and the other way around on redo
+        '''
+        c = self.conn.cursor()
+
+        for table in self.__get_ui_tables():
+            c.execute(self.history_commands[table]['DELETE_UI'], (history_id, not undo))
+
+        for table in self.__get_ui_tables():
+            c.execute(self.history_commands[table]['RESTORE_UI'], (history_id, undo))
+
+        c.close()
+
+    def history_undo_redo(self, first, last, undo):
+        '''
+        Undo or redo history commands from first to last.
+
+        Consecutive commands of the same kind on the same table are replayed
+        with a single statement.
+        '''
+        c = self.conn.cursor()
+
+        groups = []
+        for history_id, command, table in c.execute("SELECT history_id, command, table_name FROM history WHERE history_id BETWEEN ? AND ? AND command NOT IN ('PUSH', 'POP') ORDER BY history_id;",
+                                                    (first, last)).fetchall():
+            if groups and groups[-1][0] == command and groups[-1][1] == table and command != 'IMPORT':
+                groups[-1][3] = history_id
+            else:
+                groups.append([command, table, history_id, history_id])
+
+        if undo:
+            groups.reverse()
+
+        for command, table, start, end in groups:
+            commands = self.history_commands[table]
+
+            if command == 'IMPORT':
+                self.history_undo_redo_import(start, undo)
+            elif command == 'UPDATE':
+                c.execute(commands['RANGE_UNDO_UPDATE' if undo else 'RANGE_REDO_UPDATE'], (start, end, start, end))
+            elif command == 'INSERT' or command == 'DELETE':
+                if (command == 'INSERT') == undo:
+                    c.execute(commands['RANGE_DELETE'], (start, end))
+                else:
+                    c.execute(commands['RANGE_INSERT_REVERSE' if undo else 'RANGE_INSERT'], (start, end))
+            else:
+                logger.warning(f'Error unknown history command {command}')
+
+        c.close()
+
+    def __get_history_size(self, c, first, last):
+        count = c.execute('SELECT count(1) FROM history WHERE history_id BETWEEN ? AND ?;', (first, last)).fetchone()[0]
+        size = 0
+
+        for table, row_size in self.__history_row_size.items():
+            c.execute(f'SELECT SUM({row_size}) FROM history_{table} WHERE history_id BETWEEN ? AND ?;', (first, last))
+            size += c.fetchone()[0] or 0
+
+        return count, size
+
+    def __get_history_sizes(self, c, first, last):
+        sizes = {}
+
+        for table, row_size in self.__history_row_size.items():
+            c.execute(f'''SELECT history_id, SUM({row_size}) FROM history_{table}
+                            WHERE history_id BETWEEN ? AND ? GROUP BY history_id;''', (first, last))
+
+            for history_id, size in c:
+                sizes[history_id] = sizes.get(history_id, 0) + (size or 0)
+
+        return sizes
+
+    def __get_history_totals(self, c):
+        last = c.execute('SELECT MAX(history_id) FROM history;').fetchone()[0] or 0
+        index = int(c.execute("SELECT value FROM global WHERE key='history_index';").fetchone()[0])
+
+        # Commands after the history index can be replaced and the last one can still change
+        stable = last - 1 if index < 0 else min(last - 1, index)
+
+        if last < self.__history_counted:
+            # Redo commands were replaced, count everything again
+            self.__history_count = self.__history_size = self.__history_counted = 0
+        elif stable + 1 < self.__history_counted:
+            count, size = self.__get_history_size(c, stable + 1, self.__history_counted - 1)
+            self.__history_count -= count
+            self.__history_size -= size
+            self.__history_counted = stable + 1
+
+        # Stable commands are only counted once
+        if stable >= self.__history_counted:
+            count, size = self.__get_history_size(c, self.__history_counted, stable)
+            self.__history_count += count
+            self.__history_size += size
+            self.__history_counted = stable + 1
+
+        count, size = self.__get_history_size(c, self.__history_counted, last)
+
+        return self.__history_count + count, self.__history_size + size
+
+    def compact_history(self, max_entries, max_size, history_index):
+        '''
+        Remove the oldest history commands until there are at most
+        max_entries commands and their data takes at most max_size bytes.
+
+        Only whole PUSH/POP ranges up to history_index are removed.
+        A limit of 0 means no limit. Returns the last removed history_id
+        or None.
+        '''
+        c = self.conn.cursor()
+
+        count, size = self.__get_history_totals(c)
+
+        def over_limit():
+            return (max_entries and count > max_entries) or (max_size and size > max_size)
+
+        if not over_limit():
+            c.close()
+            return None
+
+        first_id = last_id = None
+        depth = 0
+
+        # Size of each command, measured a chunk at a time
+        sizes = {}
+        measured = 0
+
+        history = self.conn.execute('SELECT history_id, command FROM history WHERE history_id <= ? ORDER BY history_id;',
+                                    (history_index, ))
+
+        for history_id, command in history:
+            if first_id is None:
+                first_id = history_id
+
+            count -= 1
+            if max_size:
+                if history_id > measured:
+                    measured = history_id + HISTORY_SIZE_CHUNK - 1
+                    sizes = self.__get_history_sizes(c, history_id, measured)
+
+                size -= sizes.get(history_id, 0)
+
+            if command == 'PUSH':
+                depth += 1
+            elif command == 'POP':
+                depth -= 1
+
+            # Never split a range
+            if depth > 0:
+                continue
+
+            last_id = history_id
+
+            if not over_limit():
+                break
+
+        history.close()
+
+        if last_id is None:
+            c.close()
+            return None
+
+        if last_id < self.__history_counted:
+            count, size = self.__get_history_size(c, first_id, last_id)
+            self.__history_count -= count
+            self.__history_size -= size
+        else:
+            self.__history_count = self.__history_size = self.__history_counted = 0
+
+        c.close()
+
+        with self.conn:
+            for table in self.__tables:
+                self.conn.execute(f'DELETE FROM history_{table} WHERE history_id <= ?;', (last_id, ))
+
+            self.conn.execute('DELETE FROM history WHERE history_id <= ?;', (last_id, ))
+
+        return last_id
+
+
+    def __get_history_tables(self):
+        return ['history'] + [f'history_{table}' for table in self.__tables]
+
+    def __history_file_changed(self, first, last):
+        # Compare history rows both ways to know if any of them changed
+        for table in self.__get_history_tables():
+            for a, b in [('main', 'history_file'), ('history_file', 'main')]:
+                c = self.conn.execute(f'''SELECT * FROM {a}.{table} WHERE history_id BETWEEN ? AND ?
+                                         EXCEPT SELECT * FROM {b}.{table} WHERE history_id BETWEEN ? AND ?
+                                         LIMIT 1;''', (first, last, first, last))
+                if c.fetchone() is not None:
+                    return True
+
+        return False
+
+    def load_history(self, filename, project_stamp):
+        '''
+        Load history commands written with save_history() from filename.
+
+        History is only loaded if the project file was saved in the state
+        described by project_stamp. Returns the history index of that state
+        or None.
+        '''
+        if not os.path.isfile(filename):
+            return None
+
+        self.conn.commit()
+
+        uri = pathlib.Path(os.path.abspath(filename)).as_uri()
+        self.conn.execute('ATTACH DATABASE ? AS history_file;', (f'{uri}?mode=ro', ))
+
+        try:
+            metadata = dict(self.conn.execute('SELECT key, value FROM history_file.history_metadata;'))
+            history_index = metadata.get('saved_index', None)
+
+            if metadata.get('version', None) != VERSION or metadata.get('project', None) != project_stamp or history_index is None:
+                return None
+
+            history_index = int(history_index)
+            min_id, max_id = self.conn.execute('SELECT MIN(history_id), MAX(history_id) FROM history_file.history;').fetchone()
+
+            # Saved state has to be reachable with the commands left
+            if min_id is None or history_index < min_id - 1 or history_index > max_id:
+                return None
+
+            with self.conn:
+                for table in self.__get_history_tables():
+                    self.conn.execute(f'INSERT INTO main.{table} SELECT * FROM history_file.{table};')
+
+                # POP insert trigger resets range and message, restore them
+                self.conn.execute('''UPDATE main.history SET (range_id, message) =
+                                       (SELECT range_id, message FROM history_file.history AS h WHERE h.history_id=history.history_id)
+                                     WHERE command='POP';''')
+        except sqlite3.Error as e:
+            logger.warning(f'Error loading history from {filename}: {e}')
+            return None
+        finally:
+            self.conn.execute('DETACH DATABASE history_file;')
+
+        self.__history_filename = os.path.realpath(filename)
+        self.__history_synced = max_id
+
+        return history_index
+
+    def save_history(self, filename, start, saved_index=None, project_stamp=None):
+        '''
+        Write history commands changed since the last call to filename.
+
+        Commands from start on could have changed, usually the lowest history
+        index since the last call. saved_index and project_stamp mark the
+        project file as saved in that history state.
+        '''
+        filename = os.path.realpath(filename)
+        new_file = self.__history_filename != filename or not os.path.isfile(filename)
+
+        self.conn.commit()
+
+        # Do not mix commands from another session
+        if new_file and os.path.exists(filename):
+            os.remove(filename)
+
+        self.conn.execute('ATTACH DATABASE ? AS history_file;', (filename, ))
+
+        try:
+            self.conn.execute('PRAGMA history_file.journal_mode=WAL;')
+            tables = self.__get_history_tables()
+
+            with self.conn:
+                if new_file:
+                    self.conn.execute('CREATE TABLE history_file.history_metadata (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;')
+
+                    for table in tables:
+                        self.conn.execute(f'CREATE TABLE history_file.{table} AS SELECT * FROM main.{table} WHERE 0;')
+                        self.conn.execute(f'CREATE INDEX history_file.{table}_history_id_idx ON {table} (history_id);')
+
+                    start = 0
+                else:
+                    start = min(start, self.__history_synced)
+                    old_saved_index = self.conn.execute("SELECT value FROM history_file.history_metadata WHERE key='saved_index';").fetchone()
+
+                    # Saved state is lost if the commands up to it changed
+                    if old_saved_index is not None and old_saved_index[0] is not None and start <= int(old_saved_index[0]) and \
+                       self.__history_file_changed(start, int(old_saved_index[0])):
+                        self.conn.execute("DELETE FROM history_file.history_metadata WHERE key='saved_index';")
+
+                    # Oldest commands could have been removed
+                    min_id = self.conn.execute('SELECT MIN(history_id) FROM main.history;').fetchone()[0]
+                    min_id = start if min_id is None else min_id
+
+                    for table in tables:
+                        self.conn.execute(f'DELETE FROM history_file.{table} WHERE history_id >= ? OR history_id < ?;',
+                                          (start, min_id))
+
+                for table in tables:
+                    self.conn.execute(f'INSERT INTO history_file.{table} SELECT * FROM main.{table} WHERE history_id >= ?;',
+                                      (start, ))
+
+                metadata = [('version', VERSION)]
+                if saved_index is not None:
+                    metadata += [('saved_index', saved_index), ('project', project_stamp)]
+
+                self.conn.executemany('INSERT OR REPLACE INTO history_file.history_metadata VALUES (?, ?);', metadata)
+
+            # Keep history in a single file
+            self.conn.execute('PRAGMA history_file.wal_checkpoint(TRUNCATE);')
+        finally:
+            self.conn.execute('DETACH DATABASE history_file;')
+
+        self.__history_filename = filename
+        self.__history_synced = self.conn.execute('SELECT coalesce(MAX(history_id), 0) FROM history;').fetchone()[0]
+
+
+# Table data format
+
+# Tokens used to store table rows as a list of Python tuples
+TUPLE_TOKEN_RE = re.compile(r'''\s*(?:
+    (?P<open>\()|
+    (?P<close>\))|
+    (?P<comma>,)|
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|
+    (?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)|
+    (?P<name>None|True|False)
+)''', re.VERBOSE | re.DOTALL)
+
+TUPLE_NAMES = {
+    'None': None,
+    'True': True,
+    'False': False
+}
+
+def iter_tuples(text):
+    '''
+    Parse rows from a comma separated list of tuples literals.
+
+    Generates the same values ast.literal_eval() would without building the
+    whole list in memory.
+    '''
+    row = None
+    pos = 0
+    end = len(text)
+
+    while pos < end:
+        match = TUPLE_TOKEN_RE.match(text, pos)
+
+        if match is None:
+            if text[pos:].isspace():
+                break
+
+            raise Exception(f'Can not parse table data near {text[pos:pos+32]!r}')
+
+        pos = match.end()
+        kind = match.lastgroup
+        token = match.group(kind)
+
+        if kind == 'comma':
+            continue
+
+        if row is None:
+            if kind != 'open':
+                raise Exception(f'Expected a tuple, got {token!r}')
+
+            row = []
+        elif kind == 'close':
+            yield tuple(row)
+            row = None
+        elif kind == 'string':
+            row.append(token[1:-1] if '\\' not in token else ast.literal_eval(token))
+        elif kind == 'number':
+            row.append(float(token) if any(c in token for c in '.eE') else int(token))
+        elif kind == 'name':
+            row.append(TUPLE_NAMES[token])
+        else:
+            raise Exception(f'Unexpected {token!r} in table data')
+
+    if row is not None:
+        raise Exception('Unterminated tuple in table data')
+
+def format_tuple(row):
+    values = []
+
+    for val in row:
+        if type(val) == str:
+            val = val.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            values.append(f'"{val}"')
+        elif val:
+            values.append(str(val))
+        else:
+            values.append('None')
+
+    return f'\t({",".join(values)})'
+
+# Characters not allowed in XML 1.0 documents
+XML_INVALID_CHARS_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+def escape_xml_text(text):
+    if XML_INVALID_CHARS_RE.search(text):
+        raise ValueError('All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters')
+
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;')
+
+def escape_xml_attr(text):
+    return escape_xml_text(text).replace('"', '&quot;')
+
+def is_cmbdb_filename(filename):
+    return filename.endswith(CMBDB_EXTENSION)
+
+def is_cmbdb_file(filename):
+    try:
+        with open(filename, 'rb') as fd:
+            return fd.read(16) == b'SQLite format 3\x00'
+    except OSError:
+        return False
+
+def fsync_dir(dirname):
+    # Make sure a rename is on disk, not supported on every platform
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
 
 # Function used in SQLite
 
@@ -32,7 +32,7 @@ def ensure_columns_for_0_7_5(table, data):
     return data
 
 
-def migrate_table_data_to_0_7_5(c, table, data):
+def migrate_table_data_to_0_7_5(c, table):
     if table == 'object':
         c.execute('''
             UPDATE object SET position=new.position - 1
@@ -65,7 +65,7 @@ def ensure_columns_for_0_9_0(table, data):
 
     return data
 
-def migrate_table_data_to_0_9_0(c, table, data):
+def migrate_table_data_to_0_9_0(c, table):
     if table == 'object_property':
         # Remove all object properties with a 0 as value
         c.execute('''
@@ -21,10 +21,15 @@
 #   Juan Pablo Ugarte <juanpablougarte@gmail.com>
 #
 
+import io
 import os
 import sys
 import gi
 import time
+import hashlib
+import tempfile
+import multiprocessing
+import concurrent.futures
 
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gio, GLib, GObject, Gtk
@@ -38,7 +43,7 @@ from .cmb_object import CmbObject
 from .cmb_property import CmbProperty
 from .cmb_layout_property import CmbLayoutProperty
 from .cmb_library_info import CmbLibraryInfo
-from .cmb_type_info import CmbTypeInfo
+from .cmb_type_info import CmbTypeInfo, CmbTypeInfoMap
 from .cmb_objects_base import CmbSignal
 from .cmb_list_store import CmbListStore
 from .config import *
@@ -46,6 +51,16 @@ from cambalache import getLogger
 
 logger = getLogger(__name__)
 
+# Backups of unsaved changes, one per project file
+AUTOSAVE_DIR = os.path.join(GLib.get_user_data_dir(), 'cambalache', 'autosave')
+
+# Default history limits, the oldest commands are removed when reached
+HISTORY_MAX_ENTRIES = 8192
+HISTORY_MAX_SIZE = 64 * 1024 * 1024
+
+# Seconds without changes before pending history is written to the history file
+HISTORY_SAVE_IDLE = 30
+
 
 class CmbProject(Gtk.TreeStore):
     __gtype_name__ = 'CmbProject'
@@ -110,9 +125,13 @@ class CmbProject(Gtk.TreeStore):
     undo_msg = GObject.Property(type=str)
     redo_msg = GObject.Property(type=str)
 
-    def __init__(self, target_tk=None, filename=None, **kwargs):
+    history_max_entries = GObject.Property(type=int, default=HISTORY_MAX_ENTRIES, minimum=0, flags=GObject.ParamFlags.READWRITE)
+    history_max_size = GObject.Property(type=int, default=HISTORY_MAX_SIZE, minimum=0, flags=GObject.ParamFlags.READWRITE)
+    history_persistent = GObject.Property(type=bool, default=False, flags=GObject.ParamFlags.READWRITE | GObject.ParamFlags.CONSTRUCT)
+
+    def __init__(self, target_tk=None, filename=None, recover=False, **kwargs):
         # Type Information
-        self.type_info = {}
+        self.type_info = CmbTypeInfoMap()
 
         # Library Info
         self.library_info = {}
@@ -127,14 +146,25 @@ class CmbProject(Gtk.TreeStore):
         self.__template_info = {}
         self.__reordering_children = False
 
+        # History file state
+        self.__history_save_id = None
+        self.__history_changed_time = 0
+        self.__history_save_start = 0
+        self.__history_saved = None
+        self.__history_compact_id = None
+
         super().__init__(**kwargs)
 
         self.target_tk = target_tk
         self.filename = filename
 
+        # Unsaved changes are loaded from the autosave file instead of the project
+        recovery_filename = CmbProject.get_recovery_filename(self.filename) if recover and self.filename else None
+        source = recovery_filename or self.filename
+
         # Target from file take precedence over target_tk property
-        if self.filename and os.path.isfile(self.filename):
-            target_tk = CmbDB.get_target_from_file(self.filename)
+        if source and os.path.isfile(source):
+            target_tk = CmbDB.get_target_from_file(source)
 
             if target_tk is not None:
                 self.target_tk = target_tk
@@ -151,7 +181,19 @@ class CmbProject(Gtk.TreeStore):
         self.db.type_info = self.type_info
         self.__init_data()
 
-        self.__load()
+        self.__load(source)
+
+        # Project file is in the current history state
+        if self.filename and not recovery_filename and os.path.isfile(self.filename):
+            if self.history_persistent:
+                self.__history_load()
+
+            self.__history_saved = (self.history_index, self.__get_project_stamp())
+
+        self.__history_save_start = self.history_index
+
+        # History index of the last autosave, nothing to backup until there is a change
+        self.__autosave_index = None if recovery_filename else self.history_index
 
     @GObject.Property(type=bool, default=False)
     def history_enabled(self):
@@ -172,6 +214,18 @@ class CmbProject(Gtk.TreeStore):
 
         return int(row[0])
 
+    @GObject.Property(type=int)
+    def history_index_min(self):
+        c = self.db.execute("SELECT MIN(history_id) FROM history;")
+        row = c.fetchone()
+        c.close()
+
+        # Oldest commands could have been removed
+        if row is None or row[0] is None:
+            return self.history_index_max
+
+        return int(row[0]) - 1
+
     @GObject.Property(type=int)
     def history_index(self):
         history_index = int(self.db.get_data('history_index'))
@@ -224,12 +278,7 @@ class CmbProject(Gtk.TreeStore):
         }
 
     def __init_type_info(self, c):
-        for row in c.execute('''SELECT * FROM type
-                                  WHERE
-                                    parent_id IS NOT NULL
-                                  ORDER BY type_id;'''):
-            type_id = row[0]
-            self.type_info[type_id] = CmbTypeInfo.from_row(self, *row)
+        self.type_info.update(CmbTypeInfo.from_db(self))
 
         # Set parent back reference
         for type_id in self.type_info:
@@ -255,12 +304,12 @@ class CmbProject(Gtk.TreeStore):
 
         c.close()
 
-    def __load(self):
-        if self.filename is None or not os.path.isfile(self.filename):
+    def __load(self, filename):
+        if filename is None or not os.path.isfile(filename):
             return
 
         self.history_enabled = False
-        self.db.load(self.filename)
+        self.db.load(filename)
         self.history_enabled = True
 
         self.__populate_objects()
@@ -301,6 +350,142 @@ class CmbProject(Gtk.TreeStore):
 
     def save(self):
         self.db.save(self.filename)
+        self.remove_autosave()
+        self.__history_set_saved(self.history_index)
+
+    def save_async(self, callback=None):
+        history_index = self.history_index
+
+        def on_saved(error):
+            if error is None:
+                self.remove_autosave(history_index)
+                self.__history_set_saved(history_index)
+
+            if callback:
+                callback(error)
+
+        self.db.save_async(self.filename, on_saved)
+
+    @staticmethod
+    def get_autosave_filename(filename):
+        digest = hashlib.sha256(os.path.realpath(filename).encode()).hexdigest()
+        return os.path.join(AUTOSAVE_DIR, f'{digest}.cmbdb')
+
+    @staticmethod
+    def get_history_filename(filename):
+        dirname, basename = os.path.split(filename)
+        return os.path.join(dirname, f'.{basename}.history')
+
+    def __get_project_stamp(self):
+        st = os.stat(self.filename)
+        return f'{st.st_mtime_ns}:{st.st_size}'
+
+    def __history_load(self):
+        try:
+            history_index = self.db.load_history(CmbProject.get_history_filename(self.filename),
+                                                 self.__get_project_stamp())
+        except Exception as e:
+            logger.warning(f'Error loading history: {e}')
+            return
+
+        if history_index is not None:
+            self.history_index = history_index
+
+    def __history_set_saved(self, history_index):
+        if self.filename is None or not os.path.isfile(self.filename):
+            return
+
+        self.__history_saved = (history_index, self.__get_project_stamp())
+        self.save_history()
+
+    def __history_queue_save(self):
+        if not self.history_persistent or not self.filename:
+            return
+
+        # History file is written on save, on close or once the user stops editing
+        self.__history_changed_time = time.monotonic()
+
+        if self.__history_save_id is None:
+            self.__history_save_id = GLib.timeout_add_seconds(HISTORY_SAVE_IDLE, self.__on_history_save_timeout)
+
+    def __on_history_save_timeout(self):
+        idle = time.monotonic() - self.__history_changed_time
+
+        if idle < HISTORY_SAVE_IDLE:
+            self.__history_save_id = GLib.timeout_add_seconds(int(HISTORY_SAVE_IDLE - idle) + 1,
+                                                              self.__on_history_save_timeout)
+            return GLib.SOURCE_REMOVE
+
+        self.__history_save_id = None
+        self.save_history()
+        return GLib.SOURCE_REMOVE
+
+    def save_history(self):
+        '''
+        Write pending history changes to the history file next to the
+        project, only if history_persistent is set.
+        '''
+        if self.__history_save_id is not None:
+            GLib.source_remove(self.__history_save_id)
+            self.__history_save_id = None
+
+        if not self.history_persistent or not self.filename:
+            return
+
+        saved_index, project_stamp = self.__history_saved if self.__history_saved else (None, None)
+        history_index = self.history_index
+
+        try:
+            self.db.save_history(CmbProject.get_history_filename(self.filename),
+                                 self.__history_save_start,
+                                 saved_index,
+                                 project_stamp)
+        except Exception as e:
+            logger.warning(f'Error saving history: {e}')
+            return
+
+        self.__history_save_start = history_index
+        self.__history_saved = None
+
+    @staticmethod
+    def get_recovery_filename(filename):
+        '''
+        Return the autosave file for filename if it has changes newer than
+        the project file, None otherwise.
+        '''
+        autosave = CmbProject.get_autosave_filename(filename)
+
+        if not os.path.isfile(autosave):
+            return None
+
+        if os.path.isfile(filename) and os.path.getmtime(filename) >= os.path.getmtime(autosave):
+            return None
+
+        return autosave
+
+    def autosave(self):
+        '''
+        Backup unsaved changes in the background, only if there was a change
+        since the last autosave.
+        '''
+        if self.filename is None:
+            return
+
+        history_index = self.history_index
+
+        if history_index == self.__autosave_index:
+            return
+
+        if self.db.autosave(CmbProject.get_autosave_filename(self.filename)):
+            self.__autosave_index = history_index
+
+    def remove_autosave(self, history_index=None):
+        if self.filename is None:
+            return
+
+        # Changes are on disk, do not autosave until there is a new one
+        self.__autosave_index = self.history_index if history_index is None else history_index
+        self.db.remove_autosave(CmbProject.get_autosave_filename(self.filename))
 
     def __get_import_errors(self):
         errors = self.db.errors
@@ -358,22 +543,41 @@ class CmbProject(Gtk.TreeStore):
     def import_file(self, filename, overwrite=False):
         start = time.monotonic()
 
-        self.history_push(_('Import file "{filename}"').format(filename=filename))
+        message = _('Import file "{filename}"').format(filename=filename)
+        history_id = self.__history_add_import(message)
 
-        # Remove old UI
-        if overwrite:
-            c.execute("DELETE FROM ui WHERE filename=?;", (filename, ))
+        # Import file without recording every row in history
+        history_enabled = self.history_enabled
+        self.history_enabled = False
 
-        # Import file
         dirname = os.path.dirname(self.filename if self.filename else filename)
-        ui_id = self.db.import_file(filename, dirname)
+        old_ui_id = None
+
+        # New UI ids are always bigger, ui_id is AUTOINCREMENT
+        last_ui_id = self.db.execute("SELECT coalesce(MAX(ui_id), 0) FROM ui;").fetchone()[0]
+
+        try:
+            # Remove old UI, undo restores it from the import command
+            if overwrite:
+                old_ui_id = self.__import_remove_ui(history_id, os.path.relpath(filename, dirname))
+
+            ui_id = self.db.import_file(filename, dirname)
+
+            if history_id is not None:
+                self.db.history_snapshot_ui(history_id, ui_id, False)
+        except Exception as e:
+            self.__import_cancel(history_id, last_ui_id, old_ui_id)
+            raise e
+        finally:
+            self.history_enabled = history_enabled
 
         import_end = time.monotonic()
 
         # Populate UI
         self.__populate_objects(ui_id)
 
-        self.history_pop()
+        if history_id is not None:
+            self.emit('changed')
 
         logger.info('Import took: {import_end - start}')
         logger.info('UI update: {time.monotonic() - import_end}')
@@ -386,12 +590,56 @@ class CmbProject(Gtk.TreeStore):
 
         return (ui, msgs, detail_msg)
 
-    def __export(self, ui_id, filename, dirname=None):
+    def __import_remove_ui(self, history_id, filename):
+        c = self.db.execute("SELECT ui_id FROM ui WHERE filename=?;", (filename, ))
+        row = c.fetchone()
+        c.close()
+
+        if row is None:
+            return
+
+        ui_id = row[0]
+
+        if history_id is not None:
+            self.db.history_snapshot_ui(history_id, ui_id, True)
+
+        self.db.execute("DELETE FROM ui WHERE ui_id=?;", (ui_id, ))
+
+        ui = self.get_object_by_id(ui_id)
+        if ui is not None:
+            self.__remove_ui(ui)
+
+        return ui_id
+
+    def __import_cancel(self, history_id, last_ui_id, old_ui_id):
+        # Remove partially imported rows, they are not in history
+        self.db.execute("DELETE FROM ui WHERE ui_id > ?;", (last_ui_id, ))
+        self.db.commit()
+
+        if history_id is None:
+            return
+
+        # Drop the import command and put the overwritten UI back
+        self.db.history_cancel_import(history_id)
+
+        if old_ui_id is not None:
+            self.__populate_objects(old_ui_id)
+
+            ui = self.get_object_by_id(old_ui_id)
+            if ui is not None:
+                self.emit('ui-added', ui)
+
+    def __get_export_filename(self, filename, dirname=None):
         if not os.path.isabs(filename):
             if dirname is None:
                 dirname = os.path.dirname(self.filename)
             filename = os.path.join(dirname, filename)
 
+        return filename
+
+    def __export(self, ui_id, filename, dirname=None):
+        filename = self.__get_export_filename(filename, dirname)
+
         # Get XML tree
         ui = self.db.export_ui(ui_id)
 
@@ -406,21 +654,35 @@ class CmbProject(Gtk.TreeStore):
     def export_ui(self, ui):
         self.__export(ui.ui_id, ui.filename)
 
-    def export(self):
-        c = self.db.cursor()
-
+    def export(self, jobs=1):
+        '''
+        Export every UI with a filename, using up to jobs processes.
+        Returns the number of exported files.
+        '''
         dirname = os.path.dirname(self.filename)
+        uis = self.db.execute('SELECT ui_id, filename FROM ui WHERE filename IS NOT NULL;').fetchall()
 
-        n_files = 0
+        if jobs < 2 or len(uis) < 2:
+            for ui_id, filename in uis:
+                self.__export(ui_id, filename, dirname=dirname)
 
-        for row in c.execute('SELECT ui_id, filename FROM ui WHERE filename IS NOT NULL;'):
-            ui_id, filename = row
-            self.__export(ui_id, filename, dirname=dirname)
-            n_files += 1
+            return len(uis)
 
-        c.close()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Every worker loads its own copy of the project from this snapshot
+            snapshot = os.path.join(tmpdir, 'project.cmbdb')
+            self.db.snapshot(snapshot)
 
-        return n_files
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(uis)),
+                                                        mp_context=multiprocessing.get_context('spawn'),
+                                                        initializer=export_worker_init,
+                                                        initargs=(snapshot, )) as executor:
+                # Files are written in the same order as the serial export
+                for (ui_id, filename), data in zip(uis, executor.map(export_worker, [ui_id for ui_id, filename in uis])):
+                    with open(self.__get_export_filename(filename, dirname), 'wb') as fd:
+                        fd.write(data)
+
+        return len(uis)
 
     def __selection_remove(self, obj):
         try:
@@ -705,154 +967,209 @@ class CmbProject(Gtk.TreeStore):
         c.close()
         return retval
 
-    def __undo_redo_do(self, undo):
+    def __undo_redo_update(self, first, last):
         c = self.db.cursor()
 
-        # Get last command
-        command, range_id, table, column = self.__get_history_command(self.history_index)
+        # Update tree model and emit signals
+        # We can not easily implement this using triggers because they are called
+        # even if the transaction is rollback because of a FK constraint
+
+        # Collect everything the range touched so each item is updated once
+        rows = {'ui': {}, 'css': {}, 'object': {}}
+        changed = {}
+        properties = {}
+        signals = {}
+        css_ui = {}
 
-        if table is not None:
+        for table, commands in self.db.history_commands.items():
+            for command, column_name, *data in c.execute(commands['RANGE_DATA'], (first, last)):
+                # UPDATE commands store a comma separated list of changed columns
+                columns = column_name.split(',') if command == 'UPDATE' else ['value']
+
+                if table == 'object_property':
+                    for column in columns:
+                        properties[(data[0], data[1], False, column, data[2], data[3])] = None
+                elif table == 'object_layout_property':
+                    for column in columns:
+                        properties[(data[0], data[2], True, column, data[3], data[4])] = None
+                elif table in rows:
+                    pk = tuple(data[:2]) if table == 'object' else (data[0], )
+                    key = f'{data[0]}.{data[1]}' if table == 'object' else data[0]
+
+                    if command == 'UPDATE':
+                        for column in columns:
+                            changed[(table, key, column)] = None
+                    else:
+                        rows[table][key] = pk
+                elif table == 'object_signal':
+                    if command != 'UPDATE':
+                        signals[data[0]] = (data[1], data[2])
+                elif table == 'css_ui':
+                    css_ui[data[0]] = None
+
+        # Objects are removed and added again if they are still in the DB
+        removed = []
+        added = {}
+        for table, keys in rows.items():
             commands = self.db.history_commands[table]
+            added[table] = []
 
-        # Undo or Redo command
-        # TODO: catch sqlite errors and do something with it.
-        # probably nuke history data
-        if command == 'INSERT':
-            c.execute(commands['DELETE' if undo else 'INSERT'], (self.history_index, ))
-        elif command == 'DELETE':
-            c.execute(commands['INSERT' if undo else 'DELETE'], (self.history_index, ))
-        elif command == 'UPDATE':
-            old_data = 1 if undo else 0
-            c.execute(commands['UPDATE'], (self.history_index, old_data, self.history_index, old_data))
-        elif command == 'PUSH' or command == 'POP':
-            pass
-        else:
-            logger.warning(f'Error unknown history command {command}')
+            for key, pk in keys.items():
+                obj = self.get_css_by_id(key) if table == 'css' else self.get_object_by_key(key)
+                if obj is not None:
+                    removed.append(obj)
 
-        c.close()
+                c.execute(commands['GET'], pk)
+                row = c.fetchone()
+                if row is not None:
+                    added[table].append(row)
 
-        # Update project state
-        self.__undo_redo_update(command, range_id, table, column)
+        self.__undo_redo_remove(removed)
+        new_objects = self.__undo_redo_add(added)
 
-    def __undo_redo_update(self, command, range_id, table, column):
-        c = self.db.cursor()
+        # Notify changes on existing objects, position last to move siblings in order
+        notify = []
+        for table, key, column in changed:
+            obj = self.get_css_by_id(key) if table == 'css' else self.get_object_by_key(key)
+            if obj is not None and obj not in new_objects:
+                notify.append((obj, column))
 
-        if table is None:
-            return
+        for obj, column in sorted(notify, key=lambda n: (n[1] == 'position', n[0].position if n[1] == 'position' else 0)):
+            obj.notify(column)
 
-        # Update tree model and emit signals
-        # We can not easily implement this using triggers because they are called
-        # even if the transaction is rollback because of a FK constraint
+        for ui_id, object_id, layout, column, owner_id, property_id in properties:
+            obj = self.get_object_by_id(ui_id, object_id)
+            if obj is not None and obj not in new_objects:
+                self.__undo_redo_property_notify(obj, layout, column, owner_id, property_id)
 
-        commands = self.db.history_commands[table]
-        c.execute(commands['PK'], (self.history_index, ))
-        pk = c.fetchone()
-
-        if command == 'UPDATE':
-            if table == 'object':
-                obj = self.get_object_by_id(pk[0], pk[1])
-                if obj:
-                    obj.notify(column)
-            elif table == 'object_property':
-                obj = self.get_object_by_id(pk[0], pk[1])
-                self.__undo_redo_property_notify(obj, False, column, pk[2], pk[3])
-            elif table == 'object_layout_property':
-                child = self.get_object_by_id(pk[0], pk[2])
-                self.__undo_redo_property_notify(child, True, column, pk[3], pk[4])
-            elif table == 'object_signal':
-                pass
-            elif table == 'ui':
-                obj = self.get_object_by_id(pk[0])
-                if obj:
-                    obj.notify(column)
-            elif table == 'css':
-                obj = self.get_css_by_id(pk[0])
-                if obj:
-                    obj.notify(column)
-        elif command == 'INSERT' or command == 'DELETE':
-            if table == 'object_property':
-                obj = self.get_object_by_id(pk[0], pk[1])
-                self.__undo_redo_property_notify(obj, False, 'value', pk[2], pk[3])
-            elif table == 'object_layout_property':
-                child = self.get_object_by_id(pk[0], pk[2])
-                self.__undo_redo_property_notify(child, True, 'value', pk[3], pk[4])
-            elif table in ['object', 'ui', 'css']:
-                c.execute(commands['COUNT'], (self.history_index, ))
-                count = c.fetchone()
-
-                if count[0] == 0:
-                    if table =='object':
-                        obj = self.get_object_by_id(pk[0], pk[1])
-                        self.__remove_object(obj)
-                    elif table == 'ui':
-                        obj = self.get_object_by_id(pk[0])
-                        self.__remove_ui(obj)
-                    elif table == 'css':
-                        obj = self.get_css_by_id(pk[0])
-                        self.__remove_css(obj)
+        for signal_pk, (ui_id, object_id) in signals.items():
+            obj = self.get_object_by_id(ui_id, object_id)
+            if obj is None or obj in new_objects:
+                continue
+
+            c.execute(self.db.history_commands['object_signal']['GET'], (signal_pk, ))
+            row = c.fetchone()
+            signal = next((s for s in obj.signals if s.signal_pk == signal_pk), None)
+
+            if row is None and signal is not None:
+                obj._remove_signal(signal)
+            elif row is not None and signal is None:
+                obj._add_signal(row[0], row[3], row[4], row[5], row[6], row[7], row[8], row[9])
+
+        for css_id in css_ui:
+            obj = self.get_css_by_id(css_id)
+            if obj:
+                obj.notify('provider-for')
+
+        c.close()
+
+    def __undo_redo_remove(self, removed):
+        # Children are removed from the tree with their parent, only emit signals for the topmost objects
+        removed_set = set(removed)
+        toplevels = []
+
+        for obj in removed:
+            parent_iter = self.iter_parent(self.get_iter_from_object(obj))
+
+            if parent_iter is not None and self.get_value(parent_iter, 0) in removed_set:
+                if type(obj) == CmbObject:
+                    self.__object_id.pop(f'{obj.ui_id}.{obj.object_id}', None)
                 else:
-                    c.execute(commands['DATA'], (self.history_index, ))
-                    row = c.fetchone()
-                    if table == 'ui':
-                        self.__add_ui(True, *row)
-                    elif table == 'object':
-                        self.__add_object(True, *row)
-                    elif table == 'css':
-                        self.__add_css(True, *row)
-            elif table == 'object_signal':
-                c.execute(commands['COUNT'], (self.history_index, ))
-                count = c.fetchone()
-
-                c.execute(commands['DATA'], (self.history_index, ))
-                row = c.fetchone()
+                    self.__object_id.pop(obj.ui_id, None)
+                self.__selection_remove(obj)
+            else:
+                toplevels.append(obj)
+
+        for obj in toplevels:
+            if type(obj) == CmbObject:
+                self.__remove_object(obj)
+            elif type(obj) == CmbUI:
+                self.__remove_ui(obj)
+            elif type(obj) == CmbCSS:
+                self.__remove_css(obj)
+
+    def __undo_redo_add(self, added):
+        new_objects = []
+
+        for row in added['ui']:
+            new_objects.append(self.__add_ui(False, *row))
 
-                obj = self.get_object_by_id(row[1], row[2])
+        for row in added['css']:
+            new_objects.append(self.__add_css(False, *row))
 
-                if count[0] == 0:
-                    for signal in obj.signals:
-                        if signal.signal_pk == row[0]:
-                            obj._remove_signal(signal)
-                            break
+        # Parents have to be in the tree before their children
+        pending = sorted(added['object'], key=lambda row: (row[0], row[4] or 0, row[8]))
+        while pending:
+            left = []
+
+            for row in pending:
+                ui_id, parent_id = row[0], row[4]
+                parent_key = f'{ui_id}.{parent_id}' if parent_id else ui_id
+
+                if parent_key in self.__object_id:
+                    new_objects.append(self.__add_object(False, *row))
                 else:
-                    obj._add_signal(row[0], row[3], row[4], row[5], row[6], row[7], row[8], row[9])
-            elif table == 'css_ui':
-                obj = self.get_css_by_id(pk[0])
-                if obj:
-                    obj.notify('provider-for')
+                    left.append(row)
 
-        c.close()
+            if len(left) == len(pending):
+                logger.warning(f'Error on undo/redo: could not find parent of {len(left)} objects')
+                break
+
+            pending = left
+
+        new_set = set(new_objects)
+
+        # Only emit signals for the topmost objects
+        for obj in new_objects:
+            parent_iter = self.iter_parent(self.get_iter_from_object(obj))
+
+            if parent_iter is not None and self.get_value(parent_iter, 0) in new_set:
+                continue
+
+            if type(obj) == CmbObject:
+                self.emit('object-added', obj)
+            elif type(obj) == CmbUI:
+                self.emit('ui-added', obj)
+            elif type(obj) == CmbCSS:
+                self.emit('css-added', obj)
+
+        return new_set
 
     def __undo_redo(self, undo):
         selection = self.get_selection()
-        c = self.db.cursor()
-
-        self.history_enabled = False
-        self.db.foreign_keys = False
 
         command, range_id, table, column = self.__get_history_command(self.history_index)
 
+        # Replay the whole PUSH/POP range at once
+        first = last = self.history_index
+
         if command == 'POP':
             if undo:
-                self.history_index -= 1
-                while range_id < self.history_index:
-                    self.__undo_redo_do(True)
-                    self.history_index -= 1
+                first = range_id
             else:
                 logger.warning("Error on undo/redo stack: we should not try to redo a POP command")
+                return
         elif command == 'PUSH':
             if not undo:
-                while range_id > self.history_index:
-                    self.history_index += 1
-                    self.__undo_redo_do(undo)
+                last = range_id
             else:
                 logger.warning("Error on undo/redo stack: we should not try to undo a PUSH command")
-        else:
-            # Undo / Redo in DB
-            self.__undo_redo_do(undo)
+                return
+
+        self.history_enabled = False
+        self.db.foreign_keys = False
+
+        # Undo / Redo in DB
+        self.db.history_undo_redo(first, last, undo)
+
+        # Update project state
+        self.__undo_redo_update(first, last)
+
+        # Leave history index on the other end of the range
+        self.history_index = first if undo else last
 
         self.db.foreign_keys = True
         self.history_enabled = True
-        c.close()
 
         self.set_selection(selection)
 
@@ -976,11 +1293,15 @@ class CmbProject(Gtk.TreeStore):
         return (undo_msg, redo_msg)
 
     def undo(self):
-        if self.history_index == 0:
+        if self.history_index <= self.history_index_min:
             return
 
         self.__undo_redo(True)
         self.history_index -= 1
+
+        # Commands after this one could be replaced
+        self.__history_save_start = min(self.__history_save_start, self.history_index)
+
         self.emit('changed')
 
     def redo(self):
@@ -989,6 +1310,7 @@ class CmbProject(Gtk.TreeStore):
 
         self.history_index += 1
         self.__undo_redo(False)
+        self.__history_queue_save()
 
     def get_type_properties(self, name):
         info = self.type_info.get(name, None)
@@ -1122,8 +1444,42 @@ class CmbProject(Gtk.TreeStore):
 
         self.db.execute("INSERT INTO history (history_id, command) VALUES (?, 'POP')",
                           (self.history_index_max + 1, ))
+
         self.emit('changed')
 
+    def __history_add_import(self, message):
+        if not self.history_enabled:
+            return None
+
+        self.db.clear_history()
+
+        history_id = self.history_index_max + 1
+        self.db.history_add_import(history_id, message)
+
+        return history_id
+
+    def __history_queue_compact(self):
+        # Commands come in bursts, check the limits once the burst is over
+        if self.__history_compact_id is None:
+            self.__history_compact_id = GLib.idle_add(self.__on_history_compact_idle, priority=GLib.PRIORITY_LOW)
+
+    def __on_history_compact_idle(self):
+        self.__history_compact_id = None
+        self.compact_history()
+        return GLib.SOURCE_REMOVE
+
+    def compact_history(self):
+        '''
+        Remove the oldest history commands over history_max_entries or
+        history_max_size, this is done automatically once the project is idle.
+        '''
+        if self.__history_compact_id is not None:
+            GLib.source_remove(self.__history_compact_id)
+            self.__history_compact_id = None
+
+        # Keep the last command so the history index does not change
+        self.db.compact_history(self.history_max_entries, self.history_max_size, self.history_index - 1)
+
     def copy(self):
         # TODO: filter children out
         selection = [(o.ui_id, o.object_id) for o in self.__selection if isinstance(o, CmbObject)]
@@ -1210,6 +1566,13 @@ class CmbProject(Gtk.TreeStore):
         return self[iter][0] if iter else None
 
     # Default handlers
+    def do_changed(self):
+        # Every recorded command ends up here, not only PUSH/POP ranges
+        if self.history_enabled:
+            self.__history_queue_compact()
+
+        self.__history_queue_save()
+
     def do_ui_added(self, ui):
         self.emit('changed')
 
@@ -1323,3 +1686,24 @@ class CmbProject(Gtk.TreeStore):
 
         return False
         
+
+
+# Project loaded by each export process
+export_worker_project = None
+
+
+def export_worker_init(filename):
+    global export_worker_project
+    export_worker_project = CmbProject(filename=filename)
+
+
+def export_worker(ui_id):
+    ui = export_worker_project.db.export_ui(ui_id)
+
+    fd = io.BytesIO()
+    ui.write(fd,
+             pretty_print=True,
+             xml_declaration=True,
+             encoding='UTF-8')
+
+    return fd.getvalue()
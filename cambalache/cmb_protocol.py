@@ -0,0 +1,88 @@
+#
+# Cambalache <-> Merengue protocol
+#
+# Copyright (C) 2021  Juan Pablo Ugarte
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation;
+# version 2.1 of the License.
+#
+# library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Authors:
+#   Juan Pablo Ugarte <juanpablougarte@gmail.com>
+#
+
+# This module is used by both processes, it must not import Gtk or cambalache
+
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of bytes read at once from a pipe
+READ_SIZE = 65536
+
+
+def read_commands(fd, buffer):
+    '''
+    Read everything available from non blocking fd into buffer and parse
+    complete frames, a json line followed by payload_length bytes.
+
+    Returns a list of (command, payload) and True if fd reached EOF.
+    Incomplete frames are left in buffer for the next call.
+    '''
+    eof = False
+
+    while True:
+        try:
+            data = os.read(fd, READ_SIZE)
+        except BlockingIOError:
+            break
+
+        if not data:
+            eof = True
+            break
+
+        buffer.extend(data)
+
+    retval = []
+    start = 0
+
+    while True:
+        end = buffer.find(b'\n', start)
+
+        if end < 0:
+            break
+
+        try:
+            cmd = json.loads(buffer[start:end])
+        except ValueError as e:
+            # Ignore invalid lines
+            logger.warning(f'Error parsing command {e}')
+            start = end + 1
+            continue
+
+        length = cmd.get('payload_length', None)
+        payload_end = end + 1 + (length if length is not None else 0)
+
+        # Wait for the rest of the payload
+        if len(buffer) < payload_end:
+            break
+
+        payload = buffer[end + 1:payload_end].decode('UTF-8') if length is not None else None
+        retval.append((cmd, payload))
+        start = payload_end
+
+    del buffer[:start]
+
+    return retval, eof
@@ -40,28 +40,255 @@ class CmbTypeDataInfo(CmbBaseTypeDataInfo):
         super().__init__(**kwargs)
 
 
+class CmbTypeInfoRows:
+    """Type system rows grouped by type id.
+
+    Every table is fetched with a single query so that creating all the type
+    infos at startup does not need several queries for each type.
+    """
+
+    def __init__(self, db):
+        self.parents = {}
+        self.interfaces = {}
+        self.property = {}
+        self.signal = {}
+        self.data = {}
+        self.data_children = {}
+        self.data_args = {}
+        self.child_types = {}
+        self.enum = {}
+        self.flags = {}
+
+        c = db.cursor()
+
+        for type_id, parent_id in c.execute('SELECT type_id, parent_id FROM type;'):
+            self.parents[type_id] = parent_id
+
+        for type_id, iface_id in c.execute('SELECT type_id, iface_id FROM type_iface ORDER BY type_id, iface_id;'):
+            self.interfaces.setdefault(type_id, []).append(iface_id)
+
+        for table in ['property', 'signal']:
+            rows = getattr(self, table)
+            for row in c.execute(f'SELECT * FROM {table} ORDER BY owner_id, {table}_id;'):
+                rows.setdefault(row[0], []).append(row)
+
+        for row in c.execute('SELECT * FROM type_data ORDER BY owner_id, data_id;'):
+            owner_id, data_id, parent_id, key, type_id = row
+            if parent_id is None:
+                self.data.setdefault(owner_id, []).append(row)
+            else:
+                self.data_children.setdefault((owner_id, parent_id), []).append(row)
+
+        for row in c.execute('SELECT * FROM type_data_arg ORDER BY owner_id, data_id, key;'):
+            self.data_args.setdefault((row[0], row[1]), []).append(row)
+
+        for row in c.execute('SELECT * FROM type_child_type ORDER BY type_id, child_type;'):
+            self.child_types.setdefault(row[0], []).append(row)
+
+        for name in ['enum', 'flags']:
+            rows = getattr(self, name)
+            for type_id, *row in c.execute(f'SELECT type_id, name, nick, value FROM type_{name} ORDER BY type_id, name;'):
+                rows.setdefault(type_id, []).append(row)
+
+        c.close()
+
+    def get_hierarchy(self, type_id):
+        parent_id = self.parents.get(type_id, None)
+
+        if parent_id is None or parent_id in ['interface', 'enum', 'flags']:
+            return []
+
+        # Interfaces first, then ancestors up to the fundamental type
+        retval = list(self.interfaces.get(type_id, []))
+        retval.append(parent_id)
+
+        parent_id = self.parents.get(parent_id, None)
+        while parent_id is not None and parent_id != 'object':
+            retval.append(parent_id)
+            parent_id = self.parents.get(parent_id, None)
+
+        return retval
+
+
+class CmbTypeInfoMap(dict):
+    """Mapping of type id to CmbTypeInfo.
+
+    Type infos only keep a summary (hierarchy, category, layout, etc) until
+    their properties, signals, data or enum/flags models are accessed.
+    """
+
+    def prefetch(self, type_ids):
+        # Materialize types and everything they inherit from at once
+        for type_id in type_ids:
+            info = self.get(type_id, None)
+            if info is None:
+                continue
+
+            info._materialize()
+
+            for parent_id in info.hierarchy:
+                parent = self.get(parent_id, None)
+                if parent:
+                    parent._materialize()
+
+
 class CmbTypeInfo(CmbBaseTypeInfo):
     type_id = GObject.Property(type=str, flags = GObject.ParamFlags.READWRITE | GObject.ParamFlags.CONSTRUCT)
     parent_id = GObject.Property(type=str, flags = GObject.ParamFlags.READWRITE | GObject.ParamFlags.CONSTRUCT)
     parent = GObject.Property(type=GObject.Object, flags = GObject.ParamFlags.READWRITE)
 
-    def __init__(self, **kwargs):
+    def __init__(self, rows=None, **kwargs):
+        self.__rows = rows
+        self.__materialized = False
+        self.__properties = None
+        self.__signals = None
+        self.__data = None
+        self.__child_types = None
+        self.__enum = None
+        self.__flags = None
+
         super().__init__(**kwargs)
 
-        self.hierarchy = self.__init_hierarchy()
-        self.interfaces = self.__init_interfaces()
-        self.properties = self.__init_properties_signals(CmbPropertyInfo, 'property')
-        self.signals = self.__init_properties_signals(CmbSignalInfo, 'signal')
-        self.data = self.__init_data()
+        if rows is None:
+            self.hierarchy = self.__init_hierarchy()
+            self.interfaces = self.__init_interfaces()
+        else:
+            self.hierarchy = rows.get_hierarchy(self.type_id)
+            self.interfaces = list(rows.interfaces.get(self.type_id, []))
+
+        self.instantiable = self.is_a('GObject') and not self.abstract
+
+    @classmethod
+    def from_db(cls, project):
+        rows = CmbTypeInfoRows(project.db)
+        retval = {}
+
+        c = project.db.cursor()
+        for row in c.execute('''SELECT * FROM type
+                                  WHERE
+                                    parent_id IS NOT NULL
+                                  ORDER BY type_id;'''):
+            type_id, parent_id, library_id, version, deprecated_version, abstract, derivable, layout, category, workspace_type = row
+            retval[type_id] = cls(rows=rows,
+                                  project=project,
+                                  type_id=type_id,
+                                  parent_id=parent_id,
+                                  library_id=library_id,
+                                  version=version,
+                                  deprecated_version=deprecated_version,
+                                  abstract=abstract,
+                                  derivable=derivable,
+                                  layout=layout,
+                                  category=category,
+                                  workspace_type=workspace_type)
+
+        c.close()
+        return retval
+
+    @property
+    def properties(self):
+        self._materialize()
+        return self.__properties
+
+    @property
+    def signals(self):
+        self._materialize()
+        return self.__signals
+
+    @property
+    def data(self):
+        self._materialize()
+        return self.__data
+
+    @property
+    def child_types(self):
+        self._materialize()
+        return self.__child_types
+
+    @property
+    def enum(self):
+        self._materialize()
+        return self.__enum
+
+    @property
+    def flags(self):
+        self._materialize()
+        return self.__flags
+
+    def _materialize(self):
+        if self.__materialized:
+            return
+
+        self.__materialized = True
+
+        if self.__rows is None:
+            self.__init_from_db()
+        else:
+            self.__init_from_rows(self.__rows)
+            self.__rows = None
+
+    def __init_from_db(self):
+        self.__properties = self.__init_properties_signals(CmbPropertyInfo, 'property')
+        self.__signals = self.__init_properties_signals(CmbSignalInfo, 'signal')
+        self.__data = self.__init_data()
 
         if self.parent_id == 'enum':
-            self.enum = self.__init_enum_flags('enum')
+            self.__enum = self.__init_enum_flags('enum')
         elif self.parent_id == 'flags':
-            self.flags = self.__init_enum_flags('flags')
+            self.__flags = self.__init_enum_flags('flags')
 
-        self.child_types = self.__init_child_type()
+        self.__child_types = self.__init_child_type()
 
-        self.instantiable = self.is_a('GObject') and not self.abstract
+    def __init_from_rows(self, rows):
+        type_id = self.type_id
+
+        self.__properties = {}
+        for row in rows.property.get(type_id, []):
+            self.__properties[row[1]] = CmbPropertyInfo.from_row(self, *row)
+
+        self.__signals = {}
+        for row in rows.signal.get(type_id, []):
+            self.__signals[row[1]] = CmbSignalInfo.from_row(self, *row)
+
+        self.__data = {}
+        for row in rows.data.get(type_id, []):
+            self.__data[row[3]] = self.__type_data_from_rows(rows, *row)
+
+        if self.parent_id == 'enum':
+            self.__enum = self.__enum_flags_from_rows(rows.enum.get(type_id, []))
+        elif self.parent_id == 'flags':
+            self.__flags = self.__enum_flags_from_rows(rows.flags.get(type_id, []))
+
+        self.__child_types = {}
+        for row in rows.child_types.get(type_id, []):
+            self.__child_types[row[1]] = self.__child_type_from_row(*row)
+
+    def __type_data_from_rows(self, rows, owner_id, data_id, parent_id, key, type_id):
+        parent_id = parent_id if parent_id is not None else 0
+        retval = CmbTypeDataInfo.from_row(self, owner_id, data_id, parent_id, key, type_id)
+
+        for row in rows.data_args.get((owner_id, data_id), []):
+            retval.args[row[2]] = CmbTypeDataArgInfo.from_row(self, *row)
+
+        for row in rows.data_children.get((owner_id, data_id), []):
+            retval.children[row[3]] = self.__type_data_from_rows(rows, *row)
+
+        return retval
+
+    def __enum_flags_from_rows(self, rows):
+        retval = Gtk.ListStore(GObject.TYPE_STRING, GObject.TYPE_STRING, GObject.TYPE_INT)
+
+        for row in rows:
+            retval.append(row)
+
+        return retval
+
+    def __child_type_from_row(self, type_id, child_type, max_children, linked_property_id):
+        return CmbTypeChildInfo(project=self.project,
+                                type_id=type_id,
+                                child_type=child_type,
+                                max_children=max_children if max_children else 0,
+                                linked_property_id=linked_property_id)
 
     def __init_hierarchy(self):
         retval = []
@@ -163,12 +390,7 @@ class CmbTypeInfo(CmbBaseTypeInfo):
         c = self.project.db.cursor()
         for row in c.execute('SELECT * FROM type_child_type WHERE type_id=?;',
                              (self.type_id, )):
-            type_id, child_type, max_children, linked_property_id = row
-            retval[child_type] = CmbTypeChildInfo(project=self.project,
-                                                  type_id=type_id,
-                                                  child_type=child_type,
-                                                  max_children=max_children if max_children else 0,
-                                                  linked_property_id=linked_property_id)
+            retval[row[1]] = self.__child_type_from_row(*row)
 
         c.close()
         return retval
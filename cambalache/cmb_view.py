@@ -26,6 +26,7 @@ import gi
 import json
 import socket
 import time
+import collections
 
 gi.require_version('Gtk', '3.0')
 gi.require_version('WebKit2', '4.0')
@@ -35,6 +36,7 @@ from . import config
 from .cmb_ui import CmbUI
 from .cmb_object import CmbObject
 from .cmb_project import CmbProject
+from .cmb_protocol import read_commands
 from .cmb_context_menu import CmbContextMenu
 from cambalache import getLogger
 
@@ -45,6 +47,19 @@ basedir = os.path.dirname(__file__) or '.'
 GObject.type_ensure(WebKit2.Settings.__gtype__)
 GObject.type_ensure(WebKit2.WebView.__gtype__)
 
+# Bytes waiting to be written to a process before old UI updates are dropped
+MAX_WRITE_QUEUE_SIZE = 8 * 1024 * 1024
+
+# Frames of a UI made useless by a newer update_ui frame of the same UI
+UPDATE_UI_FRAMES = ['update_ui', 'object_added', 'object_removed', 'object_moved',
+                    'object_property_changed', 'object_layout_property_changed']
+
+# Milliseconds to wait for more changes before sending queued commands, about one frame
+COMMAND_QUEUE_INTERVAL = 16
+
+# Queued commands that are not needed anymore after a full UI update
+OBJECT_COMMANDS = ['object_property_changed', 'object_layout_property_changed', 'update_toplevels']
+
 
 class CmbProcess(GObject.Object):
     __gsignals__ = {
@@ -61,8 +76,30 @@ class CmbProcess(GObject.Object):
         self.pid = 0
         self.stdin = None
         self.stdout = None
+        self.stdout_buffer = bytearray()
+
+        # Frames waiting for stdin to be writable, the first one could be partially written
+        self.__write_queue = collections.deque()
+        self.__write_queue_size = 0
+        self.__write_offset = 0
+        self.__write_watch_id = None
+
+    @property
+    def write_pending(self):
+        return len(self.__write_queue) > 0
+
+    def __write_queue_clear(self):
+        self.__write_queue.clear()
+        self.__write_queue_size = 0
+        self.__write_offset = 0
 
     def stop(self):
+        if self.__write_watch_id is not None:
+            GLib.source_remove(self.__write_watch_id)
+            self.__write_watch_id = None
+
+        self.__write_queue_clear()
+
         if self.stdin:
             self.stdin.shutdown(False)
             self.stdin = None
@@ -98,6 +135,10 @@ class CmbProcess(GObject.Object):
 
         self.stdin = GLib.IOChannel.unix_new(stdin)
         self.stdout = GLib.IOChannel.unix_new(stdout)
+        self.stdout_buffer = bytearray()
+
+        # Never block the main loop if the process is not reading
+        os.set_blocking(stdin, False)
 
         self.stdout.add_watch(GLib.IOCondition.IN | GLib.IOCondition.HUP,
                               self.__on_stdout)
@@ -114,6 +155,106 @@ class CmbProcess(GObject.Object):
     def __on_stdout(self, channel, condition):
         return self.emit('stdout', condition)
 
+    def write_command(self, command, payload=None, args=None):
+        if self.stdin is None:
+            return
+
+        cmd = {
+            'command': command
+        }
+
+        if args is not None:
+            cmd['args'] = args
+
+        data = payload.encode('UTF-8') if payload is not None else None
+
+        # Payload length in bytes, only present if there is a payload
+        if data is not None:
+            cmd['payload_length'] = len(data)
+
+        # Send command in one line as json followed by the raw payload
+        frame = json.dumps(cmd).encode('UTF-8') + b'\n'
+
+        if data is not None:
+            frame += data
+
+        ui_id = args.get('ui_id', None) if args is not None else None
+
+        # A newer UI update makes the ones still in the queue for the same UI useless
+        if command == 'update_ui' and self.__write_queue_size + len(frame) > MAX_WRITE_QUEUE_SIZE:
+            self.__write_queue_drop(ui_id)
+
+        self.__write_queue.append((command, ui_id, frame))
+        self.__write_queue_size += len(frame)
+
+        if self.__write_watch_id is None:
+            self.__write()
+
+    def __write_queue_drop(self, ui_id):
+        # Keep the first frame if it was partially written
+        first = [self.__write_queue.popleft()] if self.__write_offset > 0 else []
+        queue = collections.deque(first)
+
+        for command, frame_ui_id, frame in self.__write_queue:
+            if command in UPDATE_UI_FRAMES and frame_ui_id == ui_id:
+                self.__write_queue_size -= len(frame)
+            else:
+                queue.append((command, frame_ui_id, frame))
+
+        self.__write_queue = queue
+
+    def __write(self):
+        fd = self.stdin.unix_get_fd()
+
+        while self.__write_queue:
+            command, ui_id, frame = self.__write_queue[0]
+
+            try:
+                self.__write_offset += os.write(fd, memoryview(frame)[self.__write_offset:])
+            except BlockingIOError:
+                break
+            except OSError as e:
+                logger.warning(f'Error writing to {self.file} {e}')
+                self.__write_queue_clear()
+                return False
+
+            if self.__write_offset == len(frame):
+                self.__write_queue.popleft()
+                self.__write_queue_size -= len(frame)
+                self.__write_offset = 0
+
+        # Continue writing when the process reads from the pipe
+        if self.__write_queue and self.__write_watch_id is None:
+            self.__write_watch_id = self.stdin.add_watch(GLib.IOCondition.OUT | GLib.IOCondition.ERR | GLib.IOCondition.HUP,
+                                                         self.__on_stdin_writable)
+
+        return len(self.__write_queue) > 0
+
+    def __on_stdin_writable(self, channel, condition):
+        if condition & (GLib.IOCondition.ERR | GLib.IOCondition.HUP):
+            self.__write_queue_clear()
+
+        if not self.__write_queue or not self.__write():
+            self.__write_watch_id = None
+            return GLib.SOURCE_REMOVE
+
+        return GLib.SOURCE_CONTINUE
+
+    def read_commands(self):
+        '''
+        Read everything available from stdout and parse complete frames, a
+        json line followed by payload_length bytes.
+
+        Returns a list of (command, payload) and True if stdout reached EOF.
+        '''
+        if self.stdout is None:
+            return [], True
+
+        fd = self.stdout.unix_get_fd()
+        os.set_blocking(fd, False)
+
+        return read_commands(fd, self.stdout_buffer)
+
 
 @Gtk.Template(resource_path='/ar/xjuan/Cambalache/cmb_view.ui')
 class CmbView(Gtk.Stack):
@@ -135,6 +276,17 @@ class CmbView(Gtk.Stack):
         self.__ui_id = 0
         self.__theme = None
 
+        # UI loaded in merengue and toplevel object id of each of its objects
+        self.__merengue_ui_id = 0
+        self.__toplevel_ids = {}
+
+        # UIs merengue keeps alive and up to date, they can be shown without rebuilding them
+        self.__merengue_warm_uis = set()
+
+        # Pending commands by key, sent together once per interval
+        self.__command_queue = {}
+        self.__command_queue_id = None
+
         self.menu = self.__create_context_menu()
 
         super().__init__(**kwargs)
@@ -167,6 +319,8 @@ class CmbView(Gtk.Stack):
         self.connect("notify::preview", self.__on_preview_notify)
 
     def do_destroy(self):
+        self.__queue_clear()
+
         if self.__merengue:
             self.__merengue.stop()
 
@@ -200,28 +354,52 @@ window.setupDocument = function (document) {
 }
 ''', None, None)
 
-    def __merengue_command(self, command, payload=None, args=None):
-        if self.__merengue is None or self.__merengue.stdin is None:
-            return
+    def __queue(self, key, func):
+        '''
+        Call func on the next queue flush, replacing any pending function
+        with the same key. A key of None is never replaced.
+        '''
+        if key is None:
+            key = object()
+        else:
+            # Move it to the end to keep the order of changes
+            self.__command_queue.pop(key, None)
 
-        cmd = {
-            'command': command,
-            'payload': payload is not None
-        }
+        self.__command_queue[key] = func
 
-        if args is not None:
-            cmd['args'] = args
+        if self.__command_queue_id is None:
+            self.__command_queue_id = GLib.timeout_add(COMMAND_QUEUE_INTERVAL, self.__on_command_queue_timeout)
+
+    def __queue_clear(self):
+        if self.__command_queue_id is not None:
+            GLib.source_remove(self.__command_queue_id)
+            self.__command_queue_id = None
 
-        # Send command in one line as json
-        self.__merengue.stdin.write(json.dumps(cmd))
-        self.__merengue.stdin.write('\n')
+        self.__command_queue = {}
 
-        if payload is not None:
-            self.__merengue.stdin.write(GLib.strescape(payload))
-            self.__merengue.stdin.write('\n')
+    def __on_command_queue_timeout(self):
+        # Keep coalescing commands until merengue reads the ones already sent
+        if self.__merengue is not None and self.__merengue.write_pending:
+            return GLib.SOURCE_CONTINUE
 
-        # Flush
-        self.__merengue.stdin.flush()
+        self.__command_queue_id = None
+
+        queue = self.__command_queue
+        self.__command_queue = {}
+
+        for func in queue.values():
+            func()
+
+        return GLib.SOURCE_REMOVE
+
+    def __merengue_command(self, command, payload=None, args=None, key=None):
+        self.__queue(key, lambda: self.__merengue_write(command, payload, args))
+
+    def __merengue_write(self, command, payload=None, args=None):
+        if self.__merengue is None:
+            return
+
+        self.__merengue.write_command(command, payload, args)
 
     def __get_ui_xml(self, ui_id, merengue=False):
         return self.__project.db.tostring(ui_id, merengue=merengue)
@@ -236,41 +414,138 @@ window.setupDocument = function (document) {
         self.buffer.set_text('')
         self.__ui_id = 0
 
+    def __queue_update_view(self):
+        self.__queue(('update_view', ), self.__update_view)
+
     def __merengue_update_ui(self, ui_id):
+        # Pending object updates of this UI are included in the full update
+        for key in list(self.__command_queue.keys()):
+            if type(key) == tuple and key[0] in OBJECT_COMMANDS and key[1] == ui_id:
+                self.__command_queue.pop(key)
+
+        self.__merengue_warm_uis.discard(ui_id)
+        self.__queue(('update_ui', ), lambda: self.__merengue_send_ui(ui_id))
+
+    def __merengue_show_ui(self, ui_id):
+        if ui_id not in self.__merengue_warm_uis:
+            self.__merengue_update_ui(ui_id)
+            return
+
+        def send():
+            selection = self.__project.get_selection()
+
+            self.__merengue_ui_id = ui_id
+            self.__toplevel_ids = self.__project.db.get_toplevel_ids(ui_id)
+
+            self.__merengue_write('show_ui',
+                                  args={
+                                      'ui_id': ui_id,
+                                      'toplevels': self.__project.db.get_toplevels(ui_id),
+                                      'selection': self.__get_selection_objects(selection, ui_id)
+                                  })
+
+        self.__queue(('update_ui', ), send)
+
+    def __merengue_check_warm(self, ui_id):
+        # Hidden UIs do not get live updates, they have to be rebuilt next time
+        if ui_id != self.__ui_id or ui_id != self.__merengue_ui_id:
+            self.__merengue_warm_uis.discard(ui_id)
+
+    def __merengue_send_ui(self, ui_id):
         ui = self.__get_ui_xml(ui_id, merengue=True)
         toplevels = self.__project.db.get_toplevels(ui_id)
         selection = self.__project.get_selection()
         objects = self.__get_selection_objects(selection, ui_id)
 
-        self.__merengue_command('update_ui',
-                                payload=ui,
-                                args={
-                                    'ui_id': ui_id,
-                                    'dirname': os.path.dirname(self.__project.filename),
-                                    'toplevels': toplevels,
-                                    'selection': objects
-                                })
+        self.__merengue_ui_id = ui_id
+        self.__toplevel_ids = self.__project.db.get_toplevel_ids(ui_id) if ui_id else {}
+
+        if ui_id:
+            self.__merengue_warm_uis.add(ui_id)
+
+        self.__merengue_write('update_ui',
+                              payload=ui,
+                              args={
+                                  'ui_id': ui_id,
+                                  'dirname': os.path.dirname(self.__project.filename),
+                                  'toplevels': toplevels,
+                                  'selection': objects
+                              })
+
+    def __merengue_update_toplevels(self, command, obj, update):
+        '''
+        Replace toplevels in update with their current version instead of
+        sending the whole UI.
+        '''
+        ui_id = obj.ui_id
+        db = self.__project.db
+
+        self.__merengue_check_warm(ui_id)
+
+        # Rebuild everything if other toplevels could end up pointing to old objects
+        if ui_id != self.__merengue_ui_id or None in update or ('update_ui', ) in self.__command_queue or \
+           any([db.has_external_references(ui_id, toplevel_id) for toplevel_id in update]):
+            self.__merengue_update_ui(ui_id)
+            return
+
+        for toplevel_id in update:
+            self.__toplevel_ids.update(db.get_toplevel_ids(ui_id, toplevel_id))
+
+        def send():
+            selection = self.__project.get_selection()
+
+            self.__merengue_write(command,
+                                  payload=db.tostring(ui_id, merengue=True, toplevels=update),
+                                  args={
+                                      'ui_id': ui_id,
+                                      'object_id': obj.object_id,
+                                      'update': update,
+                                      'toplevels': db.get_toplevels(ui_id),
+                                      'selection': self.__get_selection_objects(selection, ui_id)
+                                  })
+
+        # Several changes in the same toplevels only need one update
+        self.__queue(('update_toplevels', ui_id, tuple(sorted(update))), send)
+
+    def __on_ui_removed(self, project, ui):
+        self.__merengue_warm_uis.discard(ui.ui_id)
 
     def __on_ui_changed(self, project, ui, field):
         if field in ['custom-fragment']:
-            self.__update_view()
+            self.__queue_update_view()
             self.__merengue_update_ui(ui.ui_id)
 
     def __on_object_added(self, project, obj):
-        self.__update_view()
-        self.__merengue_update_ui(obj.ui_id)
+        self.__queue_update_view()
+
+        toplevel_id = project.db.get_toplevel(obj.ui_id, obj.object_id)
+        self.__merengue_update_toplevels('object_added', obj, [toplevel_id])
 
     def __on_object_removed(self, project, obj):
-        self.__update_view()
-        self.__merengue_update_ui(obj.ui_id)
+        self.__queue_update_view()
+
+        # Object is not in the DB anymore, use the toplevel it had when it was sent.
+        # If the toplevel was removed too it will not be exported.
+        toplevel_id = self.__toplevel_ids.pop(obj.object_id, None) if obj.ui_id == self.__merengue_ui_id else None
+        self.__merengue_update_toplevels('object_removed', obj, [toplevel_id])
 
     def __on_object_changed(self, project, obj, field):
-        if field in ['type', 'position', 'custom-fragment']:
-            self.__update_view()
+        if field in ['position', 'parent-id']:
+            self.__queue_update_view()
+
+            old_toplevel_id = self.__toplevel_ids.get(obj.object_id, None) if obj.ui_id == self.__merengue_ui_id else None
+            toplevel_id = project.db.get_toplevel(obj.ui_id, obj.object_id)
+            # Object could be moved from one toplevel to another
+            update = list(dict.fromkeys([toplevel_id, old_toplevel_id]))
+
+            self.__merengue_update_toplevels('object_moved', obj, update)
+        elif field in ['type', 'custom-fragment']:
+            self.__queue_update_view()
             self.__merengue_update_ui(obj.ui_id)
 
     def __on_object_property_changed(self, project, obj, prop):
-        self.__update_view()
+        self.__queue_update_view()
+        self.__merengue_check_warm(obj.ui_id)
 
         if obj.info.workspace_type is None and prop.info.construct_only:
             self.__merengue_update_ui(obj.ui_id)
@@ -282,17 +557,18 @@ window.setupDocument = function (document) {
             'property_id': prop.property_id,
             'is_object': prop.info.is_object,
             'value': prop.value
-        })
+        }, key=('object_property_changed', obj.ui_id, obj.object_id, prop.property_id))
 
     def __on_object_layout_property_changed(self, project, obj, child, prop):
-        self.__update_view()
+        self.__queue_update_view()
+        self.__merengue_check_warm(obj.ui_id)
         self.__merengue_command('object_layout_property_changed', args={
             'ui_id': obj.ui_id,
             'object_id': obj.object_id,
             'child_id': child.object_id,
             'property_id': prop.property_id,
             'value': prop.value
-        })
+        }, key=('object_layout_property_changed', obj.ui_id, obj.object_id, child.object_id, prop.property_id))
 
     def __get_selection_objects(self, selection, ui_id):
         objects = []
@@ -316,14 +592,16 @@ window.setupDocument = function (document) {
 
             if self.__ui_id != ui_id:
                 self.__ui_id = ui_id
-                self.__update_view()
-                self.__merengue_update_ui(ui_id)
+                self.__queue_update_view()
+                self.__merengue_show_ui(ui_id)
 
             objects = self.__get_selection_objects(selection, ui_id)
-            self.__merengue_command('selection_changed', args={ 'ui_id': ui_id, 'selection': objects })
+            self.__merengue_command('selection_changed',
+                                    args={ 'ui_id': ui_id, 'selection': objects },
+                                    key=('selection_changed', ))
         else:
             self.__ui_id = 0
-            self.__update_view()
+            self.__queue_update_view()
             self.__merengue_update_ui(0)
 
     def __on_css_added(self, project, obj):
@@ -364,6 +642,7 @@ window.setupDocument = function (document) {
     @project.setter
     def _set_project(self, project):
         if self.__project is not None:
+            self.__project.disconnect_by_func(self.__on_ui_removed)
             self.__project.disconnect_by_func(self.__on_ui_changed)
             self.__project.disconnect_by_func(self.__on_object_added)
             self.__project.disconnect_by_func(self.__on_object_removed)
@@ -379,10 +658,15 @@ window.setupDocument = function (document) {
             self.__broadwayd.stop()
 
         self.__project = project
+        self.__merengue_ui_id = 0
+        self.__merengue_warm_uis = set()
+        self.__toplevel_ids = {}
+        self.__queue_clear()
 
         self.__update_view()
 
         if project is not None:
+            project.connect('ui-removed', self.__on_ui_removed)
             project.connect('ui-changed', self.__on_ui_changed)
             project.connect('object-added', self.__on_object_added)
             project.connect('object-removed', self.__on_object_removed)
@@ -522,21 +806,24 @@ window.setupDocument = function (document) {
             self.__on_css_added(self.project, css)
 
     def __on_merengue_stdout(self, process, condition):
-        if condition == GLib.IOCondition.HUP:
-            self.__merengue.stop()
+        if self.__merengue.stdout is None:
             return GLib.SOURCE_REMOVE
 
-        if self.__merengue.stdout is None:
+        commands, eof = self.__merengue.read_commands()
+
+        for cmd, payload in commands:
+            if not self.__merengue_run_command(cmd.get('command', None), cmd.get('args', {})):
+                self.__merengue.stop()
+                return GLib.SOURCE_REMOVE
+
+        if eof:
+            self.__merengue.stop()
             return GLib.SOURCE_REMOVE
 
-        retval = self.__merengue.stdout.readline()
-        cmd = None
+        return GLib.SOURCE_CONTINUE
 
+    def __merengue_run_command(self, command, args):
         try:
-            cmd = json.loads(retval)
-            command = cmd.get('command', None)
-            args = cmd.get('args', {})
-
             if command == 'selection_changed':
                 self.__command_selection_changed(**args)
             elif command == 'started':
@@ -552,6 +839,13 @@ window.setupDocument = function (document) {
                 self.emit('placeholder-selected', args['ui_id'], args['object_id'], args['layout'], args['position'], args['child_type'])
             elif command == 'placeholder_activated':
                 self.emit('placeholder-activated', args['ui_id'], args['object_id'], args['layout'], args['position'], args['child_type'])
+            elif command == 'ui_session_missing':
+                self.__merengue_warm_uis.discard(args['ui_id'])
+
+                if args['ui_id'] == self.__ui_id:
+                    self.__merengue_update_ui(args['ui_id'])
+            elif command == 'debug_controllers':
+                logger.info(f'Merengue controllers: {args}')
             elif command == 'gtk_settings_get':
                 if args['property'] == 'gtk-theme-name':
                     self.__theme = args['value']
@@ -559,10 +853,9 @@ window.setupDocument = function (document) {
 
         except Exception as e:
             logger.warning(f'Merenge output error: {e}')
-            self.__merengue.stop()
-            return GLib.SOURCE_REMOVE
+            return False
 
-        return GLib.SOURCE_CONTINUE
+        return True
 
     def __on_broadwayd_stdout(self, process, condition):
         if condition == GLib.IOCondition.HUP:
@@ -622,6 +915,9 @@ window.setupDocument = function (document) {
                                    'modifier': modifier
                                })
 
+    def debug_controllers(self):
+        self.__merengue_command('debug_controllers')
+
     def add_placeholder(self, modifier=False):
         self.__add_remove_placeholder('add_placeholder', modifier)
 
@@ -30,6 +30,16 @@ CREATE TABLE global (
   value TEXT
 ) WITHOUT ROWID;
 
+/* Template types
+ *
+ * Per project overlay on top of the shared read only type system,
+ * exposed together with it in the temporary type view.
+ */
+CREATE TABLE template_type (
+  type_id TEXT PRIMARY KEY,
+  parent_id TEXT
+) WITHOUT ROWID;
+
 /* UI
  *
  */
@@ -55,7 +65,7 @@ WHEN
   OLD.template_id IS NOT NULL AND
   (SELECT name FROM object WHERE ui_id=OLD.ui_id AND object_id=OLD.template_id) IS NOT NULL
 BEGIN
-  DELETE FROM type WHERE library_id IS NULL AND type_id=(SELECT name FROM object
+  DELETE FROM template_type WHERE type_id=(SELECT name FROM object
       WHERE ui_id=OLD.ui_id AND object_id=OLD.template_id);
 END;
 
@@ -65,7 +75,7 @@ WHEN
   NEW.template_id IS NOT NULL AND
   (SELECT name FROM object WHERE ui_id=NEW.ui_id AND object_id=NEW.template_id) IS NOT NULL
 BEGIN
-  INSERT INTO type (type_id, parent_id)
+  INSERT INTO template_type (type_id, parent_id)
     SELECT name, type_id FROM object
       WHERE ui_id=NEW.ui_id AND object_id=NEW.template_id;
 END;
@@ -79,8 +89,7 @@ CREATE TABLE ui_library (
   library_id TEXT,
   version TEXT,
   comment TEXT,
-  PRIMARY KEY(ui_id, library_id),
-  FOREIGN KEY(library_id, version) REFERENCES library_version
+  PRIMARY KEY(ui_id, library_id)
 ) WITHOUT ROWID;
 
 
@@ -113,7 +122,7 @@ CREATE TABLE object (
   ui_id INTEGER REFERENCES ui ON DELETE CASCADE,
   object_id INTEGER,
 
-  type_id TEXT NOT NULL REFERENCES type ON UPDATE CASCADE,
+  type_id TEXT NOT NULL,
   name TEXT,
   parent_id INTEGER,
   internal TEXT,
@@ -129,7 +138,8 @@ CREATE INDEX object_type_id_fk ON object (type_id);
 CREATE INDEX object_parent_id_fk ON object (ui_id, parent_id);
 
 /* Update template name:
- * References to type will be automatically updated because of ON UPDATE CASCADE
+ * Type system tables live in an attached database so references to template
+ * types can not use foreign keys, objects are updated manually instead.
  */
 CREATE TRIGGER on_object_name_update_add_type AFTER UPDATE OF name ON object
 WHEN
@@ -137,7 +147,7 @@ WHEN
   NEW.name IS NOT NULL AND
   NEW.object_id IS (SELECT template_id FROM ui WHERE ui_id=NEW.ui_id)
 BEGIN
-  INSERT INTO type(type_id, parent_id) VALUES (NEW.name, NEW.type_id);
+  INSERT INTO template_type(type_id, parent_id) VALUES (NEW.name, NEW.type_id);
 END;
 
 CREATE TRIGGER on_object_name_update_rename_type AFTER UPDATE OF name ON object
@@ -147,7 +157,9 @@ WHEN
   OLD.name IS NOT NEW.name AND
   NEW.object_id IS (SELECT template_id FROM ui WHERE ui_id=NEW.ui_id)
 BEGIN
-  UPDATE type SET type_id=NEW.name WHERE library_id IS NULL AND type_id=OLD.name;
+  UPDATE template_type SET type_id=NEW.name WHERE type_id=OLD.name;
+  UPDATE template_type SET parent_id=NEW.name WHERE parent_id=OLD.name;
+  UPDATE object SET type_id=NEW.name WHERE type_id=OLD.name;
 END;
 
 CREATE TRIGGER on_object_name_update_remove_type AFTER UPDATE OF name ON object
@@ -156,7 +168,7 @@ WHEN
   NEW.name IS NULL AND
   NEW.object_id IS (SELECT template_id FROM ui WHERE ui_id=NEW.ui_id)
 BEGIN
-  DELETE FROM type WHERE library_id IS NULL AND type_id=OLD.name;
+  DELETE FROM template_type WHERE type_id=OLD.name;
 END;
 
 CREATE TRIGGER on_object_insert_add_type AFTER INSERT ON object
@@ -164,7 +176,7 @@ WHEN
   NEW.name IS NOT NULL AND
   NEW.object_id IS (SELECT template_id FROM ui WHERE ui_id=NEW.ui_id)
 BEGIN
-  INSERT INTO type(type_id, parent_id) VALUES (NEW.name, NEW.type_id);
+  INSERT INTO template_type(type_id, parent_id) VALUES (NEW.name, NEW.type_id);
 END;
 
 CREATE TRIGGER on_object_delete_remove_type AFTER DELETE ON object
@@ -172,7 +184,7 @@ WHEN
   OLD.name IS NOT NULL AND
   OLD.object_id IS (SELECT template_id FROM ui WHERE ui_id=OLD.ui_id)
 BEGIN
-  DELETE FROM type WHERE library_id IS NULL AND type_id=OLD.name;
+  DELETE FROM template_type WHERE type_id=OLD.name;
   UPDATE ui SET template_id=NULL WHERE ui_id=OLD.ui_id AND template_id=OLD.object_id;
 END;
 
@@ -184,7 +196,7 @@ END;
 CREATE TABLE object_property (
   ui_id INTEGER REFERENCES ui ON DELETE CASCADE,
   object_id INTEGER,
-  owner_id TEXT REFERENCES type ON UPDATE CASCADE,
+  owner_id TEXT,
   property_id TEXT,
 
   value TEXT,
@@ -195,8 +207,7 @@ CREATE TABLE object_property (
   inline_object_id INTEGER,
   PRIMARY KEY(ui_id, object_id, owner_id, property_id),
   FOREIGN KEY(ui_id, object_id) REFERENCES object(ui_id, object_id) ON DELETE CASCADE,
-  FOREIGN KEY(ui_id, inline_object_id) REFERENCES object(ui_id, object_id) ON DELETE CASCADE,
-  FOREIGN KEY(owner_id, property_id) REFERENCES property
+  FOREIGN KEY(ui_id, inline_object_id) REFERENCES object(ui_id, object_id) ON DELETE CASCADE
 ) WITHOUT ROWID;
 
 CREATE INDEX object_property_object_fk ON object_property (ui_id, object_id);
@@ -211,7 +222,7 @@ CREATE TABLE object_layout_property (
   ui_id INTEGER REFERENCES ui ON DELETE CASCADE,
   object_id INTEGER,
   child_id INTEGER,
-  owner_id TEXT REFERENCES type ON UPDATE CASCADE,
+  owner_id TEXT,
   property_id TEXT,
 
   value TEXT,
@@ -221,8 +232,7 @@ CREATE TABLE object_layout_property (
   translation_comments TEXT,
   PRIMARY KEY(ui_id, object_id, child_id, owner_id, property_id),
   FOREIGN KEY(ui_id, object_id) REFERENCES object ON DELETE CASCADE,
-  FOREIGN KEY(ui_id, child_id) REFERENCES object(ui_id, object_id) ON DELETE CASCADE,
-  FOREIGN KEY(owner_id, property_id) REFERENCES property
+  FOREIGN KEY(ui_id, child_id) REFERENCES object(ui_id, object_id) ON DELETE CASCADE
 ) WITHOUT ROWID;
 
 CREATE INDEX object_layout_property_child_property_fk ON object_layout_property (owner_id, property_id);
@@ -236,7 +246,7 @@ CREATE TABLE object_signal (
   signal_pk INTEGER PRIMARY KEY AUTOINCREMENT,
   ui_id INTEGER REFERENCES ui ON DELETE CASCADE,
   object_id INTEGER,
-  owner_id TEXT REFERENCES type ON UPDATE CASCADE,
+  owner_id TEXT,
   signal_id TEXT,
 
   handler TEXT NOT NULL,
@@ -245,8 +255,7 @@ CREATE TABLE object_signal (
   swap BOOLEAN,
   after BOOLEAN,
   comment TEXT,
-  FOREIGN KEY(ui_id, object_id) REFERENCES object ON DELETE CASCADE,
-  FOREIGN KEY(owner_id, signal_id) REFERENCES signal
+  FOREIGN KEY(ui_id, object_id) REFERENCES object ON DELETE CASCADE
 );
 
 CREATE INDEX object_signal_object_fk ON object (ui_id, object_id);
@@ -261,15 +270,14 @@ CREATE INDEX object_signal_signal_fk ON object_signal (owner_id, signal_id);
 CREATE TABLE object_data (
   ui_id INTEGER REFERENCES ui ON DELETE CASCADE,
   object_id INTEGER,
-  owner_id TEXT REFERENCES type ON UPDATE CASCADE,
+  owner_id TEXT,
   data_id INTEGER,
   id INTEGER,
   value TEXT,
   parent_id INTEGER,
   comment TEXT,
   PRIMARY KEY(ui_id, object_id, owner_id, data_id, id),
-  FOREIGN KEY(ui_id, object_id) REFERENCES object ON DELETE CASCADE,
-  FOREIGN KEY(owner_id, data_id) REFERENCES type_data
+  FOREIGN KEY(ui_id, object_id) REFERENCES object ON DELETE CASCADE
 );
 
 
@@ -279,13 +287,12 @@ CREATE TABLE object_data (
 CREATE TABLE object_data_arg (
   ui_id INTEGER REFERENCES ui ON DELETE CASCADE,
   object_id INTEGER,
-  owner_id TEXT REFERENCES type ON UPDATE CASCADE,
+  owner_id TEXT,
   data_id INTEGER,
   id INTEGER,
   key TEXT,
   value TEXT,
   PRIMARY KEY(ui_id, object_id, owner_id, data_id, id, key),
-  FOREIGN KEY(ui_id, object_id, owner_id, data_id, id) REFERENCES object_data ON DELETE CASCADE,
-  FOREIGN KEY(owner_id, data_id, key) REFERENCES type_data_arg
+  FOREIGN KEY(ui_id, object_id, owner_id, data_id, id) REFERENCES object_data ON DELETE CASCADE
 );
 
@@ -24,9 +24,12 @@
 import os
 import gi
 import sys
-import json
+import hashlib
 import importlib
 
+from collections import OrderedDict
+
+from xml.etree import ElementTree
 from gi.repository import GLib, GObject, Gio, Gdk, Gtk
 
 from .mrg_controller_registry import MrgControllerRegistry
@@ -38,6 +41,16 @@ from merengue import getLogger
 
 logger = getLogger(__name__)
 
+# Max number of objects kept in the widget cache
+WIDGET_CACHE_SIZE = 4096
+
+# Max number of hidden UIs and objects kept alive for fast switching
+MAX_UI_SESSIONS = 8
+UI_SESSION_SIZE = 8192
+
+# Max number of unused controllers kept for reuse by each controller type
+CONTROLLER_POOL_SIZE = 64
+
 
 class MrgApplication(Gtk.Application):
 
@@ -46,6 +59,7 @@ class MrgApplication(Gtk.Application):
 
     def __init__(self):
         self.stdin = None
+        self.stdin_buffer = bytearray()
 
         super().__init__(application_id='ar.xjuan.Merengue',
                          flags=Gio.ApplicationFlags.NON_UNIQUE)
@@ -56,6 +70,21 @@ class MrgApplication(Gtk.Application):
         # Dict of controllers
         self.controllers = {}
 
+        # Unused controllers by controller type
+        self.controller_pool = {}
+
+        # Dict of object ids in each toplevel subtree
+        self.toplevel_objects = {}
+
+        # Dict of toplevel id for each object in the workspace
+        self.object_toplevel = {}
+
+        # LRU of built toplevels by id, reused if their definition did not change
+        self.widget_cache = OrderedDict()
+
+        # LRU of hidden UIs by id, with their objects and toplevels
+        self.ui_sessions = OrderedDict()
+
         # Dict of CSS providers
         self.css_providers = {}
 
@@ -76,18 +105,26 @@ class MrgApplication(Gtk.Application):
         return self.controllers.get(object_id, None)
 
     def clear_all(self):
+        # Keep current UI alive in case it is shown again
+        self.__save_ui_session()
+
         self.ui_id = None
         self.preselected_widget = None
+        self.toplevel_objects = {}
+        self.object_toplevel = {}
 
         # Unset controllers objects
         for key in self.controllers:
             controller = self.controllers[key]
-            controller.object = None
             controller.selected = False
+            controller.object = None
 
     def update_ui(self, ui_id, dirname=None, toplevels=[], selection=[], payload=None):
         self.clear_all()
 
+        # Old version of this UI is replaced by the new one
+        self.__remove_ui_session(ui_id)
+
         if payload == None:
             return
 
@@ -97,55 +134,317 @@ class MrgApplication(Gtk.Application):
         if dirname:
             os.chdir(dirname)
 
-        # Build everything
-        builder = Gtk.Builder()
+        # Build everything not in the cache
+        self.__add_objects(ui_id, toplevels, payload)
 
-        try:
-            builder.add_from_string(payload)
-        except Exception as e:
-            logger.warning(f'Error updating UI {ui_id}: {e}')
+        self.set_selection(ui_id, selection)
+
+        self.__update_css_providers()
 
-        objects = builder.get_objects()
-        placeholders = []
+        self.__collect_controllers()
 
-        # Keep dict of all object controllers by id
-        for obj in objects:
-            if isinstance(obj, MrgPlaceholder):
-                placeholders.append(obj)
+    def show_ui(self, ui_id, toplevels=[], selection=[]):
+        if ui_id == self.ui_id:
+            self.selection_changed(ui_id, selection)
+            return
+
+        session = self.ui_sessions.pop(ui_id, None)
+
+        # Ask for the whole UI if it was evicted
+        if session is None:
+            utils.write_command('ui_session_missing', args={'ui_id': ui_id})
+            return
+
+        self.clear_all()
+
+        self.ui_id = ui_id
+        self.toplevel_objects = session['toplevel_objects']
+        self.object_toplevel = session['object_toplevel']
+
+        for obj in session['objects']:
+            self.__set_object_controller(obj, toplevels)
+
+        self.set_selection(ui_id, selection)
+
+        self.__update_css_providers()
+
+        self.__collect_controllers()
+
+    def __save_ui_session(self):
+        if self.ui_id is None:
+            return
+
+        objects = []
+
+        for key in self.object_toplevel:
+            controller = self.controllers.get(key, None)
+
+            if controller and controller.object:
+                objects.append(controller.object)
+
+        self.ui_sessions[self.ui_id] = {
+            'toplevel_objects': self.toplevel_objects,
+            'object_toplevel': self.object_toplevel,
+            'objects': objects
+        }
 
-            object_id = utils.object_get_id(obj)
+        size = sum([len(session['objects']) for session in self.ui_sessions.values()])
 
-            if object_id is None:
+        # Evict least recently shown UIs
+        while len(self.ui_sessions) > MAX_UI_SESSIONS or size > UI_SESSION_SIZE:
+            ui_id, session = self.ui_sessions.popitem(last=False)
+            size -= len(session['objects'])
+            self.__destroy_unused(session['objects'])
+
+    def __remove_ui_session(self, ui_id):
+        session = self.ui_sessions.pop(ui_id, None)
+
+        if session:
+            self.__destroy_unused(session['objects'])
+
+    def __destroy_unused(self, objects):
+        # Windows are not destroyed with their controller if they are cached
+        for obj in objects:
+            if not isinstance(obj, Gtk.Window) or self.is_cached(obj):
                 continue
 
-            if issubclass(type(obj), Gtk.Expander):
-                obj.props.expanded = True
+            controller = self.get_controller_from_object(obj)
+
+            if controller is None or controller.object != obj:
+                obj.destroy()
+
+    def update_toplevels(self, ui_id, object_id, update=[], toplevels=[], selection=[], payload=None):
+        # Only the UI in the workspace can be updated
+        if ui_id != self.ui_id:
+            return
+
+        self.preselected_widget = None
+
+        # Unset controllers of every object in the old subtrees
+        for toplevel_id in update:
+            for key in self.toplevel_objects.pop(f'{ui_id}.{toplevel_id}', []):
+                self.object_toplevel.pop(key, None)
+                controller = self.controllers.get(key, None)
+
+                if controller:
+                    controller.selected = False
+                    controller.object = None
+
+        if payload is not None:
+            self.__add_objects(ui_id, toplevels, payload)
+
+        self.selection_changed(ui_id, selection)
+
+        self.__collect_controllers()
+
+    def __get_toplevel_digest(self, node, ids):
+        # Objects pointing to other toplevels can not be reused since those could be rebuilt
+        for prop in node.iter('property'):
+            object_id = utils.builder_id_to_object_id(prop.text)
+
+            if object_id is not None and object_id not in ids:
+                return None
+
+        return hashlib.sha1(ElementTree.tostring(node)).hexdigest()
+
+    def __set_object_controller(self, obj, toplevels):
+        object_id = utils.object_get_id(obj)
+
+        controller = self.controllers.get(object_id, None)
+        klass = self.registry.get_controller_type(obj.__gtype__)
+
+        # object_id could be reused for a different object type if you undo
+        # the creation of a widget and create a different type
+        if controller is None or type(controller) != klass:
+            if controller:
+                self.__release_controller(controller)
+
+            pool = self.controller_pool.get(klass, None)
+            controller = pool.pop() if pool else klass(app=self)
+
+        _uiid, obj_id = object_id.split('.')
+        controller.toplevel = int(obj_id) in toplevels
+        controller.object = obj
 
-            controller = self.controllers.get(object_id, None)
-            pspec = controller.find_property('object') if controller else None
+        self.controllers[object_id] = controller
 
-            # FIXME: object_id could be reused for a different object type
-            # if you undo the creation of a widget and create a different type
-            # As a workaround if the types do not match we create a new controller
-            # This could be fixed if we alway auto increment object_id but then
-            # we would have to clean up unussed controllers
-            if pspec is None or pspec.value_type != obj.__gtype__:
-                controller = self.registry.new_controller_for_type(obj.__gtype__, self)
+    def __release_controller(self, controller):
+        controller.reset()
 
-            _uiid, obj_id = object_id.split('.')
-            controller.toplevel = int(obj_id) in toplevels
-            controller.object = obj
+        pool = self.controller_pool.setdefault(type(controller), [])
 
-            self.controllers[object_id] = controller
+        if len(pool) < CONTROLLER_POOL_SIZE:
+            pool.append(controller)
+        else:
+            controller.destroy()
+
+    def __collect_controllers(self):
+        # Objects in the workspace or in a hidden UI
+        keys = set(self.object_toplevel.keys())
+        for session in self.ui_sessions.values():
+            keys.update(session['object_toplevel'].keys())
+
+        for key in [key for key in self.controllers if key not in keys]:
+            self.__release_controller(self.controllers.pop(key))
+
+    def debug_controllers(self):
+        pool = {}
+        for klass in self.controller_pool:
+            pool[klass.__name__] = len(self.controller_pool[klass])
+
+        in_use = len([c for c in self.controllers.values() if c.object is not None])
+
+        utils.write_command('debug_controllers',
+                            args={
+                                'controllers': len(self.controllers),
+                                'in_use': in_use,
+                                'pool': pool
+                            })
 
-        # Set controller for placeholders created by Builder
+    def __set_placeholders_controller(self, placeholders):
         for obj in placeholders:
             parent_id = utils.object_get_id(obj.props.parent)
             obj.controller = self.controllers.get(parent_id, None)
 
-        self.set_selection(ui_id, selection)
+    def __add_objects(self, ui_id, toplevels, payload):
+        try:
+            root = ElementTree.fromstring(payload)
+        except Exception as e:
+            logger.warning(f'Error updating UI {ui_id}: {e}')
+            return
 
-        self.__update_css_providers()
+        built = []
+        reused = []
+
+        for node in list(root):
+            toplevel_id = utils.builder_id_to_object_id(node.get('id', None)) if node.tag == 'object' else None
+
+            if toplevel_id is None:
+                continue
+
+            ids = [utils.builder_id_to_object_id(n.get('id', None)) for n in node.iter('object')]
+            ids = [object_id for object_id in ids if object_id is not None]
+
+            self.toplevel_objects[toplevel_id] = ids
+            for object_id in ids:
+                self.object_toplevel[object_id] = toplevel_id
+
+            digest = self.__get_toplevel_digest(node, set(ids))
+            entry = self.widget_cache.get(toplevel_id, None)
+
+            # Reuse widgets built from the exact same definition
+            if digest is not None and entry is not None and entry['digest'] == digest:
+                self.widget_cache.move_to_end(toplevel_id)
+                reused.append(entry)
+                root.remove(node)
+            else:
+                built.append((toplevel_id, digest))
+
+        for entry in reused:
+            for obj in entry['objects']:
+                self.__set_object_controller(obj, toplevels)
+
+            self.__set_placeholders_controller(entry['placeholders'])
+
+        if built:
+            builder = Gtk.Builder()
+            exposed = set()
+
+            # Let new objects reference the ones already in the workspace
+            for key in self.controllers:
+                obj = self.controllers[key].object
+
+                if obj is not None:
+                    builder.expose_object(f'__cmb__{key}', obj)
+                    exposed.add(key)
+
+            try:
+                builder.add_from_string(ElementTree.tostring(root, encoding='unicode') if reused else payload)
+            except Exception as e:
+                logger.warning(f'Error updating UI {ui_id}: {e}')
+
+            placeholders = {}
+
+            # Keep dict of all object controllers by id
+            for obj in builder.get_objects():
+                if isinstance(obj, MrgPlaceholder):
+                    toplevel_id = self.object_toplevel.get(utils.object_get_id(obj.props.parent), None)
+                    placeholders.setdefault(toplevel_id, []).append(obj)
+
+                object_id = utils.object_get_id(obj)
+
+                # Exposed objects already have a controller
+                if object_id is None or object_id in exposed:
+                    continue
+
+                if issubclass(type(obj), Gtk.Expander):
+                    obj.props.expanded = True
+
+                self.__set_object_controller(obj, toplevels)
+
+            # Set controller for placeholders created by Builder
+            for toplevel_placeholders in placeholders.values():
+                self.__set_placeholders_controller(toplevel_placeholders)
+
+            # Cache new widgets replacing the old version
+            for toplevel_id, digest in built:
+                self.__widget_cache_remove(toplevel_id)
+
+                if digest is None:
+                    continue
+
+                objects = [builder.get_object(f'__cmb__{object_id}') for object_id in self.toplevel_objects[toplevel_id]]
+
+                self.widget_cache[toplevel_id] = {
+                    'digest': digest,
+                    'objects': [obj for obj in objects if obj is not None],
+                    'placeholders': placeholders.get(toplevel_id, [])
+                }
+
+        self.__widget_cache_trim()
+
+    def is_cached(self, obj):
+        for entry in self.widget_cache.values():
+            objects = entry['objects']
+
+            if objects and objects[0] == obj:
+                return True
+
+        for session in self.ui_sessions.values():
+            if obj in session['objects']:
+                return True
+
+        return False
+
+    def __widget_cache_invalidate(self, ui_id, object_id):
+        # Widget was modified in place, it has to be built again next time
+        toplevel_id = self.object_toplevel.get(f'{ui_id}.{object_id}', None)
+        entry = self.widget_cache.get(toplevel_id, None)
+
+        if entry:
+            entry['digest'] = None
+
+    def __widget_cache_remove(self, toplevel_id):
+        entry = self.widget_cache.pop(toplevel_id, None)
+
+        if entry is None:
+            return
+
+        self.__destroy_unused(entry['objects'])
+
+    def __widget_cache_trim(self):
+        size = sum([len(entry['objects']) for entry in self.widget_cache.values()])
+
+        # Remove least recently used widgets not in the workspace
+        for toplevel_id in list(self.widget_cache.keys()):
+            if size <= WIDGET_CACHE_SIZE:
+                break
+
+            if toplevel_id in self.toplevel_objects:
+                continue
+
+            size -= len(self.widget_cache[toplevel_id]['objects'])
+            self.__widget_cache_remove(toplevel_id)
 
     def object_property_changed(self, ui_id, object_id, property_id, is_object, value):
         controller = self.get_controller(ui_id, object_id)
@@ -153,6 +452,8 @@ class MrgApplication(Gtk.Application):
         if controller is None:
             return
 
+        self.__widget_cache_invalidate(ui_id, object_id)
+
         if is_object:
             target = self.get_controller(ui_id, value)
             controller.set_object_property(property_id,
@@ -169,6 +470,7 @@ class MrgApplication(Gtk.Application):
         if controller is None or child is None:
             return
 
+        self.__widget_cache_invalidate(ui_id, object_id)
         controller.set_object_child_property(child.object, property_id, value)
 
     def _show_widget(self, controller):
@@ -219,11 +521,13 @@ class MrgApplication(Gtk.Application):
     def add_placeholder(self, ui_id, object_id, modifier):
         controller = self.get_controller(ui_id, object_id)
         if controller:
+            self.__widget_cache_invalidate(ui_id, object_id)
             controller.add_placeholder(modifier)
 
     def remove_placeholder(self, ui_id, object_id, modifier):
         controller = self.get_controller(ui_id, object_id)
         if controller:
+            self.__widget_cache_invalidate(ui_id, object_id)
             controller.remove_placeholder(modifier)
 
     def load_namespace(self, namespace, version, object_types):
@@ -285,6 +589,10 @@ class MrgApplication(Gtk.Application):
             self.clear_all()
         elif command == 'update_ui':
             self.update_ui(**args, payload=payload)
+        elif command == 'show_ui':
+            self.show_ui(**args)
+        elif command in ['object_added', 'object_removed', 'object_moved']:
+            self.update_toplevels(**args, payload=payload)
         elif command == 'selection_changed':
             self.selection_changed(**args)
         elif command == 'object_property_changed':
@@ -299,6 +607,8 @@ class MrgApplication(Gtk.Application):
             self.add_placeholder(**args)
         elif command == 'remove_placeholder':
             self.remove_placeholder(**args)
+        elif command == 'debug_controllers':
+            self.debug_controllers()
         elif command == 'load_namespace':
             self.load_namespace(**args)
         elif command == 'set_app_property':
@@ -313,28 +623,15 @@ class MrgApplication(Gtk.Application):
             logger.warning(f'Unknown command {command}')
 
     def on_stdin(self, channel, condition):
-        if condition == GLib.IOCondition.HUP:
-            sys.exit(-1)
-            return GLib.SOURCE_REMOVE
-
-        # We receive a command in each line
-        retval = self.stdin.readline()
-
-        try:
-            # Command is a Json string with a command, args and payload fields
-            cmd = json.loads(retval)
-        except Exception as e:
-            logger.warning(f'Error parsing command {e}')
-        else:
-            command = cmd.get('command', None)
-            args = cmd.get('args', {})
-            has_payload = cmd.get('payload', False)
+        # Commands are a Json line with command and args fields followed by the payload
+        commands, eof = utils.read_commands(sys.stdin.fileno(), self.stdin_buffer)
 
-            # Read payload
-            payload = GLib.strcompress(self.stdin.readline()) if has_payload else None
+        for cmd, payload in commands:
+            self.run_command(cmd.get('command', None), cmd.get('args', {}), payload)
 
-            # Run command
-            self.run_command(command, args, payload)
+        if eof:
+            sys.exit(-1)
+            return GLib.SOURCE_REMOVE
 
         return GLib.SOURCE_CONTINUE
 
@@ -344,6 +641,7 @@ class MrgApplication(Gtk.Application):
         from merengue import mrg_gtk
         self.registry.load_module('Gtk', mrg_gtk)
 
+        os.set_blocking(sys.stdin.fileno(), False)
         self.stdin = GLib.IOChannel.unix_new(sys.stdin.fileno())
         GLib.io_add_watch(self.stdin, GLib.PRIORITY_DEFAULT_IDLE,
                           GLib.IOCondition.IN | GLib.IOCondition.HUP,
@@ -63,6 +63,22 @@ class MrgController(GObject.Object):
     def __on_object_changed(self, obj, pspec):
         self.on_object_changed()
 
+    def reset(self):
+        '''
+        Forget any state about the current object, called before the
+        controller is pooled to be used with a different object.
+        '''
+        self.selected = False
+        self.toplevel = False
+        self.object = None
+
+    def destroy(self):
+        '''
+        Free any resource created by the controller, called when it is not
+        going to be used anymore.
+        '''
+        self.object = None
+
     # Object set property wrapper
     def set_object_property(self, name, value):
         if self.object and name not in self.property_ignore_list:
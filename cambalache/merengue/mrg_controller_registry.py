@@ -58,7 +58,7 @@ class MrgControllerRegistry(GObject.GObject):
                 object_type = get_object_type(klass)
                 self.registry[object_type] = klass
 
-    def new_controller_for_type(self, gtype, app):
+    def get_controller_type(self, gtype):
         klass = None
 
         while gtype and klass is None:
@@ -69,4 +69,8 @@ class MrgControllerRegistry(GObject.GObject):
                 gtype = None
                 break
 
-        return klass(app=app) if klass else MrgController(app=app)
+        return klass if klass else MrgController
+
+    def new_controller_for_type(self, gtype, app):
+        klass = self.get_controller_type(gtype)
+        return klass(app=app)
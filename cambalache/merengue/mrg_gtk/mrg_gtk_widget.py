@@ -93,6 +93,13 @@ class MrgGtkWidget(MrgController):
             self.window.add(self.object)
             self.window.show_all()
 
+    def destroy(self):
+        super().destroy()
+
+        if self.window:
+            self.window.destroy()
+            self.window = None
+
     def on_selected_changed(self):
         if self.object is None:
             return
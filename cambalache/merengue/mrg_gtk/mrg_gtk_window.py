@@ -48,8 +48,12 @@ class MrgGtkWindow(MrgGtkBin):
         self.property_ignore_list.add('modal')
 
     def __on_object_changed(self, obj, pspec):
-        if self._object:
-            self._object.destroy()
+        if self._object and self._object != self.object:
+            # Cached windows are reused if the UI is shown again
+            if self.app.is_cached(self._object):
+                self._object.hide()
+            else:
+                self._object.destroy()
 
         self._object = self.object
 
@@ -60,11 +64,12 @@ class MrgGtkWindow(MrgGtkBin):
         if self.object:
             self._update_name()
 
-            # Make sure the user can not close the window
-            if Gtk.MAJOR_VERSION == 4:
-                self.object.connect('close-request', lambda o: True)
-            else:
-                self.object.connect('delete-event', lambda o, e: True)
+            # Make sure the user can not close the window, cached windows are connected once
+            if getattr(self.object, '_mrg_close_handler_id', None) is None:
+                if Gtk.MAJOR_VERSION == 4:
+                    self.object._mrg_close_handler_id = self.object.connect('close-request', lambda o: True)
+                else:
+                    self.object._mrg_close_handler_id = self.object.connect('delete-event', lambda o, e: True)
 
             # Restore size
             if self._size and not self._is_maximized:
@@ -90,6 +95,15 @@ class MrgGtkWindow(MrgGtkBin):
         # keep track of size, position, and window state (maximized)
         self._save_state()
 
+    def reset(self):
+        super().reset()
+
+        # Pooled controllers should not restore the state of the last window
+        self._position = None
+        self._size = None
+        self._is_maximized = None
+        self._is_fullscreen = None
+
     def _update_name(self):
         if self.object is None:
             return
@@ -27,26 +27,33 @@ import json
 import gi
 from gi.repository import GLib, Gdk, Gtk
 
+# Shared with Cambalache, installed next to the merengue package
+from cmb_protocol import read_commands
+
 
 def write_command(command, payload=None, args=None):
     cmd = {
-        'command': command,
-        'payload_length': len(payload) if payload is not None else 0
+        'command': command
     }
 
     if args is not None:
         cmd['args'] = args
 
-    # Send command in one line as json
-    sys.stdout.write(json.dumps(cmd))
-    sys.stdout.write('\n')
+    data = payload.encode('UTF-8') if payload is not None else None
+
+    # Payload length in bytes, only present if there is a payload
+    if data is not None:
+        cmd['payload_length'] = len(data)
 
-    # Send payload if any
-    if payload is not None:
-        sys.stdout.write(payload)
+    # Send command in one line as json followed by the raw payload
+    sys.stdout.buffer.write(json.dumps(cmd).encode('UTF-8'))
+    sys.stdout.buffer.write(b'\n')
+
+    if data is not None:
+        sys.stdout.buffer.write(data)
 
     # Flush
-    sys.stdout.flush()
+    sys.stdout.buffer.flush()
 
 
 def object_get_builder_id(obj):
@@ -62,17 +69,20 @@ def object_get_builder_id(obj):
         return _g_object_get_data(obj, 'gtk-builder-name')
 
 
-def object_get_id(obj):
-    if obj is None:
-        return None
-
-    builder_id = object_get_builder_id(obj)
+def builder_id_to_object_id(builder_id):
     if builder_id and builder_id.startswith('__cmb__'):
         return builder_id[7:]
 
     return None
 
 
+def object_get_id(obj):
+    if obj is None:
+        return None
+
+    return builder_id_to_object_id(object_get_builder_id(obj))
+
+
 def gesture_click_new(widget, **kwargs):
     if Gtk.MAJOR_VERSION == 4:
         retval = Gtk.GestureClick(**kwargs)
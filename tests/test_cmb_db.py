@@ -0,0 +1,307 @@
+"""
+Test CmbDB internals
+"""
+import os
+import ast
+import shutil
+import threading
+
+from lxml import etree
+from cambalache import CmbProject, cmb_db, cmb_project
+
+
+def catalog_cache_test(target_tk, cache_dir, monkeypatch):
+    monkeypatch.setattr(cmb_db, 'CATALOG_CACHE_DIR', str(cache_dir))
+
+    # First instance parses the catalogs and creates the snapshot
+    db = cmb_db.CmbDB(target_tk=target_tk)
+    types = db.execute('SELECT * FROM type ORDER BY type_id;').fetchall()
+    properties = db.execute('SELECT * FROM property ORDER BY owner_id, property_id;').fetchall()
+
+    cache = [f for f in os.listdir(cache_dir) if f.startswith(target_tk)]
+    assert len(cache) == 1
+
+    # Second instance restores the type system from the snapshot
+    db = cmb_db.CmbDB(target_tk=target_tk)
+    assert db.execute('SELECT * FROM type ORDER BY type_id;').fetchall() == types
+    assert db.execute('SELECT * FROM property ORDER BY owner_id, property_id;').fetchall() == properties
+
+def test_gtk3_catalog_cache(tmp_path, monkeypatch):
+    catalog_cache_test('gtk+-3.0', tmp_path, monkeypatch)
+
+def test_gtk4_catalog_cache(tmp_path, monkeypatch):
+    catalog_cache_test('gtk-4.0', tmp_path, monkeypatch)
+
+def test_catalog_cache_private(tmp_path, monkeypatch):
+    # Directories other users can write to are never trusted
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    os.chmod(shared, 0o777)
+
+    monkeypatch.setattr(cmb_db, 'CATALOG_CACHE_DIR', str(shared))
+    monkeypatch.setattr(cmb_db, 'CATALOG_CACHE_FALLBACK_DIR', str(shared))
+
+    db = cmb_db.CmbDB(target_tk='gtk-4.0')
+    assert os.listdir(shared) == []
+    assert db.execute("SELECT count(1) FROM type WHERE type_id='GtkWindow';").fetchone()[0] == 1
+
+    # Snapshots other users can write to are rebuilt
+    private = tmp_path / 'private'
+    monkeypatch.setattr(cmb_db, 'CATALOG_CACHE_DIR', str(private))
+    cmb_db.CmbDB(target_tk='gtk-4.0')
+    assert oct(os.stat(private).st_mode & 0o777) == oct(0o700)
+
+    snapshot = private / os.listdir(private)[0]
+    with open(snapshot, 'wb') as fd:
+        fd.write(b'planted')
+    os.chmod(snapshot, 0o666)
+
+    db = cmb_db.CmbDB(target_tk='gtk-4.0')
+    assert db.execute("SELECT count(1) FROM type WHERE type_id='GtkWindow';").fetchone()[0] == 1
+    assert os.stat(snapshot).st_mode & 0o022 == 0
+
+    # Snapshots for other versions are left alone
+    other = private / 'gtk-4.0-other.db'
+    other.write_bytes(b'')
+    os.remove(snapshot)
+    cmb_db.CmbDB(target_tk='gtk-4.0')
+    assert other.exists()
+
+
+def test_iter_tuples():
+    text = '''
+	("a \\"quoted\\" \\\\ string\\nwith newline",None,1,-2,3.5,1e+308,True,False),
+	('single',"",0)
+  '''
+    assert list(cmb_db.iter_tuples(text)) == ast.literal_eval(f'[{text}]')
+
+def test_save_matches_baseline(tmp_path):
+    # baseline.cmb was written by the lxml based writer, saving it again
+    # should give exactly the same bytes
+    baseline = os.path.join(os.path.dirname(__file__), 'gtk-4.0', 'baseline.cmb')
+    filename = str(tmp_path / 'baseline.cmb')
+    shutil.copyfile(baseline, filename)
+
+    project = CmbProject(filename=filename)
+    project.db.save(filename)
+
+    with open(baseline, 'rb') as expected, open(filename, 'rb') as saved:
+        assert saved.read() == expected.read()
+
+def incremental_save_test(filename, save_between):
+    project = CmbProject(target_tk='gtk-4.0', filename=filename)
+    dirname = os.path.join(os.path.dirname(__file__), 'gtk-4.0')
+
+    for ui in sorted(os.listdir(dirname)):
+        if ui.endswith('.ui'):
+            project.db.import_file(os.path.join(dirname, ui))
+
+    if save_between:
+        project.save()
+
+    project.db.execute("UPDATE object SET comment='edited' WHERE ui_id=2;")
+    project.db.execute("DELETE FROM object WHERE ui_id=3 AND parent_id IS NULL;")
+    project.db.execute("UPDATE object_data SET value='edited' WHERE ui_id=5 AND id=7;")
+    project.db.execute("DELETE FROM object_data_arg WHERE ui_id=5 AND id=8;")
+    project.db.execute("INSERT INTO css (filename) VALUES ('test.css');")
+    ui = project.add_ui('new.ui')
+    project.add_object(ui.ui_id, 'GtkBox')
+
+    if save_between:
+        project.save()
+
+    project.db.execute("DELETE FROM ui WHERE ui_id=1;")
+    project.save()
+
+    with open(filename, 'r') as fd:
+        return fd.read()
+
+def test_incremental_save(tmp_path):
+    # Saving only changed tables should be the same as saving everything
+    assert incremental_save_test(str(tmp_path / 'a.cmb'), True) == \
+           incremental_save_test(str(tmp_path / 'b.cmb'), False)
+
+def test_save_async(tmp_path):
+    project = CmbProject(target_tk='gtk-4.0', filename=str(tmp_path / 'test.cmb'))
+    project.db.import_file(os.path.join(os.path.dirname(__file__), 'gtk-4.0', 'children.ui'))
+
+    # Changes after save_async() should not end up in the file
+    project.save_async()
+    project.db.execute("UPDATE object SET comment='after';")
+    project.db.save(str(tmp_path / 'sync.cmb'))
+
+    with open(project.filename, 'r') as fd:
+        assert 'after' not in fd.read()
+
+    project.save()
+
+    with open(project.filename, 'r') as fd, open(tmp_path / 'sync.cmb', 'r') as sync:
+        assert fd.read() == sync.read()
+
+    # Saves started while another one is running are written after it
+    project.db.execute("UPDATE object SET comment='first';")
+    project.save_async()
+    project.db.execute("UPDATE object SET comment='second';")
+    project.save_async()
+    project.db.save(str(tmp_path / 'sync.cmb'))
+
+    with open(project.filename, 'r') as fd, open(tmp_path / 'sync.cmb', 'r') as sync:
+        assert fd.read() == sync.read()
+
+    # Temporary files are always renamed
+    assert sorted(os.listdir(tmp_path)) == ['sync.cmb', 'test.cmb']
+
+def test_cmbdb_convert(tmp_path):
+    project = CmbProject(target_tk='gtk-4.0', filename=str(tmp_path / 'test.cmb'))
+    dirname = os.path.join(os.path.dirname(__file__), 'gtk-4.0')
+
+    for ui in sorted(os.listdir(dirname)):
+        if ui.endswith('.ui'):
+            project.db.import_file(os.path.join(dirname, ui))
+
+    project.save()
+
+    # XML -> SQLite -> XML should not lose any data
+    cmb_db.CmbDB.convert(project.filename, str(tmp_path / 'test.cmbdb'))
+    cmb_db.CmbDB.convert(str(tmp_path / 'test.cmbdb'), str(tmp_path / 'converted.cmb'))
+
+    with open(project.filename, 'r') as fd, open(tmp_path / 'converted.cmb', 'r') as converted:
+        assert fd.read() == converted.read()
+
+    # Incremental saves
+    project = CmbProject(filename=str(tmp_path / 'test.cmbdb'))
+    project.db.execute("UPDATE object SET comment='edited' WHERE ui_id=2;")
+    project.db.execute("DELETE FROM ui WHERE ui_id=1;")
+    project.save()
+    project.db.save(str(tmp_path / 'expected.cmb'))
+
+    cmb_db.CmbDB.convert(str(tmp_path / 'test.cmbdb'), str(tmp_path / 'converted.cmb'))
+
+    with open(tmp_path / 'expected.cmb', 'r') as fd, open(tmp_path / 'converted.cmb', 'r') as converted:
+        assert fd.read() == converted.read()
+
+def test_autosave_recovery(tmp_path, monkeypatch):
+    monkeypatch.setattr(cmb_project, 'AUTOSAVE_DIR', str(tmp_path / 'autosave'))
+
+    def wait_autosave():
+        for thread in threading.enumerate():
+            if thread.name == 'CmbDB autosave':
+                thread.join()
+
+    filename = str(tmp_path / 'test.cmb')
+    project = CmbProject(target_tk='gtk-4.0', filename=filename)
+
+    # Nothing changed yet
+    project.autosave()
+    wait_autosave()
+    assert CmbProject.get_recovery_filename(filename) is None
+
+    project.add_ui('recovered.ui')
+    project.autosave()
+    wait_autosave()
+    assert CmbProject.get_recovery_filename(filename) is not None
+
+    recovered = CmbProject(filename=filename, recover=True)
+    assert [ui.filename for ui in recovered.get_ui_list()] == ['recovered.ui']
+
+    # Saving makes the backup obsolete
+    project.save()
+    assert CmbProject.get_recovery_filename(filename) is None
+    assert not os.listdir(tmp_path / 'autosave')
+
+def test_export_toplevels(tmp_path):
+    project = CmbProject(target_tk='gtk-4.0', filename=str(tmp_path / 'test.cmb'))
+    ui_id = project.db.import_file(os.path.join(os.path.dirname(__file__), 'gtk-4.0', 'children.ui'))
+    db = project.db
+
+    db.execute("INSERT INTO object (ui_id, object_id, type_id) VALUES (?, 10, 'GtkLabel');", (ui_id, ))
+
+    toplevel_ids = db.get_toplevel_ids(ui_id)
+    toplevels = db.get_toplevels(ui_id)
+
+    assert set(toplevel_ids.values()) == set(toplevels)
+
+    for object_id, toplevel_id in toplevel_ids.items():
+        assert db.get_toplevel(ui_id, object_id) == toplevel_id
+
+    # Exporting every toplevel one at a time should give the same objects
+    full = etree.fromstring(db.tostring(ui_id, merengue=True).encode())
+    objects = []
+
+    for toplevel_id in toplevels:
+        assert db.get_toplevel_ids(ui_id, toplevel_id) == {k: v for k, v in toplevel_ids.items() if v == toplevel_id}
+        assert not db.has_external_references(ui_id, toplevel_id)
+
+        ui = etree.fromstring(db.tostring(ui_id, merengue=True, toplevels=[toplevel_id]).encode())
+        objects += ui.findall('object')
+
+    assert [etree.tostring(o, with_tail=False) for o in objects] == \
+           [etree.tostring(o, with_tail=False) for o in full.findall('object')]
+
+    # Label mnemonic points inside the first toplevel
+    button_id = max([k for k, v in toplevel_ids.items() if v == toplevels[0]])
+    db.execute("INSERT INTO object_property (ui_id, object_id, owner_id, property_id, value) VALUES (?, 10, 'GtkLabel', 'mnemonic-widget', ?);",
+               (ui_id, button_id))
+    assert db.has_external_references(ui_id, toplevels[0])
+    assert not db.has_external_references(ui_id, 10)
+
+
+def test_export_cache(tmp_path):
+    project = CmbProject(target_tk='gtk-4.0', filename=str(tmp_path / 'test.cmb'))
+    ui_id = project.db.import_file(os.path.join(os.path.dirname(__file__), 'gtk-4.0', 'layout.ui'))
+    db = project.db
+
+    # Another toplevel, its export should not change when the others do
+    db.execute("INSERT INTO object (ui_id, object_id, type_id, name) VALUES (?, 100, 'GtkImage', 'other');", (ui_id, ))
+    other = db.tostring(ui_id, toplevels=[100])
+
+    def check_export():
+        # A new project has nothing cached yet
+        db.save(str(tmp_path / 'fresh.cmb'))
+        fresh = CmbProject(filename=str(tmp_path / 'fresh.cmb')).db
+
+        assert [db.tostring(ui_id), db.tostring(ui_id, merengue=True)] == \
+               [fresh.tostring(ui_id), fresh.tostring(ui_id, merengue=True)]
+        assert db.tostring(ui_id, toplevels=[100]) == other
+
+    check_export()
+
+    grid_id, label_id = [row[0] for row in db.execute("SELECT object_id FROM object WHERE ui_id=? AND type_id IN ('GtkLabel', 'GtkGrid') ORDER BY type_id;", (ui_id, ))]
+    button_id = db.execute("SELECT object_id FROM object WHERE ui_id=? AND parent_id=? ORDER BY position;", (ui_id, grid_id)).fetchone()[0]
+
+    db.execute("UPDATE object_property SET value='Changed' WHERE ui_id=? AND object_id=? AND property_id='label';", (ui_id, button_id))
+    check_export()
+
+    db.execute("UPDATE object_layout_property SET value='3' WHERE ui_id=? AND child_id=? AND property_id='column';", (ui_id, button_id))
+    check_export()
+
+    db.execute("UPDATE object SET name='label' WHERE ui_id=? AND object_id=?;", (ui_id, label_id))
+    db.execute("INSERT INTO object_property (ui_id, object_id, owner_id, property_id, value) VALUES (?, ?, 'GtkLabel', 'mnemonic-widget', ?);",
+               (ui_id, label_id, button_id))
+    db.execute("UPDATE object SET name='button' WHERE ui_id=? AND object_id=?;", (ui_id, button_id))
+    check_export()
+
+    db.execute("UPDATE object SET parent_id=?, position=10 WHERE ui_id=? AND object_id=?;", (grid_id, ui_id, label_id))
+    check_export()
+
+    db.execute("DELETE FROM object WHERE ui_id=? AND object_id=?;", (ui_id, button_id))
+    check_export()
+
+
+def test_export_jobs(tmp_path):
+    project = CmbProject(target_tk='gtk-4.0', filename=str(tmp_path / 'test.cmb'))
+    filenames = ['children.ui', 'layout.ui', 'signals.ui', 'window.ui']
+
+    for filename in filenames:
+        shutil.copy(os.path.join(os.path.dirname(__file__), 'gtk-4.0', filename), tmp_path)
+        project.db.import_file(str(tmp_path / filename), str(tmp_path))
+
+    def export(jobs):
+        for filename in filenames:
+            if os.path.exists(tmp_path / filename):
+                os.remove(tmp_path / filename)
+
+        assert project.export(jobs=jobs) == len(filenames)
+        return [(tmp_path / filename).read_bytes() for filename in filenames]
+
+    assert export(1) == export(2)
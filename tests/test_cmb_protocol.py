@@ -0,0 +1,27 @@
+"""
+Test Cambalache <-> Merengue protocol
+"""
+import os
+import json
+
+from cambalache import cmb_protocol
+
+
+def test_read_commands():
+    r, w = os.pipe()
+    os.set_blocking(r, False)
+    buffer = bytearray()
+
+    payload = 'Payload\nwith ñ'.encode('UTF-8')
+    frame = json.dumps({'command': 'update', 'payload_length': len(payload)}).encode('UTF-8') + b'\n' + payload
+
+    # Incomplete frames are kept for the next read
+    os.write(w, b'{"command": "ping"}\nnot json\n' + frame[:-3])
+    assert cmb_protocol.read_commands(r, buffer) == ([({'command': 'ping'}, None)], False)
+
+    os.write(w, frame[-3:])
+    os.close(w)
+    assert cmb_protocol.read_commands(r, buffer) == ([({'command': 'update', 'payload_length': len(payload)}, 'Payload\nwith ñ')], True)
+    assert len(buffer) == 0
+
+    os.close(r)
@@ -0,0 +1,34 @@
+"""
+Test CmbTypeInfo bulk loading
+"""
+from cambalache import CmbProject, CmbTypeInfo
+
+
+def type_info_test(target_tk):
+    project = CmbProject(target_tk=target_tk)
+
+    c = project.db.cursor()
+    for row in c.execute('SELECT * FROM type WHERE parent_id IS NOT NULL;'):
+        bulk = project.type_info[row[0]]
+        info = CmbTypeInfo.from_row(project, *row)
+
+        assert bulk.hierarchy == info.hierarchy
+        assert bulk.interfaces == info.interfaces
+        assert list(bulk.properties.keys()) == list(info.properties.keys())
+        assert list(bulk.signals.keys()) == list(info.signals.keys())
+        assert list(bulk.data.keys()) == list(info.data.keys())
+        assert list(bulk.child_types.keys()) == list(info.child_types.keys())
+        assert bulk.instantiable == info.instantiable
+
+        for name in ['enum', 'flags']:
+            model = getattr(info, name)
+            if model is not None:
+                assert [tuple(r) for r in getattr(bulk, name)] == [tuple(r) for r in model]
+
+    c.close()
+
+def test_gtk3_type_info():
+    type_info_test('gtk+-3.0')
+
+def test_gtk4_type_info():
+    type_info_test('gtk-4.0')
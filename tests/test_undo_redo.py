@@ -2,6 +2,7 @@
 Test Undo/Redo API
 """
 import os
+import pytest
 
 from cambalache import CmbProject, config
 
@@ -32,3 +33,231 @@ def test_gtk3_undo():
 
 def test_gtk4_undo():
     undo_test('gtk-4.0', 'liststore.ui', 'liststore_test')
+
+
+def test_history_limit():
+    project = CmbProject(target_tk='gtk-4.0')
+    project.history_max_entries = 8
+
+    ui = project.add_ui('test.ui')
+
+    for i in range(0, 8):
+        project.add_object(ui.ui_id, 'GtkLabel', name=f'label{i}')
+
+    # Limits are checked once the project is idle
+    project.compact_history()
+
+    # Oldest ranges are removed whole
+    assert project.db.execute("SELECT count(1) FROM history;").fetchone()[0] <= 8
+    assert project.db.execute("SELECT command FROM history ORDER BY history_id LIMIT 1;").fetchone()[0] == 'PUSH'
+
+    while project.history_index > project.history_index_min:
+        project.undo()
+
+    names = [row[0] for row in project.db.execute("SELECT name FROM object WHERE ui_id=? ORDER BY object_id;", (ui.ui_id, ))]
+    assert names == [f'label{i}' for i in range(0, len(names))] and 0 < len(names) < 8
+
+    project.undo()
+    assert project.get_object_by_name(ui.ui_id, names[-1]) is not None
+
+    # Single commands outside PUSH/POP ranges are compacted too
+    project.history_max_entries = 4
+    project.history_max_size = 512
+
+    for i in range(0, 16):
+        obj = project.get_object_by_name(ui.ui_id, names[i % len(names)])
+        obj.comment = f'comment {i} ' * 8
+
+    project.compact_history()
+    assert project.db.execute("SELECT count(1) FROM history;").fetchone()[0] <= 4
+    assert project.db.execute("SELECT SUM(length(comment)) FROM history_object;").fetchone()[0] <= 512
+
+
+def test_import_undo(monkeypatch):
+    path = os.path.join(os.path.dirname(__file__), 'gtk-4.0', 'liststore.ui')
+    project = CmbProject(target_tk='gtk-4.0')
+
+    ui, msgs, detail_msg = project.import_file(path)
+    ui_id = ui.ui_id
+
+    # Import is recorded as a single command
+    assert project.db.execute("SELECT command FROM history;").fetchall() == [('IMPORT', )]
+    assert project.get_undo_redo_msg()[0] == f'Import file "{path}"'
+
+    count = "SELECT count(1) FROM object WHERE ui_id=?;"
+    n_objects = project.db.execute(count, (ui_id, )).fetchone()[0]
+
+    project.undo()
+    assert project.get_object_by_id(ui_id) is None
+    assert project.db.execute(count, (ui_id, )).fetchone()[0] == 0
+
+    project.redo()
+    assert project.get_object_by_id(ui_id) is not None
+    assert project.get_object_by_name(ui_id, 'liststore_test') is not None
+    assert project.db.execute(count, (ui_id, )).fetchone()[0] == n_objects
+
+    # Overwriting is a single command too and undo restores the old UI
+    project.db.execute("UPDATE object SET comment='old' WHERE ui_id=?;", (ui_id, ))
+    history_index = project.history_index_max
+    new_ui, msgs, detail_msg = project.import_file(path, overwrite=True)
+
+    assert project.get_object_by_id(ui_id) is None
+    assert project.db.execute(count, (ui_id, )).fetchone()[0] == 0
+    assert project.db.execute("SELECT command FROM history WHERE history_id > ?;", (history_index, )).fetchall() == [('IMPORT', )]
+
+    project.undo()
+    assert project.get_object_by_id(new_ui.ui_id) is None
+    assert project.get_object_by_name(ui_id, 'liststore_test') is not None
+    assert project.db.execute("SELECT count(1) FROM object WHERE ui_id=? AND comment='old';", (ui_id, )).fetchone()[0] == n_objects
+
+    project.redo()
+    assert project.get_object_by_id(ui_id) is None
+    assert project.get_object_by_name(new_ui.ui_id, 'liststore_test') is not None
+
+    # Failed imports leave no history and no partial rows behind
+    history = project.db.execute("SELECT * FROM history;").fetchall()
+    ui_ids = project.db.execute("SELECT ui_id FROM ui;").fetchall()
+    import_file = project.db.import_file
+
+    def import_error(*args):
+        import_file(*args)
+        raise Exception('Import error')
+
+    monkeypatch.setattr(project.db, 'import_file', import_error)
+
+    with pytest.raises(Exception):
+        project.import_file(path, overwrite=True)
+
+    assert project.history_enabled
+    assert project.db.execute("SELECT * FROM history;").fetchall() == history
+    assert project.db.execute("SELECT ui_id FROM ui;").fetchall() == ui_ids
+    assert project.get_object_by_name(new_ui.ui_id, 'liststore_test') is not None
+    assert project.db.execute(count, (new_ui.ui_id, )).fetchone()[0] == n_objects
+
+
+def test_range_undo_redo():
+    project = CmbProject(target_tk='gtk-4.0')
+    ui = project.add_ui('test.ui')
+    box = project.add_object(ui.ui_id, 'GtkBox')
+
+    for i in range(0, 4):
+        project.add_object(ui.ui_id, 'GtkLabel', name=f'label{i}', parent_id=box.object_id, position=i)
+
+    project.set_selection([box])
+    project.copy()
+    project.set_selection([ui])
+    project.paste()
+
+    query = "SELECT object_id FROM object WHERE ui_id=? ORDER BY object_id;"
+    pasted = [row[0] for row in project.db.execute(query, (ui.ui_id, ))][5:]
+    assert len(pasted) == 5
+
+    project.undo()
+    assert len(project.db.execute(query, (ui.ui_id, )).fetchall()) == 5
+    assert all(project.get_object_by_id(ui.ui_id, object_id) is None for object_id in pasted)
+
+    project.redo()
+    assert all(project.get_object_by_id(ui.ui_id, object_id) is not None for object_id in pasted)
+
+    # Children are back under their parent in the tree model
+    parent = project.get_iter_from_object(project.get_object_by_id(ui.ui_id, pasted[0]))
+    assert project.iter_n_children(parent) == 4
+
+
+def test_update_compress():
+    project = CmbProject(target_tk='gtk-4.0')
+    ui = project.add_ui('test.ui')
+    obj = project.add_object(ui.ui_id, 'GtkLabel', name='label')
+    history_index = project.history_index
+
+    # Consecutive edits of the same cell are stored in one command
+    obj.name = 'label1'
+    obj.name = 'label2'
+    assert project.history_index == history_index + 1
+
+    # Editing another cell adds a new command
+    obj.comment = 'comment'
+    assert project.history_index == history_index + 2
+
+    # Columns changed by one statement are stored in one command
+    project.db.execute("UPDATE object SET name='label3', comment=NULL WHERE ui_id=? AND object_id=?;",
+                       (ui.ui_id, obj.object_id))
+    assert project.db.execute("SELECT column_name FROM history WHERE history_id=?;",
+                              (project.history_index, )).fetchone()[0] == 'name,comment'
+
+    project.undo()
+    assert obj.name == 'label2' and obj.comment == 'comment'
+
+    project.undo()
+    project.undo()
+    assert obj.name == 'label'
+
+    project.redo()
+    assert obj.name == 'label2'
+
+
+def test_history_persistent(tmp_path):
+    filename = str(tmp_path / 'test.cmb')
+
+    project = CmbProject(target_tk='gtk-4.0', filename=filename, history_persistent=True)
+    ui = project.add_ui('test.ui')
+    project.add_object(ui.ui_id, 'GtkLabel', name='saved')
+    project.save()
+    saved_index = project.history_index
+
+    # Unsaved changes are kept as redo commands
+    project.add_object(ui.ui_id, 'GtkLabel', name='unsaved')
+    project.save_history()
+
+    project = CmbProject(filename=filename, history_persistent=True)
+    assert project.history_index == saved_index
+    assert project.get_object_by_name(ui.ui_id, 'unsaved') is None
+
+    project.redo()
+    assert project.get_object_by_name(ui.ui_id, 'unsaved') is not None
+
+    while project.history_index > project.history_index_min:
+        project.undo()
+
+    assert project.get_object_by_id(ui.ui_id) is None
+
+    # History is not loaded if the project changed
+    with open(filename, 'a') as fd:
+        fd.write('\n')
+
+    project = CmbProject(filename=filename, history_persistent=True)
+    assert project.history_index == 0
+
+
+def test_update_history_ids():
+    project = CmbProject(target_tk='gtk-4.0')
+    project.history_enabled = True
+
+    # Plain DB statements, one history command each
+    project.db.execute("INSERT INTO ui (ui_id, filename) VALUES (1, 'test.ui');")
+    for object_id in range(1, 4):
+        project.db.execute("INSERT INTO object (ui_id, object_id, type_id) VALUES (1, ?, 'GtkLabel');", (object_id, ))
+
+    project.db.execute("UPDATE object SET name='label' WHERE ui_id=1 AND object_id=1;")
+    project.db.execute("INSERT INTO object (ui_id, object_id, type_id) VALUES (1, 4, 'GtkLabel');")
+    project.db.execute("UPDATE object SET name='label2' WHERE ui_id=1 AND object_id=2;")
+    project.db.execute("UPDATE object SET name='label3' WHERE ui_id=1 AND object_id=2;")
+
+    rows = project.db.execute("SELECT history_id, history_old, object_id, name FROM history_object ORDER BY history_id, history_old;").fetchall()
+    assert rows == [
+        (2, 0, 1, None),
+        (3, 0, 2, None),
+        (4, 0, 3, None),
+        (5, 0, 1, 'label'),
+        (5, 1, 1, None),
+        (6, 0, 4, None),
+        (7, 0, 2, 'label3'),
+        (7, 1, 2, None)
+    ]
+
+    project.undo()
+    assert project.db.execute("SELECT name FROM object WHERE object_id=2;").fetchone()[0] is None
+    assert project.db.execute("SELECT count(1) FROM object;").fetchone()[0] == 4
+
+    project.redo()
+    assert project.db.execute("SELECT name FROM object WHERE object_id=2;").fetchone()[0] == 'label3'